@@ -0,0 +1,188 @@
+"""
+Admission control of /play requests with token bucket rate limits
+"""
+
+import logging
+import time
+from typing import Callable, Dict, Hashable, List, Optional, Tuple
+
+import metrics
+from config import Config
+
+ADMISSIONS = metrics.counter(
+    'musicstream_admissions_total', '/play requests by admission outcome and the limit that decided it', ['result', 'reason'])
+
+# Idle buckets are dropped after this many admission checks
+_PRUNE_INTERVAL = 1000
+
+class TokenBucket:
+    """
+    Token bucket that can go into debt
+
+    Requests that would have to wait at most max_delay reserve their
+    tokens right away and are told how long to wait, so deferred requests
+    keep their place and the long-run rate stays bounded.
+    """
+
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate: float, burst: float, now: Optional[float] = None):
+        """
+        Initialize token bucket, full
+
+        Args:
+            rate: Tokens added per second
+            burst: Bucket capacity
+            now: Current monotonic time
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic() if now is None else now
+
+    def delay(self, cost: float, now: float) -> float:
+        """Seconds until cost tokens are available, without taking them"""
+        self._refill(now)
+        if self.tokens >= cost:
+            return 0.0
+        if self.rate <= 0:
+            return float('inf')
+        return (cost - self.tokens) / self.rate
+
+    def take(self, cost: float, now: float):
+        """Take cost tokens, going into debt if there are not enough"""
+        self._refill(now)
+        self.tokens -= cost
+
+    def full(self, now: float) -> bool:
+        """Check if the bucket has refilled completely"""
+        self._refill(now)
+        return self.tokens >= self.burst
+
+    def _refill(self, now: float):
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+class Admission:
+    """Outcome of an admission check"""
+
+    __slots__ = ('admitted', 'delay', 'reason')
+
+    def __init__(self, admitted: bool, delay: float = 0.0, reason: str = ''):
+        self.admitted = admitted
+        # Seconds an admitted request should wait before starting, or a
+        # rejected one before trying again
+        self.delay = delay
+        # Limit that deferred or rejected the request: user, chat, global or busy
+        self.reason = reason
+
+    def __repr__(self) -> str:
+        return f"Admission(admitted={self.admitted}, delay={self.delay:.2f}, reason={self.reason!r})"
+
+class AdmissionController:
+    """
+    Rate limits /play per user, per chat and globally before any search
+    or download starts
+
+    The global limit tightens as play downloads queue up: every pending
+    play download per download slot makes a request cost one more global
+    token, and past shed_backlog pending downloads per slot requests are
+    rejected outright. Runs on the event loop only.
+    """
+
+    def __init__(self, saturation: Optional[Callable[[], float]] = None,
+                 enabled: Optional[bool] = None, max_delay: Optional[float] = None,
+                 shed_backlog: Optional[float] = None):
+        """
+        Initialize admission controller
+
+        Args:
+            saturation: Returns pending play downloads per download slot, None ignores load
+            enabled: Apply the limits (defaults to RATE_LIMIT_ENABLED)
+            max_delay: Longest deferral before a request is rejected (defaults to RATE_LIMIT_MAX_DELAY)
+            shed_backlog: Saturation at which requests are rejected (defaults to RATE_LIMIT_SHED_BACKLOG)
+        """
+        self.saturation = saturation
+        self.enabled = Config.RATE_LIMIT_ENABLED if enabled is None else enabled
+        self.max_delay = Config.RATE_LIMIT_MAX_DELAY if max_delay is None else max_delay
+        self.shed_backlog = Config.RATE_LIMIT_SHED_BACKLOG if shed_backlog is None else shed_backlog
+
+        self.user_buckets: Dict[Hashable, TokenBucket] = {}
+        self.chat_buckets: Dict[Hashable, TokenBucket] = {}
+        self.global_bucket = TokenBucket(Config.RATE_LIMIT_GLOBAL_RATE, Config.RATE_LIMIT_GLOBAL_BURST)
+
+        self._checks = 0
+
+    def admit(self, chat_id: int, user_id: Optional[int] = None) -> Admission:
+        """
+        Decide whether a request may start, and when
+
+        Tokens are only taken from the buckets when the request is admitted.
+
+        Args:
+            chat_id: Chat the request came from
+            user_id: User who sent it, None if unknown
+
+        Returns:
+            Admission with the delay to apply, or the delay before retrying
+        """
+        if not self.enabled:
+            return Admission(True)
+
+        now = time.monotonic()
+        self._checks += 1
+        if self._checks % _PRUNE_INTERVAL == 0:
+            self._prune(now)
+
+        saturation = self.saturation() if self.saturation is not None else 0.0
+        if self.shed_backlog and saturation >= self.shed_backlog:
+            ADMISSIONS.inc(result='rejected', reason='busy')
+            # Downloads take seconds each, a backlog this deep needs a while
+            return Admission(False, max(1.0, self.max_delay), 'busy')
+
+        # (reason, bucket, cost)
+        checks: List[Tuple[str, TokenBucket, float]] = []
+        if user_id is not None:
+            bucket = self._bucket(self.user_buckets, user_id, Config.RATE_LIMIT_USER_RATE, Config.RATE_LIMIT_USER_BURST, now)
+            checks.append(('user', bucket, 1.0))
+        bucket = self._bucket(self.chat_buckets, chat_id, Config.RATE_LIMIT_CHAT_RATE, Config.RATE_LIMIT_CHAT_BURST, now)
+        checks.append(('chat', bucket, 1.0))
+        checks.append(('global', self.global_bucket, 1.0 + saturation))
+
+        delays = [(bucket.delay(cost, now), reason) for reason, bucket, cost in checks]
+        delay, reason = max(delays)
+
+        if delay > self.max_delay:
+            ADMISSIONS.inc(result='rejected', reason=reason)
+            return Admission(False, delay, reason)
+
+        for _, bucket, cost in checks:
+            bucket.take(cost, now)
+
+        if delay > 0:
+            ADMISSIONS.inc(result='deferred', reason=reason)
+            return Admission(True, delay, reason)
+
+        ADMISSIONS.inc(result='admitted', reason='')
+        return Admission(True)
+
+    def stats(self) -> Dict[str, int]:
+        """Get the number of users and chats with a partly used bucket"""
+        return {'users': len(self.user_buckets), 'chats': len(self.chat_buckets)}
+
+    @staticmethod
+    def _bucket(buckets: Dict[Hashable, TokenBucket], key: Hashable, rate: float, burst: float,
+                now: float) -> TokenBucket:
+        """Get the bucket of a user or chat, creating a full one"""
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = TokenBucket(rate, burst, now)
+        return bucket
+
+    def _prune(self, now: float):
+        """Drop full buckets, a new bucket would start in the same state"""
+        for buckets in (self.user_buckets, self.chat_buckets):
+            for key in [key for key, bucket in buckets.items() if bucket.full(now)]:
+                del buckets[key]
+        logging.debug(f"Admission buckets after pruning: {len(self.user_buckets)} users, {len(self.chat_buckets)} chats")
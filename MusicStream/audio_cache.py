@@ -0,0 +1,498 @@
+"""
+On-disk audio cache keyed by YouTube video ID
+"""
+
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+import metrics
+from config import Config
+
+CACHE_REQUESTS = metrics.counter('musicstream_cache_requests_total', 'Cache lookups', ['cache', 'result'])
+CACHE_BYTES = metrics.gauge('musicstream_cache_bytes', 'Bytes of cached audio files')
+
+class AudioCache:
+    """Content-addressed cache of downloaded audio with LRU eviction"""
+
+    INDEX_FILE = "cache_index.json"
+
+    # Minimum seconds between index writes caused only by cache hits
+    SAVE_INTERVAL = 5.0
+
+    def __init__(self, cache_dir: Optional[str] = None, max_bytes: Optional[int] = None):
+        """
+        Initialize audio cache
+
+        Args:
+            cache_dir: Directory holding cached files (defaults to DOWNLOAD_DIR)
+            max_bytes: Byte budget for cached files (defaults to CACHE_MAX_BYTES)
+        """
+        self.cache_dir = cache_dir or Config.DOWNLOAD_DIR
+        self.max_bytes = Config.CACHE_MAX_BYTES if max_bytes is None else max_bytes
+        self.index_path = os.path.join(self.cache_dir, self.INDEX_FILE)
+
+        # Entries ordered from least to most recently used
+        self.entries: "OrderedDict[str, Dict]" = OrderedDict()
+        self.total_bytes = 0
+
+        # File name -> video ID, for lookups by path
+        self._files: Dict[str, str] = {}
+
+        # Files in the cache directory the index does not own, e.g. leftovers
+        # of failed downloads, as file name -> (size, mtime) from the load scan
+        self.orphans: Dict[str, Tuple[int, float]] = {}
+
+        # Entries for which this returns True are never evicted
+        self.is_pinned: Callable[[str], bool] = lambda video_id: False
+
+        self._lock = threading.RLock()
+        self._dirty = False
+        self._last_save = 0.0
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._load()
+
+        CACHE_BYTES.set_function(lambda: self.total_bytes)
+
+        logging.info(f"Audio cache initialized ({len(self.entries)} entries, {self.total_bytes} bytes)")
+
+    @staticmethod
+    def cache_key(video_id: str) -> str:
+        """
+        Convert a video ID into a safe file name stem
+
+        Args:
+            video_id: YouTube video ID
+
+        Returns:
+            File name stem for the cache entry
+        """
+        return re.sub(r'[^A-Za-z0-9_-]', '_', video_id) or "unknown"
+
+    def path_for(self, video_id: str, ext: str) -> str:
+        """
+        Get the cache path for a video ID and extension
+
+        Args:
+            video_id: YouTube video ID
+            ext: File extension without dot
+
+        Returns:
+            Path of the cached file
+        """
+        return os.path.join(self.cache_dir, f"{self.cache_key(video_id)}.{ext}")
+
+    def get(self, video_id: str) -> Optional[str]:
+        """
+        Look up a cached file and mark it as recently used
+
+        Args:
+            video_id: YouTube video ID
+
+        Returns:
+            Path to cached file or None on a miss
+        """
+        with self._lock:
+            entry = self.entries.get(video_id)
+            if entry is None:
+                CACHE_REQUESTS.inc(cache='audio', result='miss')
+                return None
+
+            file_path = os.path.join(self.cache_dir, entry['file_name'])
+            if not os.path.exists(file_path):
+                # File vanished behind our back, forget about it
+                self._drop(video_id)
+                self._save()
+                CACHE_REQUESTS.inc(cache='audio', result='miss')
+                return None
+
+            CACHE_REQUESTS.inc(cache='audio', result='hit')
+
+            entry['last_access'] = time.time()
+            self.entries.move_to_end(video_id)
+            self._dirty = True
+            self._maybe_save()
+            return file_path
+
+    def video_id_for(self, file_path: str) -> Optional[str]:
+        """
+        Find the video ID a cached file belongs to
+
+        Args:
+            file_path: Path of a file in the cache directory
+
+        Returns:
+            Video ID or None if the file is not cached
+        """
+        with self._lock:
+            return self._files.get(os.path.basename(file_path))
+
+    def get_entry(self, video_id: str) -> Optional[Dict]:
+        """
+        Get a copy of the index entry for a video ID
+
+        Args:
+            video_id: YouTube video ID
+
+        Returns:
+            Index entry dict or None if not cached
+        """
+        with self._lock:
+            entry = self.entries.get(video_id)
+            return dict(entry) if entry else None
+
+    def put(self, video_id: str, file_path: str, duration: float = 0, codec: Optional[str] = None) -> str:
+        """
+        Register a downloaded file in the cache
+
+        Args:
+            video_id: YouTube video ID
+            file_path: Path of the downloaded file inside the cache directory
+            duration: Track duration in seconds
+            codec: Audio codec or container of the file
+
+        Returns:
+            Path to the cached file
+        """
+        with self._lock:
+            now = time.time()
+
+            if video_id in self.entries:
+                old_entry = self.entries[video_id]
+                if old_entry['file_name'] != os.path.basename(file_path):
+                    self._remove_file(old_entry['file_name'])
+                # Sidecars were derived from the old file
+                for sidecar in old_entry.get('sidecars', {}).values():
+                    self._remove_file(sidecar['file_name'])
+                self._drop(video_id)
+
+            self.entries[video_id] = {
+                'file_name': os.path.basename(file_path),
+                'size': os.path.getsize(file_path),
+                'created': now,
+                'last_access': now,
+                'duration': duration or 0,
+                'codec': codec or os.path.splitext(file_path)[1].lstrip('.'),
+            }
+            self.total_bytes += self.entries[video_id]['size']
+            self._files[self.entries[video_id]['file_name']] = video_id
+            self.orphans.pop(self.entries[video_id]['file_name'], None)
+
+            self.evict()
+            self._save()
+            return file_path
+
+    def update(self, video_id: str, **fields) -> bool:
+        """
+        Update metadata fields of a cache entry
+
+        Args:
+            video_id: YouTube video ID
+            **fields: Fields to store in the index entry
+
+        Returns:
+            True if updated, False if the entry does not exist
+        """
+        with self._lock:
+            entry = self.entries.get(video_id)
+            if entry is None:
+                return False
+
+            entry.update(fields)
+            self._dirty = True
+            self._save()
+            return True
+
+    def attach(self, video_id: str, kind: str, file_path: str, **fields) -> bool:
+        """
+        Register a file derived from a cache entry, e.g. its Opus frames
+
+        Sidecars count against the byte budget and are removed together
+        with their entry.
+
+        Args:
+            video_id: YouTube video ID
+            kind: Sidecar kind, e.g. 'frames'
+            file_path: Path of the sidecar inside the cache directory
+            **fields: Details stored with the sidecar, e.g. how it was made
+
+        Returns:
+            True if attached, False if the entry does not exist
+        """
+        with self._lock:
+            entry = self.entries.get(video_id)
+            if entry is None:
+                return False
+
+            file_name = os.path.basename(file_path)
+            old_sidecar = self._detach(entry, kind)
+            if old_sidecar is not None and old_sidecar['file_name'] != file_name:
+                self._remove_file(old_sidecar['file_name'])
+
+            size = os.path.getsize(file_path)
+            entry.setdefault('sidecars', {})[kind] = {**fields, 'file_name': file_name, 'size': size}
+            entry['size'] += size
+            self.total_bytes += size
+            self._files[file_name] = video_id
+            self.orphans.pop(file_name, None)
+
+            self._dirty = True
+            self.evict()
+            self._save()
+            return True
+
+    def sidecar_path(self, video_id: str, kind: str) -> Optional[str]:
+        """
+        Get the path of a sidecar of a cache entry
+
+        Args:
+            video_id: YouTube video ID
+            kind: Sidecar kind
+
+        Returns:
+            Path of the sidecar or None if it is missing
+        """
+        with self._lock:
+            entry = self.entries.get(video_id)
+            sidecar = entry.get('sidecars', {}).get(kind) if entry else None
+            if sidecar is None:
+                return None
+
+            file_path = os.path.join(self.cache_dir, sidecar['file_name'])
+            if not os.path.exists(file_path):
+                self._detach(entry, kind)
+                self._save()
+                return None
+            return file_path
+
+    def remove(self, video_id: str) -> bool:
+        """
+        Remove an entry and its file from the cache
+
+        Args:
+            video_id: YouTube video ID
+
+        Returns:
+            True if removed, False otherwise
+        """
+        with self._lock:
+            entry = self.entries.get(video_id)
+            if entry is None:
+                return False
+
+            self._remove_files(entry)
+            self._drop(video_id)
+            self._save()
+            return True
+
+    def evict(self, max_bytes: Optional[int] = None) -> int:
+        """
+        Evict least recently used entries until the cache fits its budget
+
+        Pinned entries are skipped, so the cache may stay over budget.
+
+        Args:
+            max_bytes: Byte budget to enforce (defaults to the cache budget)
+
+        Returns:
+            Number of bytes freed
+        """
+        budget = self.max_bytes if max_bytes is None else max_bytes
+        freed = 0
+
+        with self._lock:
+            for video_id, entry in list(self.entries.items()):
+                if self.total_bytes <= budget:
+                    break
+                if self.is_pinned(video_id):
+                    continue
+                self._remove_files(entry)
+                self._drop(video_id)
+                freed += entry['size']
+                logging.info(f"Evicted cached audio: {entry['file_name']} ({entry['size']} bytes)")
+
+            if freed:
+                self._save()
+
+        return freed
+
+    def expire(self, max_age_seconds: float) -> int:
+        """
+        Remove entries that have not been used for a while
+
+        Args:
+            max_age_seconds: Maximum time since last access in seconds
+
+        Returns:
+            Number of bytes freed
+        """
+        cutoff = time.time() - max_age_seconds
+        freed = 0
+
+        with self._lock:
+            # Entries are in LRU order, so stop at the first fresh one
+            for video_id, entry in list(self.entries.items()):
+                if entry['last_access'] >= cutoff:
+                    break
+                if self.is_pinned(video_id):
+                    continue
+                self._remove_files(entry)
+                self._drop(video_id)
+                freed += entry['size']
+
+            if freed:
+                self._save()
+
+        return freed
+
+    def remove_orphans(self, max_age_seconds: float) -> int:
+        """
+        Delete untracked files found by the load scan once they are old
+
+        Args:
+            max_age_seconds: Minimum time since the file was last written
+
+        Returns:
+            Number of bytes freed
+        """
+        cutoff = time.time() - max_age_seconds
+        freed = 0
+
+        with self._lock:
+            for file_name, (size, mtime) in list(self.orphans.items()):
+                if mtime >= cutoff:
+                    continue
+                del self.orphans[file_name]
+                self._remove_file(file_name)
+                freed += size
+                logging.info(f"Removed untracked file: {file_name} ({size} bytes)")
+
+        return freed
+
+    def orphan_bytes(self) -> int:
+        """Get the bytes held by untracked files"""
+        with self._lock:
+            return sum(size for size, _ in self.orphans.values())
+
+    def video_ids(self) -> List[str]:
+        """Get the IDs of all cached videos, least recently used first"""
+        with self._lock:
+            return list(self.entries)
+
+    def tracked_files(self) -> Set[str]:
+        """Get the names of all files in the cache directory owned by the cache"""
+        with self._lock:
+            return set(self._files) | {self.INDEX_FILE}
+
+    def flush(self):
+        """Write pending index changes to disk"""
+        with self._lock:
+            if self._dirty:
+                self._save()
+
+    def _drop(self, video_id: str):
+        """Forget an entry without touching its file"""
+        entry = self.entries.pop(video_id, None)
+        if entry:
+            self.total_bytes -= entry['size']
+            self._files.pop(entry['file_name'], None)
+            for sidecar in entry.get('sidecars', {}).values():
+                self._files.pop(sidecar['file_name'], None)
+            self._dirty = True
+
+    def _detach(self, entry: Dict, kind: str) -> Optional[Dict]:
+        """Forget a sidecar of an entry without touching its file"""
+        sidecar = entry.get('sidecars', {}).pop(kind, None)
+        if sidecar is not None:
+            self._files.pop(sidecar['file_name'], None)
+            entry['size'] -= sidecar['size']
+            self.total_bytes -= sidecar['size']
+            self._dirty = True
+        return sidecar
+
+    def _remove_files(self, entry: Dict):
+        """Delete the file of an entry and its sidecars"""
+        self._remove_file(entry['file_name'])
+        for sidecar in entry.get('sidecars', {}).values():
+            self._remove_file(sidecar['file_name'])
+
+    def _remove_file(self, file_name: str):
+        """Delete a cached file, ignoring files that are already gone"""
+        try:
+            os.remove(os.path.join(self.cache_dir, file_name))
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logging.error(f"Error removing cached file {file_name}: {e}")
+
+    def _load(self):
+        """
+        Load the persistent index, dropping entries whose files are gone
+
+        The directory is listed once with os.scandir, which also finds the
+        untracked files.
+        """
+        files: Dict[str, os.stat_result] = {}
+        with os.scandir(self.cache_dir) as it:
+            for dir_entry in it:
+                if dir_entry.is_file():
+                    files[dir_entry.name] = dir_entry.stat()
+
+        try:
+            with open(self.index_path, 'r') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            data = {}
+        except Exception as e:
+            logging.error(f"Error loading cache index, starting empty: {e}")
+            data = {}
+
+        for video_id, entry in sorted(data.items(), key=lambda item: item[1].get('last_access', 0)):
+            stat = files.get(entry.get('file_name', ''))
+            if stat is None:
+                self._dirty = True
+                continue
+
+            entry['size'] = stat.st_size
+            sidecars = entry.get('sidecars', {})
+            for kind, sidecar in list(sidecars.items()):
+                sidecar_stat = files.get(sidecar.get('file_name', ''))
+                if sidecar_stat is not None:
+                    sidecar['size'] = sidecar_stat.st_size
+                    entry['size'] += sidecar['size']
+                    self._files[sidecar['file_name']] = video_id
+                else:
+                    del sidecars[kind]
+                    self._dirty = True
+
+            self.entries[video_id] = entry
+            self.total_bytes += entry['size']
+            self._files[entry['file_name']] = video_id
+
+        owned = set(self._files) | {self.INDEX_FILE, self.INDEX_FILE + ".tmp"}
+        self.orphans = {
+            name: (stat.st_size, stat.st_mtime) for name, stat in files.items() if name not in owned
+        }
+
+    def _maybe_save(self):
+        """Save the index if enough time has passed since the last write"""
+        if time.time() - self._last_save >= self.SAVE_INTERVAL:
+            self._save()
+
+    def _save(self):
+        """Atomically write the index to disk"""
+        try:
+            tmp_path = self.index_path + ".tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(self.entries, f)
+            os.replace(tmp_path, self.index_path)
+            self._dirty = False
+            self._last_save = time.time()
+        except Exception as e:
+            logging.error(f"Error saving cache index: {e}")
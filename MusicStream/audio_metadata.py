@@ -0,0 +1,395 @@
+"""
+Audio duration and codec detection without blocking the play path
+"""
+
+import asyncio
+import logging
+import os
+import struct
+from typing import Dict, Optional, Tuple
+
+from config import Config
+
+# Fallback when nothing else can tell the duration
+DEFAULT_DURATION = 180.0
+
+# MPEG audio bitrate tables in kbit/s, indexed by [version is MPEG1][layer][index]
+_MP3_BITRATES = {
+    True: {
+        1: (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+        2: (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+        3: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    },
+    False: {
+        1: (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+        2: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+        3: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    },
+}
+_MP3_SAMPLE_RATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)}
+
+def _parse_mp3_header(header: bytes) -> Optional[Tuple[int, int, int, int, bool, bool]]:
+    """
+    Parse a 4-byte MPEG audio frame header
+
+    Returns:
+        (frame length, bitrate in bit/s, sample rate, samples per frame, is MPEG1, is mono)
+        or None if the bytes are not a valid header
+    """
+    if len(header) < 4 or header[0] != 0xFF or (header[1] & 0xE0) != 0xE0:
+        return None
+
+    version = (header[1] >> 3) & 0x03
+    layer = 4 - ((header[1] >> 1) & 0x03)
+    bitrate_index = header[2] >> 4
+    sample_rate_index = (header[2] >> 2) & 0x03
+    if version == 1 or layer == 4 or bitrate_index in (0, 15) or sample_rate_index == 3:
+        return None
+
+    mpeg1 = version == 3
+    bitrate = _MP3_BITRATES[mpeg1][layer][bitrate_index] * 1000
+    sample_rate = _MP3_SAMPLE_RATES[version][sample_rate_index]
+    padding = (header[2] >> 1) & 0x01
+    mono = (header[3] >> 6) == 3
+
+    if layer == 1:
+        samples = 384
+        frame_length = (12 * bitrate // sample_rate + padding) * 4
+    else:
+        samples = 1152 if (layer == 2 or mpeg1) else 576
+        frame_length = samples // 8 * bitrate // sample_rate + padding
+
+    return frame_length, bitrate, sample_rate, samples, mpeg1, mono
+
+def _mp3_duration(f, file_size: int) -> Optional[float]:
+    """Get the duration of an MP3 file from its Xing/VBRI header or CBR bitrate"""
+    f.seek(0)
+    head = f.read(10)
+    offset = 0
+    if head[:3] == b'ID3' and len(head) == 10:
+        size = (head[6] << 21) | (head[7] << 14) | (head[8] << 7) | head[9]
+        offset = 10 + size + (10 if head[5] & 0x10 else 0)
+
+    f.seek(offset)
+    data = f.read(64 * 1024)
+
+    for i in range(len(data) - 4):
+        if data[i] != 0xFF:
+            continue
+        frame = _parse_mp3_header(data[i:i + 4])
+        if frame is None:
+            continue
+
+        frame_length, bitrate, sample_rate, samples, mpeg1, mono = frame
+        # Require the next frame to line up to rule out false sync words
+        next_header = data[i + frame_length:i + frame_length + 4]
+        if len(next_header) == 4 and _parse_mp3_header(next_header) is None:
+            continue
+
+        # Xing/Info header of VBR encoders
+        side_info = (17 if mono else 32) if mpeg1 else (9 if mono else 17)
+        xing = i + 4 + side_info
+        if data[xing:xing + 4] in (b'Xing', b'Info'):
+            flags = struct.unpack('>I', data[xing + 4:xing + 8])[0]
+            if flags & 0x01:
+                frames = struct.unpack('>I', data[xing + 8:xing + 12])[0]
+                return frames * samples / sample_rate
+
+        # VBRI header of the Fraunhofer encoder
+        vbri = i + 4 + 32
+        if data[vbri:vbri + 4] == b'VBRI':
+            frames = struct.unpack('>I', data[vbri + 14:vbri + 18])[0]
+            return frames * samples / sample_rate
+
+        # Constant bitrate
+        audio_bytes = file_size - offset - i
+        f.seek(-128, os.SEEK_END)
+        if f.read(3) == b'TAG':
+            audio_bytes -= 128
+        return audio_bytes * 8 / bitrate
+
+    return None
+
+def _ogg_duration(f, file_size: int) -> Optional[float]:
+    """Get the duration of an Ogg Opus or Vorbis file from its last granule position"""
+    f.seek(0)
+    first_page = f.read(4096)
+    if first_page[:4] != b'OggS':
+        return None
+
+    segments = first_page[26]
+    packet = first_page[27 + segments:]
+    if packet[:8] == b'OpusHead':
+        pre_skip = struct.unpack('<H', packet[10:12])[0]
+        sample_rate = 48000
+    elif packet[:7] == b'\x01vorbis':
+        pre_skip = 0
+        sample_rate = struct.unpack('<I', packet[12:16])[0]
+    else:
+        return None
+
+    tail_size = min(file_size, 64 * 1024)
+    f.seek(file_size - tail_size)
+    tail = f.read(tail_size)
+
+    position = tail.rfind(b'OggS')
+    while position != -1:
+        granule = struct.unpack('<q', tail[position + 6:position + 14])[0]
+        if granule >= 0:
+            return max(0, granule - pre_skip) / sample_rate
+        position = tail.rfind(b'OggS', 0, position)
+
+    return None
+
+def _mp4_duration(f, file_size: int) -> Optional[float]:
+    """Get the duration of an MP4/M4A file from its movie header"""
+    def find_box(start: int, end: int, box_type: bytes) -> Optional[Tuple[int, int]]:
+        position = start
+        while position + 8 <= end:
+            f.seek(position)
+            size, kind = struct.unpack('>I4s', f.read(8))
+            header = 8
+            if size == 1:
+                size = struct.unpack('>Q', f.read(8))[0]
+                header = 16
+            elif size == 0:
+                size = end - position
+            if size < header:
+                return None
+            if kind == box_type:
+                return position + header, position + size
+            position += size
+        return None
+
+    moov = find_box(0, file_size, b'moov')
+    if moov is None:
+        return None
+
+    mvhd = find_box(moov[0], moov[1], b'mvhd')
+    if mvhd is None:
+        return None
+
+    f.seek(mvhd[0])
+    version = f.read(4)[0]
+    if version == 1:
+        timescale, duration = struct.unpack('>16xIQ', f.read(28))
+    else:
+        timescale, duration = struct.unpack('>8xII', f.read(16))
+
+    return duration / timescale if timescale else None
+
+def _read_ebml_vint(data: bytes, position: int, keep_marker: bool) -> Tuple[int, int]:
+    """Read an EBML variable-length integer, returning (value, next position)"""
+    first = data[position]
+    length = 1
+    while length <= 8 and not first & (0x80 >> (length - 1)):
+        length += 1
+    if length > 8:
+        raise ValueError("Invalid EBML integer")
+
+    value = first if keep_marker else first & (0xFF >> length)
+    for byte in data[position + 1:position + length]:
+        value = (value << 8) | byte
+
+    if not keep_marker and value == (1 << (7 * length)) - 1:
+        # All ones means unknown size
+        value = -1
+    return value, position + length
+
+def _webm_duration(f, file_size: int) -> Optional[Tuple[float, str]]:
+    """Get the duration and codec of a WebM/Matroska file from its segment info"""
+    f.seek(0)
+    data = f.read(64 * 1024)
+
+    def children(start: int, end: int):
+        position = start
+        while position < min(end, len(data)) - 1:
+            element_id, position = _read_ebml_vint(data, position, True)
+            size, position = _read_ebml_vint(data, position, False)
+            child_end = end if size < 0 else position + size
+            yield element_id, position, child_end
+            position = child_end
+
+    codec = 'opus' if b'A_OPUS' in data else ('vorbis' if b'A_VORBIS' in data else 'webm')
+
+    for element_id, start, end in children(0, len(data)):
+        if element_id != 0x18538067:  # Segment
+            continue
+        for child_id, child_start, child_end in children(start, end):
+            if child_id != 0x1549A966:  # Info
+                continue
+            timecode_scale = 1000000
+            duration = None
+            for info_id, info_start, info_end in children(child_start, child_end):
+                value = data[info_start:info_end]
+                if info_id == 0x2AD7B1:
+                    timecode_scale = int.from_bytes(value, 'big')
+                elif info_id == 0x4489:
+                    duration = struct.unpack('>f' if len(value) == 4 else '>d', value)[0]
+            if duration is None:
+                return None
+            return duration * timecode_scale / 1e9, codec
+
+    return None
+
+def parse_duration(file_path: str) -> Optional[Tuple[float, str]]:
+    """
+    Read the duration of an audio file from its headers in pure Python
+
+    Args:
+        file_path: Path to audio file
+
+    Returns:
+        (duration in seconds, codec) or None if the format is not understood
+    """
+    try:
+        file_size = os.path.getsize(file_path)
+        with open(file_path, 'rb') as f:
+            magic = f.read(12)
+
+            if magic[:4] == b'OggS':
+                duration = _ogg_duration(f, file_size)
+                codec = 'opus' if duration is not None and _is_opus(f) else 'vorbis'
+            elif magic[:4] == b'\x1a\x45\xdf\xa3':
+                parsed = _webm_duration(f, file_size)
+                duration, codec = parsed if parsed else (None, 'webm')
+            elif magic[4:8] == b'ftyp':
+                duration, codec = _mp4_duration(f, file_size), 'aac'
+            elif magic[:3] == b'ID3' or (magic[0] == 0xFF and (magic[1] & 0xE0) == 0xE0):
+                duration, codec = _mp3_duration(f, file_size), 'mp3'
+            else:
+                return None
+
+        if duration and duration > 0:
+            return duration, codec
+        return None
+
+    except Exception as e:
+        logging.warning(f"Could not parse audio headers of {file_path}: {e}")
+        return None
+
+def _is_opus(f) -> bool:
+    """Check if an Ogg stream starts with an Opus header"""
+    f.seek(0)
+    page = f.read(4096)
+    return page[27 + page[26]:][:8] == b'OpusHead'
+
+async def ffprobe_duration(file_path: str, timeout: float = 10.0) -> Optional[float]:
+    """
+    Get the duration of an audio file with ffprobe in an async subprocess
+
+    Args:
+        file_path: Path to audio file
+        timeout: Seconds to wait for ffprobe
+
+    Returns:
+        Duration in seconds or None if ffprobe failed
+    """
+    # ffprobe ships next to ffmpeg
+    ffmpeg_dir = os.path.dirname(Config.FFMPEG_PATH)
+    ffprobe = os.path.join(ffmpeg_dir, 'ffprobe') if ffmpeg_dir else 'ffprobe'
+
+    try:
+        process = await asyncio.create_subprocess_exec(
+            ffprobe, '-v', 'quiet', '-show_entries', 'format=duration', '-of', 'csv=p=0', file_path,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+    except Exception as e:
+        logging.warning(f"Could not run ffprobe: {e}")
+        return None
+
+    try:
+        stdout, _ = await asyncio.wait_for(process.communicate(), timeout)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        logging.warning(f"ffprobe timed out for {file_path}")
+        return None
+
+    if process.returncode == 0 and stdout.strip():
+        try:
+            return float(stdout.strip())
+        except ValueError:
+            return None
+    return None
+
+class AudioMetadata:
+    """Resolves track durations from the cheapest source that knows them"""
+
+    def __init__(self, cache=None):
+        """
+        Initialize metadata resolver
+
+        Args:
+            cache: AudioCache whose index stores probed metadata
+        """
+        self.cache = cache
+
+        # Durations of files outside the cache, keyed by (path, size, mtime)
+        self._memo: Dict[Tuple[str, int, float], float] = {}
+
+        self.stats = {'info': 0, 'index': 0, 'header': 0, 'ffprobe': 0, 'default': 0}
+
+    async def get_duration(self, file_path: str, info_duration: Optional[float] = None,
+                           video_id: Optional[str] = None) -> float:
+        """
+        Get the duration of a track
+
+        Sources are tried in order: the yt-dlp info, the cache index, the
+        file headers and finally ffprobe. Anything found on disk is written
+        back to the cache index so the file is not inspected again.
+
+        Args:
+            file_path: Path to audio file
+            info_duration: Duration reported by yt-dlp, if any
+            video_id: Cache key of the file, looked up from the path if not given
+
+        Returns:
+            Duration in seconds
+        """
+        if info_duration:
+            self.stats['info'] += 1
+            return float(info_duration)
+
+        if video_id is None and self.cache is not None:
+            video_id = self.cache.video_id_for(file_path)
+
+        entry = self.cache.get_entry(video_id) if (self.cache is not None and video_id) else None
+        if entry and entry.get('duration'):
+            self.stats['index'] += 1
+            return float(entry['duration'])
+
+        try:
+            stat = os.stat(file_path)
+            memo_key = (file_path, stat.st_size, stat.st_mtime)
+        except OSError:
+            memo_key = None
+        if memo_key in self._memo:
+            self.stats['index'] += 1
+            return self._memo[memo_key]
+
+        codec = None
+        parsed = parse_duration(file_path)
+        if parsed:
+            duration, codec = parsed
+            self.stats['header'] += 1
+        else:
+            duration = await ffprobe_duration(file_path)
+            if duration:
+                self.stats['ffprobe'] += 1
+
+        if not duration:
+            self.stats['default'] += 1
+            logging.warning(f"Could not get audio duration of {file_path}, assuming {DEFAULT_DURATION}s")
+            return DEFAULT_DURATION
+
+        if entry is not None:
+            fields = {'duration': duration}
+            if codec:
+                fields['codec'] = codec
+            self.cache.update(video_id, **fields)
+        elif memo_key is not None:
+            self._memo[memo_key] = duration
+
+        return duration
@@ -0,0 +1,253 @@
+"""
+Remuxing, transcoding, Opus frame encoding and loudness analysis of
+downloaded audio in worker processes
+"""
+
+import asyncio
+import json
+import logging
+import math
+import multiprocessing
+import os
+import subprocess
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+from config import Config
+from opus_frames import SAMPLE_RATE, is_ogg_opus, read_ogg_opus, write_frames
+
+# Audio-only file extension for each codec family served by YouTube
+CODEC_EXTENSIONS = {
+    'opus': 'opus',
+    'aac': 'm4a',
+    'mp3': 'mp3',
+    'vorbis': 'ogg',
+}
+
+# ffmpeg muxer for each audio file extension
+MUXERS = {
+    'opus': 'ogg',
+    'ogg': 'ogg',
+    'm4a': 'ipod',
+    'mp3': 'mp3',
+}
+
+# ffmpeg encoder used when AUDIO_FORMAT has to be produced by transcoding
+ENCODERS = {
+    'opus': 'libopus',
+    'ogg': 'libvorbis',
+    'm4a': 'aac',
+    'mp3': 'libmp3lame',
+}
+
+def codec_family(acodec: Optional[str]) -> Optional[str]:
+    """
+    Map a yt-dlp acodec value to a codec family
+
+    Args:
+        acodec: Codec string, e.g. 'opus' or 'mp4a.40.2'
+
+    Returns:
+        'opus', 'aac', 'mp3', 'vorbis' or None if unknown
+    """
+    acodec = (acodec or '').lower()
+    if acodec.startswith('opus'):
+        return 'opus'
+    if acodec.startswith(('mp4a', 'aac')):
+        return 'aac'
+    if acodec.startswith('mp3'):
+        return 'mp3'
+    if acodec.startswith('vorbis'):
+        return 'vorbis'
+    return None
+
+def convert_audio(source: str, target: str, encoder: Optional[str] = None,
+                  bitrate: Optional[str] = None, ffmpeg: str = 'ffmpeg') -> float:
+    """
+    Write the first audio stream of a file into an audio-only container
+
+    Runs in a worker process. The target is written next to itself and
+    renamed once complete.
+
+    Args:
+        source: Downloaded file
+        target: Output path, its extension picks the container
+        encoder: ffmpeg encoder to transcode with, None copies the stream
+        bitrate: Target bitrate when transcoding, e.g. '128k'
+        ffmpeg: Path of the ffmpeg executable
+
+    Returns:
+        Seconds ffmpeg took
+    """
+    ext = os.path.splitext(target)[1].lstrip('.')
+    part_path = target + ".part"
+
+    command = [ffmpeg, '-nostdin', '-y', '-v', 'error', '-i', source, '-map', '0:a:0', '-vn']
+    if encoder is None:
+        command += ['-c:a', 'copy']
+    else:
+        command += ['-c:a', encoder] + (['-b:a', bitrate] if bitrate else [])
+    command += ['-f', MUXERS.get(ext, ext), part_path]
+
+    started = time.perf_counter()
+    try:
+        subprocess.run(command, check=True, capture_output=True, timeout=600)
+        os.replace(part_path, target)
+    except subprocess.CalledProcessError as e:
+        raise RuntimeError(e.stderr.decode(errors='replace').strip() or f"ffmpeg exited with {e.returncode}")
+    finally:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+    return time.perf_counter() - started
+
+def encode_opus_frames(source: str, target: str, bitrate: Optional[str] = None,
+                       ffmpeg: str = 'ffmpeg', gain: float = 0.0) -> float:
+    """
+    Write a track as a voice chat ready Opus frame file
+
+    Runs in a worker process. Ogg Opus sources without a gain are only
+    repacketized, anything else is encoded to 48 kHz stereo Opus once,
+    with the gain applied as a fixed volume change.
+
+    Args:
+        source: Cached audio file
+        target: Output frame file
+        bitrate: Opus bitrate when encoding, e.g. '128k'
+        ffmpeg: Path of the ffmpeg executable
+        gain: Loudness normalization gain in dB
+
+    Returns:
+        Seconds the job took
+    """
+    started = time.perf_counter()
+    ogg_path = source if is_ogg_opus(source) and not gain else target + ".ogg"
+
+    try:
+        if ogg_path != source:
+            command = [ffmpeg, '-nostdin', '-y', '-v', 'error', '-i', source, '-map', '0:a:0', '-vn']
+            if gain:
+                command += ['-af', f"volume={gain:.2f}dB"]
+            command += ['-c:a', 'libopus', '-ar', str(SAMPLE_RATE), '-ac', '2', '-frame_duration', '20']
+            command += (['-b:a', bitrate] if bitrate else []) + ['-f', 'ogg', ogg_path]
+            try:
+                subprocess.run(command, check=True, capture_output=True, timeout=600)
+            except subprocess.CalledProcessError as e:
+                raise RuntimeError(e.stderr.decode(errors='replace').strip() or f"ffmpeg exited with {e.returncode}")
+
+        with open(ogg_path, 'rb') as f:
+            channels, pre_skip, packets = read_ogg_opus(f)
+            write_frames(target, channels, pre_skip, packets)
+    finally:
+        if ogg_path != source and os.path.exists(ogg_path):
+            os.remove(ogg_path)
+    return time.perf_counter() - started
+
+def loudness_gain(loudness: float, true_peak: float, target: float, max_peak: float) -> float:
+    """
+    Get the fixed gain that brings a track to the target loudness
+
+    The gain is lowered where needed so the true peak stays at or below
+    max_peak.
+
+    Args:
+        loudness: Integrated loudness in LUFS
+        true_peak: True peak in dBTP
+        target: Target integrated loudness in LUFS
+        max_peak: Highest true peak after the gain in dBTP
+
+    Returns:
+        Gain in dB, 0 for silent or unmeasurable tracks
+    """
+    if not (math.isfinite(loudness) and math.isfinite(true_peak)):
+        return 0.0
+    return round(min(target - loudness, max_peak - true_peak), 2)
+
+def analyze_loudness(source: str, target: float = -16.0, max_peak: float = -1.0,
+                     ffmpeg: str = 'ffmpeg') -> Dict[str, float]:
+    """
+    Measure the loudness of a track with ffmpeg's loudnorm filter
+
+    Runs in a worker process. The audio is decoded once and nothing is
+    written.
+
+    Args:
+        source: Cached audio file
+        target: Target integrated loudness in LUFS
+        max_peak: Highest true peak after the gain in dBTP
+        ffmpeg: Path of the ffmpeg executable
+
+    Returns:
+        Dict with the integrated loudness, true peak, loudness range, the
+        gain to apply and the seconds the analysis took
+    """
+    command = [ffmpeg, '-nostdin', '-hide_banner', '-nostats', '-i', source, '-map', '0:a:0', '-vn',
+               '-af', f"loudnorm=I={target}:TP={max_peak}:print_format=json", '-f', 'null', '-']
+
+    started = time.perf_counter()
+    try:
+        process = subprocess.run(command, check=True, capture_output=True, timeout=600)
+    except subprocess.CalledProcessError as e:
+        raise RuntimeError(e.stderr.decode(errors='replace').strip() or f"ffmpeg exited with {e.returncode}")
+
+    # loudnorm logs its measurements as the last JSON object on stderr
+    output = process.stderr.decode(errors='replace')
+    measured = json.loads(output[output.rindex('{'):output.rindex('}') + 1])
+    loudness = float(measured['input_i'])
+    true_peak = float(measured['input_tp'])
+
+    return {
+        'integrated': loudness,
+        'true_peak': true_peak,
+        'range': float(measured['input_lra']),
+        'gain': loudness_gain(loudness, true_peak, target, max_peak),
+        'seconds': round(time.perf_counter() - started, 3),
+    }
+
+class MediaProcessPool:
+    """
+    Worker processes for ffmpeg jobs, started on first use
+
+    Jobs get their own interpreters, so they neither hold the bot's GIL
+    nor take download worker threads, and at most `workers` of them run
+    at once. Shard workers are daemon processes, which cannot have
+    children, so there the jobs run on threads instead.
+    """
+
+    def __init__(self, workers: Optional[int] = None):
+        """
+        Initialize media process pool
+
+        Args:
+            workers: Number of worker processes (defaults to MEDIA_WORKERS)
+        """
+        self.workers = max(1, Config.MEDIA_WORKERS if workers is None else workers)
+        self._executor: Optional[Executor] = None
+
+    async def run(self, func: Callable[..., Any], *args) -> Any:
+        """
+        Run a module-level function in a worker process
+
+        Args:
+            func: Picklable function
+            *args: Picklable arguments
+
+        Returns:
+            Result of func
+        """
+        if self._executor is None:
+            if multiprocessing.current_process().daemon:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="media")
+            else:
+                # Forking a process with running threads can deadlock the child
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context('spawn')
+                )
+            logging.info(f"Started media pool ({self.workers} workers)")
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def shutdown(self):
+        """Stop the worker processes, dropping jobs that have not started"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
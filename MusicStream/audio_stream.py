@@ -0,0 +1,294 @@
+"""
+Progressive audio streaming through ffmpeg into a growing cache file
+"""
+
+import asyncio
+import logging
+import os
+from typing import BinaryIO, Callable, Dict, Hashable, Optional
+
+from config import Config
+
+# Encoder and muxer for each output format that can be written to a pipe
+STREAM_FORMATS = {
+    'mp3': ('libmp3lame', 'mp3'),
+    'opus': ('libopus', 'opus'),
+    'ogg': ('libvorbis', 'ogg'),
+}
+
+CHUNK_SIZE = 64 * 1024
+
+# Bytes of ffmpeg's error output kept for the failure log
+STDERR_TAIL = 4096
+
+def parse_bitrate(bitrate: str) -> int:
+    """
+    Convert a bitrate like '128k' into bytes per second
+
+    Args:
+        bitrate: Bitrate string as used by ffmpeg
+
+    Returns:
+        Bytes per second
+    """
+    value = bitrate.strip().lower()
+    multiplier = 1000 if value.endswith('k') else 1
+    return int(float(value.rstrip('k')) * multiplier) // 8
+
+class ProgressiveStream:
+    """Remote audio piped through ffmpeg into a file that grows while it plays"""
+
+    def __init__(self, video_id: str, source_url: str, final_path: str,
+                 duration: float = 0, http_headers: Optional[Dict[str, str]] = None,
+                 min_buffer: Optional[int] = None, max_ahead: Optional[int] = None):
+        """
+        Initialize progressive stream
+
+        Args:
+            video_id: YouTube video ID
+            source_url: Direct URL of the remote audio
+            final_path: Cache path the file is moved to once complete
+            duration: Track duration in seconds, if known
+            http_headers: HTTP headers required by the source URL
+            min_buffer: Bytes needed before playback may start (defaults to STREAM_MIN_BUFFER)
+            max_ahead: Bytes written ahead of the fastest listener (defaults to STREAM_MAX_AHEAD)
+        """
+        self.video_id = video_id
+        self.source_url = source_url
+        self.final_path = final_path
+        self.part_path = final_path + ".part"
+        self.duration = duration
+        self.http_headers = http_headers or {}
+        self.min_buffer = Config.STREAM_MIN_BUFFER if min_buffer is None else min_buffer
+        self.max_ahead = Config.STREAM_MAX_AHEAD if max_ahead is None else max_ahead
+        self.byte_rate = parse_bitrate(Config.AUDIO_BITRATE)
+
+        self.bytes_written = 0
+        self.failed = False
+        self.listened = False
+        # Handed out for playback and let go of, see release()
+        self.released = False
+        self.ready = asyncio.Event()
+        self.complete = asyncio.Event()
+
+        # Listener key -> function returning the playback position in seconds
+        self._clocks: Dict[Hashable, Callable[[], float]] = {}
+        self._data_written = asyncio.Event()
+
+        self.process: Optional[asyncio.subprocess.Process] = None
+        self.task: Optional[asyncio.Task] = None
+        # Drains ffmpeg's stderr so a chatty ffmpeg never blocks on the pipe
+        self._stderr_task: Optional[asyncio.Task] = None
+        self._stderr_tail = b''
+
+    @property
+    def codec(self) -> str:
+        """Codec of the streamed file"""
+        return Config.AUDIO_FORMAT
+
+    async def start(self) -> bool:
+        """
+        Start ffmpeg and the task copying its output to disk
+
+        Returns:
+            True if ffmpeg started, False otherwise
+        """
+        encoder, muxer = STREAM_FORMATS[Config.AUDIO_FORMAT]
+
+        command = [Config.FFMPEG_PATH, '-nostdin', '-loglevel', 'error',
+                   '-reconnect', '1', '-reconnect_streamed', '1', '-reconnect_delay_max', '5']
+        if self.http_headers:
+            command += ['-headers', ''.join(f"{key}: {value}\r\n" for key, value in self.http_headers.items())]
+        command += ['-i', self.source_url, '-vn', '-acodec', encoder,
+                    '-b:a', Config.AUDIO_BITRATE, '-f', muxer, 'pipe:1']
+
+        try:
+            self.process = await asyncio.create_subprocess_exec(
+                *command,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+            )
+        except Exception as e:
+            logging.error(f"Could not start ffmpeg for streaming: {e}")
+            self._fail()
+            return False
+
+        self._stderr_task = asyncio.create_task(self._drain_stderr())
+        self.task = asyncio.create_task(self._pump())
+        return True
+
+    async def wait_ready(self, timeout: Optional[float] = None) -> bool:
+        """
+        Wait until enough audio is buffered to start playback
+
+        Args:
+            timeout: Seconds to wait (defaults to STREAM_START_TIMEOUT)
+
+        Returns:
+            True if playback can start, False if the stream failed or timed out
+        """
+        timeout = Config.STREAM_START_TIMEOUT if timeout is None else timeout
+        try:
+            await asyncio.wait_for(self.ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"Stream for {self.video_id} did not buffer within {timeout}s")
+            return False
+        return not self.failed
+
+    async def wait_complete(self) -> Optional[str]:
+        """
+        Wait for the whole track to be written
+
+        Returns:
+            Path of the completed file or None if the stream failed
+        """
+        await self.complete.wait()
+        return None if self.failed else self.final_path
+
+    async def read(self, position: int, size: int = CHUNK_SIZE) -> bytes:
+        """
+        Read buffered audio, waiting for the writer when it is not there yet
+
+        Args:
+            position: Byte offset in the stream
+            size: Maximum number of bytes to read
+
+        Returns:
+            Audio bytes, empty once the end of the stream is reached
+        """
+        while position >= self.bytes_written and not self.complete.is_set():
+            self._data_written.clear()
+            await self._data_written.wait()
+
+        path = self.final_path if (self.complete.is_set() and not self.failed) else self.part_path
+        try:
+            with open(path, 'rb') as f:
+                f.seek(position)
+                return f.read(min(size, max(0, self.bytes_written - position)))
+        except FileNotFoundError:
+            return b''
+
+    def attach_clock(self, key: Hashable, position: Callable[[], float]):
+        """
+        Register a listener whose playback position throttles the writer
+
+        Args:
+            key: Listener key, e.g. a chat ID
+            position: Function returning the listener's playback position in seconds
+        """
+        self._clocks[key] = position
+        self.listened = True
+
+    def detach_clock(self, key: Hashable):
+        """Remove a listener, the rest of the track is then written unthrottled"""
+        self._clocks.pop(key, None)
+
+    def release(self):
+        """
+        Let go of a stream that was handed out for playback
+
+        Listeners that attached a clock keep throttling the writer. Without
+        any, the rest of the track is written unthrottled for the cache
+        instead of waiting for a listener that is not coming.
+        """
+        self.released = True
+
+    async def cancel(self):
+        """Stop ffmpeg and drop the partial file"""
+        if self.process is not None and self.process.returncode is None:
+            self.process.kill()
+        tasks = [task for task in (self.task, self._stderr_task) if task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self.process is not None:
+            # Reap the killed ffmpeg, reading what is left in its pipes so
+            # they close on this loop
+            await self.process.communicate()
+        self._fail()
+
+    async def _pump(self):
+        """Copy ffmpeg output into the part file with backpressure"""
+        try:
+            with open(self.part_path, 'wb') as f:
+                while True:
+                    await self._wait_for_room()
+
+                    chunk = await self.process.stdout.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+
+                    # Disk writes can stall, keep them off the event loop
+                    await asyncio.to_thread(self._write, f, chunk)
+                    self.bytes_written += len(chunk)
+                    self._data_written.set()
+
+                    if not self.ready.is_set() and self.bytes_written >= self.min_buffer:
+                        self.ready.set()
+
+            return_code = await self.process.wait()
+            await self._stderr_task
+            if return_code != 0 or self.bytes_written == 0:
+                stderr = self._stderr_tail.decode(errors='replace').strip()
+                logging.error(f"ffmpeg stream failed for {self.video_id}: {stderr}")
+                self._fail()
+                return
+
+            os.replace(self.part_path, self.final_path)
+            self.ready.set()
+            self.complete.set()
+            self._data_written.set()
+            logging.info(f"Stream completed: {self.final_path} ({self.bytes_written} bytes)")
+
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Error streaming {self.video_id}: {e}")
+            self._fail()
+
+    @staticmethod
+    def _write(f: BinaryIO, chunk: bytes):
+        """Append a chunk to the part file so readers see it, runs on a worker thread"""
+        f.write(chunk)
+        f.flush()
+
+    async def _drain_stderr(self):
+        """Read ffmpeg's stderr as it comes, keeping the end of it"""
+        while True:
+            chunk = await self.process.stderr.read(STDERR_TAIL)
+            if not chunk:
+                return
+            self._stderr_tail = (self._stderr_tail + chunk)[-STDERR_TAIL:]
+
+    async def _wait_for_room(self):
+        """Pause the writer while it is too far ahead of every listener"""
+        while True:
+            if self._clocks:
+                played = max(clock() for clock in self._clocks.values())
+            elif self.listened or self.released:
+                # Everyone stopped listening, or nobody will, finish the
+                # file for the cache
+                return
+            else:
+                played = 0.0
+
+            limit = self.min_buffer + self.max_ahead + int(played * self.byte_rate)
+            excess = self.bytes_written - limit
+            if excess < 0:
+                return
+
+            # ffmpeg blocks on the full pipe meanwhile, which throttles the download
+            await asyncio.sleep(min(1.0, max(0.05, excess / max(1, self.byte_rate))))
+
+    def _fail(self):
+        """Mark the stream as failed and wake everyone waiting on it"""
+        self.failed = True
+        try:
+            os.remove(self.part_path)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logging.error(f"Error removing partial stream file: {e}")
+        self.ready.set()
+        self.complete.set()
+        self._data_written.set()
@@ -0,0 +1,442 @@
+"""
+Offline load test driving MusicBot's command handlers with synthetic updates
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import wave
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional, Tuple
+
+from telegram import Update
+from telegram.request import BaseRequest, RequestData
+
+from config import Config
+from youtube_downloader import YouTubeDownloader
+from webhook_server import LocalUpdateSender
+
+class FakeTelegramRequest(BaseRequest):
+    """Bot API transport answering every call locally and recording it"""
+
+    BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'LoadTest', 'username': 'load_test_bot'}
+
+    def __init__(self, latency: float = 0.0):
+        """
+        Initialize fake Telegram API
+
+        Args:
+            latency: Seconds every call takes
+        """
+        self.latency = latency
+        self.calls: Counter = Counter()
+        self._message_ids = defaultdict(lambda: 1000)
+
+        # (chat_id, message_id) -> time a bot message was sent, and the
+        # delays until bot messages were first edited
+        self._sent_at: Dict[Tuple[int, int], float] = {}
+        self.edit_delays: List[float] = []
+
+    @property
+    def read_timeout(self) -> Optional[float]:
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url: str, method: str, request_data: Optional[RequestData] = None,
+                         read_timeout=None, write_timeout=None, connect_timeout=None,
+                         pool_timeout=None) -> Tuple[int, bytes]:
+        """Answer a Bot API call"""
+        endpoint = url.rsplit('/', 1)[-1]
+        params = request_data.parameters if request_data else {}
+        self.calls[endpoint] += 1
+
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        result = self._result(endpoint, params)
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+    def _result(self, endpoint: str, params: Dict):
+        """Build the result Telegram would return"""
+        if endpoint == 'getMe':
+            return self.BOT_USER
+
+        if endpoint not in ('sendMessage', 'editMessageText'):
+            return True
+
+        chat_id = int(params.get('chat_id', 0))
+        if endpoint == 'sendMessage':
+            self._message_ids[chat_id] += 1
+            message_id = self._message_ids[chat_id]
+            self._sent_at[(chat_id, message_id)] = time.perf_counter()
+        else:
+            message_id = int(params.get('message_id', 0))
+            sent_at = self._sent_at.pop((chat_id, message_id), None)
+            if sent_at is not None:
+                self.edit_delays.append(time.perf_counter() - sent_at)
+
+        return {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'group', 'title': f"Chat {chat_id}"},
+            'from': self.BOT_USER,
+            'text': params.get('text', ''),
+        }
+
+class FakeDownloader(YouTubeDownloader):
+    """YouTubeDownloader serving a local file with simulated latency"""
+
+    def __init__(self, source_path: str, search_latency: float = 0.05,
+                 download_latency: float = 0.2, track_duration: float = 5.0):
+        """
+        Initialize fake downloader
+
+        Args:
+            source_path: Audio file copied into the cache for every video
+            search_latency: Seconds a search takes, awaited on the event loop
+            download_latency: Seconds a download blocks its worker thread
+            track_duration: Duration reported for every video
+        """
+        super().__init__()
+        # Take the regular cached, deduplicated and scheduled paths
+        self.ydl_available = True
+        self.source_path = source_path
+        self.search_latency = search_latency
+        self.download_latency = download_latency
+        self.track_duration = track_duration
+
+    async def _search_youtube(self, query: str, max_results: int, cache_key: str) -> Optional[Dict]:
+        """Answer a search after the configured latency"""
+        await asyncio.sleep(self.search_latency)
+        video_id = hashlib.blake2b(query.encode(), digest_size=6).hexdigest()
+        video_info = {
+            'id': video_id,
+            'title': f"Fake: {query}",
+            'url': f"https://www.youtube.com/watch?v={video_id}",
+            'duration': self.track_duration,
+            'uploader': 'Load Test',
+        }
+        self.search_cache.put(cache_key, video_info)
+        return video_info
+
+    async def stream_audio(self, video_info: Dict, chat_id: int = 0):
+        """Streaming needs ffmpeg, always fall back to downloads"""
+        return None
+
+    async def _download_audio(self, video_info: Dict, video_id: str, chat_id: int, priority: int) -> Optional[str]:
+        """Copy the source file into the cache on a download worker"""
+        ext = os.path.splitext(self.source_path)[1].lstrip('.')
+        file_path = self.cache.path_for(video_id, ext)
+
+        def download():
+            time.sleep(self.download_latency)
+            shutil.copyfile(self.source_path, file_path)
+
+        await self.scheduler.run(download, chat_id=chat_id, priority=priority, key=f"download:{video_id}")
+        return self.cache.put(video_id, file_path, duration=self.track_duration, codec=ext)
+
+    async def prewarm(self):
+        pass
+
+def write_silence(path: str, seconds: float = 1.0):
+    """Write a mono 8 kHz WAV file of silence"""
+    with wave.open(path, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(8000)
+        wav.writeframes(b'\0\0' * int(8000 * seconds))
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    """Summarize latencies in milliseconds using nearest-rank percentiles"""
+    if not samples:
+        return {'count': 0}
+
+    ordered = sorted(samples)
+
+    def rank(p: float) -> float:
+        index = max(0, min(len(ordered) - 1, int(round(p / 100 * len(ordered))) - 1))
+        return round(ordered[index] * 1000, 3)
+
+    return {
+        'count': len(ordered),
+        'p50_ms': rank(50),
+        'p95_ms': rank(95),
+        'p99_ms': rank(99),
+        'max_ms': round(ordered[-1] * 1000, 3),
+    }
+
+def rss_bytes() -> int:
+    """Resident set size of this process, 0 where it cannot be read"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return 0
+
+def git_revision() -> Optional[str]:
+    """Commit of the tree under test"""
+    try:
+        result = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                                text=True, timeout=5, cwd=os.path.dirname(os.path.abspath(__file__)))
+        return result.stdout.strip() or None
+    except Exception:
+        return None
+
+class LoadTest:
+    """Runs a scripted command mix across many fake chats against one MusicBot"""
+
+    def __init__(self, chats: int = 1000, plays: int = 3, concurrency: int = 200,
+                 catalog: int = 100, think_time: float = 0.0, seed: int = 1,
+                 search_latency: float = 0.05, download_latency: float = 0.2,
+                 telegram_latency: float = 0.0, track_duration: float = 5.0,
+                 drain_timeout: float = 30.0, source_path: Optional[str] = None,
+                 rate_limit: bool = False):
+        """
+        Initialize load test
+
+        Args:
+            chats: Number of fake group chats
+            plays: /play commands per chat, followed by /queue, /skip and /queue
+            concurrency: Chats sending commands at the same time
+            catalog: Number of distinct songs requested across all chats
+            think_time: Seconds between the commands of one chat
+            seed: Random seed of the song choice
+            search_latency: Seconds a fake search takes
+            download_latency: Seconds a fake download takes
+            telegram_latency: Seconds a fake Bot API call takes
+            track_duration: Duration of every fake track
+            drain_timeout: Seconds to wait for background work after the last command
+            source_path: Audio file served for every video (defaults to generated silence)
+            rate_limit: Apply /play admission control, off so raw handler capacity is measured
+        """
+        self.chats = chats
+        self.plays = plays
+        self.concurrency = concurrency
+        self.catalog = max(1, catalog)
+        self.think_time = think_time
+        self.seed = seed
+        self.search_latency = search_latency
+        self.download_latency = download_latency
+        self.telegram_latency = telegram_latency
+        self.track_duration = track_duration
+        self.drain_timeout = drain_timeout
+        self.source_path = source_path
+        self.rate_limit = rate_limit
+
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors = 0
+        self.peak_threads = threading.active_count()
+
+    def script(self, rng: random.Random) -> List[str]:
+        """Commands one chat sends, in order"""
+        songs = [f"/play song {rng.randrange(self.catalog)}" for _ in range(self.plays)]
+        return songs + ['/queue', '/skip', '/queue']
+
+    async def run(self) -> Dict:
+        """Run the load test in a scratch directory and return the results"""
+        with tempfile.TemporaryDirectory(prefix='musicstream-load-') as workdir:
+            # Every file the bot writes stays in the scratch directory
+            Config.DOWNLOAD_DIR = os.path.join(workdir, 'downloads')
+            Config.STATE_DIR = os.path.join(workdir, 'state')
+            Config.BOT_TOKEN = Config.BOT_TOKEN or '1:load-test'
+            Config.WEBHOOK_ENABLED = False
+            Config.MAX_QUEUE_SIZE = max(Config.MAX_QUEUE_SIZE, self.plays)
+            Config.RATE_LIMIT_ENABLED = self.rate_limit
+            # Background analysis of cached tracks is not on the command path
+            Config.LOUDNESS_ANALYSIS = False
+            os.makedirs(Config.DOWNLOAD_DIR, exist_ok=True)
+
+            source_path = self.source_path
+            if source_path is None:
+                source_path = os.path.join(workdir, 'silence.wav')
+                write_silence(source_path)
+
+            return await self._run(source_path)
+
+    async def _run(self, source_path: str) -> Dict:
+        """Start the bot on the fake transport, drive it and shut it down"""
+        from admission import ADMISSIONS
+        from bot import MusicBot
+
+        telegram = FakeTelegramRequest(self.telegram_latency)
+        downloader = FakeDownloader(source_path, self.search_latency, self.download_latency, self.track_duration)
+        bot = MusicBot(youtube_downloader=downloader, request=telegram)
+        application = bot.application
+
+        async def count_error(update: object, context):
+            self.errors += 1
+            logging.debug(f"Handler error: {context.error}")
+
+        application.add_error_handler(count_error)
+
+        rss_before = rss_bytes()
+        await application.initialize()
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+
+        sampler = asyncio.create_task(self._sample_threads())
+        sender = LocalUpdateSender()
+        semaphore = asyncio.Semaphore(max(1, self.concurrency))
+        rng = random.Random(self.seed)
+        scripts = [self.script(rng) for _ in range(self.chats)]
+
+        async def drive(index: int, commands: List[str]):
+            chat_id = -1000000 - index
+            async with semaphore:
+                for text in commands:
+                    update = Update.de_json(sender.command_update(chat_id, text), application.bot)
+                    started = time.perf_counter()
+                    await application.process_update(update)
+                    self.latencies[text.split(' ', 1)[0]].append(time.perf_counter() - started)
+                    if self.think_time:
+                        await asyncio.sleep(self.think_time)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(drive(index, commands) for index, commands in enumerate(scripts)))
+        elapsed = time.perf_counter() - started
+
+        # Let searches and downloads started by the commands finish
+        drained = await self._drain(bot)
+        rss_after = rss_bytes()
+        downloads = self._download_stats(downloader)
+
+        sampler.cancel()
+        await application.stop()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+        await application.shutdown()
+        # Downloads still running would write into the scratch directory
+        await asyncio.get_running_loop().run_in_executor(None, downloader.scheduler.executor.shutdown, True)
+
+        total = sum(len(samples) for samples in self.latencies.values())
+        return {
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'parameters': {
+                'chats': self.chats,
+                'plays': self.plays,
+                'concurrency': self.concurrency,
+                'catalog': self.catalog,
+                'think_time': self.think_time,
+                'seed': self.seed,
+                'search_latency': self.search_latency,
+                'download_latency': self.download_latency,
+                'telegram_latency': self.telegram_latency,
+                'track_duration': self.track_duration,
+                'download_workers': Config.DOWNLOAD_WORKERS,
+                'search_workers': Config.SEARCH_WORKERS,
+                'queue_persistence': Config.QUEUE_PERSISTENCE,
+                'rate_limit': self.rate_limit,
+            },
+            'commands': {command: percentiles(samples) for command, samples in sorted(self.latencies.items())},
+            # Time from the "Searching" reply until it was edited with the outcome
+            'play_resolution': percentiles(telegram.edit_delays),
+            'total_commands': total,
+            'elapsed_s': round(elapsed, 3),
+            'throughput_per_s': round(total / elapsed, 1) if elapsed else 0.0,
+            'drained': drained,
+            'errors': self.errors,
+            'memory_per_chat_bytes': (rss_after - rss_before) // max(1, self.chats) if rss_before else None,
+            'rss_bytes': rss_after or None,
+            'threads_peak': self.peak_threads,
+            'telegram_calls': dict(telegram.calls),
+            'downloads': downloads,
+            'admissions': {'/'.join(filter(None, key)): int(count) for key, count in sorted(ADMISSIONS.totals().items())},
+        }
+
+    @staticmethod
+    def _download_stats(downloader: FakeDownloader) -> Dict:
+        """Summarize how long downloads waited for a worker"""
+        waits = list(downloader.scheduler.wait_stats.values())
+        jobs = sum(stats['jobs'] for stats in waits)
+        return {
+            'jobs': jobs,
+            'pending': downloader.scheduler.stats()['pending'],
+            'avg_wait_ms': round(sum(stats['total_wait'] for stats in waits) / jobs * 1000, 3) if jobs else 0.0,
+            'max_wait_ms': round(max((stats['max_wait'] for stats in waits), default=0.0) * 1000, 3),
+        }
+
+    async def _drain(self, bot) -> bool:
+        """Wait for the bot's background tasks, False if they did not finish in time"""
+        deadline = time.monotonic() + self.drain_timeout
+        while bot._background_tasks:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            await asyncio.wait(list(bot._background_tasks), timeout=remaining)
+        return True
+
+    async def _sample_threads(self):
+        """Track the peak number of threads while the test runs"""
+        while True:
+            self.peak_threads = max(self.peak_threads, threading.active_count())
+            await asyncio.sleep(0.05)
+
+def main():
+    """Run a load test and print or save the results as JSON"""
+    parser = argparse.ArgumentParser(description="Offline load test of the bot's command handlers")
+    parser.add_argument('--chats', type=int, default=1000, help="Number of fake chats")
+    parser.add_argument('--plays', type=int, default=3, help="/play commands per chat")
+    parser.add_argument('--concurrency', type=int, default=200, help="Chats sending commands at the same time")
+    parser.add_argument('--catalog', type=int, default=100, help="Distinct songs across all chats")
+    parser.add_argument('--think-time', type=float, default=0.0, help="Seconds between commands of a chat")
+    parser.add_argument('--seed', type=int, default=1, help="Random seed")
+    parser.add_argument('--search-latency', type=float, default=0.05, help="Seconds per fake search")
+    parser.add_argument('--download-latency', type=float, default=0.2, help="Seconds per fake download")
+    parser.add_argument('--telegram-latency', type=float, default=0.0, help="Seconds per fake Bot API call")
+    parser.add_argument('--track-duration', type=float, default=5.0, help="Seconds per fake track")
+    parser.add_argument('--drain-timeout', type=float, default=30.0, help="Seconds to wait for background work")
+    parser.add_argument('--source', default=None, help="Audio file served for every video")
+    parser.add_argument('--rate-limit', action='store_true', help="Apply /play admission control")
+    parser.add_argument('--output', default=None, help="Write results to this file instead of stdout")
+    parser.add_argument('--verbose', action='store_true', help="Show the bot's logs")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO if args.verbose else logging.ERROR
+    )
+
+    load_test = LoadTest(
+        chats=args.chats,
+        plays=args.plays,
+        concurrency=args.concurrency,
+        catalog=args.catalog,
+        think_time=args.think_time,
+        seed=args.seed,
+        search_latency=args.search_latency,
+        download_latency=args.download_latency,
+        telegram_latency=args.telegram_latency,
+        track_duration=args.track_duration,
+        drain_timeout=args.drain_timeout,
+        source_path=args.source,
+        rate_limit=args.rate_limit,
+    )
+    results = asyncio.run(load_test.run())
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
@@ -5,43 +5,137 @@ Main bot class with command handlers using python-telegram-bot
 import asyncio
 import logging
 import os
-from typing import Dict, Optional
+import time
+from typing import Dict, List, Optional, Set, Tuple
 
 from telegram import Update
-from telegram.ext import Application, CommandHandler, ContextTypes
+from telegram.ext import Application, CommandHandler, ContextTypes, TypeHandler
+from telegram.request import BaseRequest
 
+import tracing
+from admission import Admission, AdmissionController
+from audio_stream import ProgressiveStream
+from chat_actor import ActorRegistry
 from config import Config
-from music_player import MusicPlayer
+from music_player import MusicPlayer, TelegramVoiceChatPlayer
+from prefetcher import Prefetcher
 from youtube_downloader import YouTubeDownloader
 from queue_manager import QueueManager
+from queue_store import QueueJournal
+from song_queue import Song
+from startup_timing import startup_timer
+from storage_manager import StorageManager
+from telegram_request import TimedRequest
+from webhook_server import WebhookServer, run_webhook
 
 class MusicBot:
     """Main Telegram Music Bot class"""
     
-    def __init__(self):
-        """Initialize the bot"""
+    def __init__(self, youtube_downloader: Optional[YouTubeDownloader] = None,
+                 music_player: Optional[MusicPlayer] = None,
+                 queue_manager: Optional[QueueManager] = None,
+                 request: Optional[BaseRequest] = None):
+        """
+        Initialize the bot
+        
+        Components not given are built on first use, so updates are
+        taken as soon as possible after a restart.
+        
+        Args:
+            youtube_downloader: Downloader to use instead of building one
+            music_player: Player to use instead of building one
+            queue_manager: Queue manager to use instead of building one
+            request: Bot API transport to use instead of timed HTTPS, e.g. an offline stand-in
+        """
         # Validate configuration
         Config.validate()
         
         # Initialize application
-        self.application = Application.builder().token(Config.BOT_TOKEN).build()
+        self.application = (
+            Application.builder()
+            .token(Config.BOT_TOKEN)
+            # Same connection pool size as the builder's default transport
+            .request(request or TimedRequest(connection_pool_size=256))
+            .post_init(self._post_init)
+            .post_shutdown(self._post_shutdown)
+            # Handlers only await Telegram API calls, searches and downloads
+            # run in background tasks, so chats never wait on each other
+            .concurrent_updates(True)
+            .build()
+        )
+        
+        # Components, built lazily by the properties below
+        self._youtube_downloader = youtube_downloader
+        self._music_player = music_player
+        self._queue_manager = queue_manager
+        self._prefetcher: Optional[Prefetcher] = None
+        self._storage: Optional[StorageManager] = None
+        
+        if music_player is not None:
+            music_player.on_track_finished = self._on_track_finished
         
-        # Initialize components
-        self.music_player = MusicPlayer()
-        self.youtube_downloader = YouTubeDownloader()
-        self.queue_manager = QueueManager()
+        # Commands and playback events of a chat run one at a time
+        self.actors = ActorRegistry()
+        
+        # Rate limits /play before any search or download starts
+        self.admission = AdmissionController(self._download_saturation)
         
         # Track active voice chats
         self.active_chats: Dict[int, bool] = {}
         
+        # Keep references to fire-and-forget tasks
+        self._background_tasks = set()
+        
+        # Serves /metrics on METRICS_PORT
+        self._metrics_server: Optional[WebhookServer] = None
+        
         # Setup handlers
         self._setup_handlers()
         
         # Create download directory
         os.makedirs(Config.DOWNLOAD_DIR, exist_ok=True)
         
+        startup_timer.mark("init")
         logging.info("Music bot initialized successfully")
     
+    @property
+    def youtube_downloader(self) -> YouTubeDownloader:
+        """YouTube downloader, built on first use"""
+        if self._youtube_downloader is None:
+            self._youtube_downloader = YouTubeDownloader()
+        return self._youtube_downloader
+    
+    @property
+    def music_player(self) -> MusicPlayer:
+        """Music player, built on first use"""
+        if self._music_player is None:
+            player_class = TelegramVoiceChatPlayer if Config.OPUS_FRAMES else MusicPlayer
+            self._music_player = player_class(self.youtube_downloader.cache)
+            # Advance the queue when a track ends
+            self._music_player.on_track_finished = self._on_track_finished
+        return self._music_player
+    
+    @property
+    def queue_manager(self) -> QueueManager:
+        """Queue manager, built on first use, replaying the queue journal"""
+        if self._queue_manager is None:
+            self._queue_manager = QueueManager(QueueJournal() if Config.QUEUE_PERSISTENCE else None)
+        return self._queue_manager
+    
+    @property
+    def prefetcher(self) -> Prefetcher:
+        """Prefetcher, built on first use"""
+        if self._prefetcher is None:
+            self._prefetcher = Prefetcher(self.youtube_downloader, self.queue_manager, self.music_player)
+        return self._prefetcher
+    
+    @property
+    def storage(self) -> StorageManager:
+        """Storage manager of the download directory, built on first use"""
+        if self._storage is None:
+            self._storage = StorageManager(self.youtube_downloader.cache, self.queue_manager)
+        return self._storage
+    
     def _setup_handlers(self):
         """Setup command handlers"""
         
@@ -51,6 +145,7 @@ class MusicBot:
                 "🎵 **Welcome to the Music Bot!** 🎵\n\n"
                 "**Available Commands:**\n"
                 "• `/play <song_name>` - Search and play music from YouTube\n"
+                "• `/playlist <url>` - Queue the songs of a YouTube playlist\n"
                 "• `/pause` - Pause the current song\n"
                 "• `/resume` - Resume playback\n"
                 "• `/stop` - Stop music and leave voice chat\n"
@@ -77,39 +172,70 @@ class MusicBot:
                 
                 song_name = " ".join(context.args)
                 
-                # Send searching message
-                search_msg = await update.message.reply_text(f"🔍 Searching for: **{song_name}**...", parse_mode='Markdown')
+                user = update.effective_user
+                admission = self.admission.admit(chat_id, user.id if user else None)
+                if not admission.admitted:
+                    await update.message.reply_text(self._rejection_text(admission))
+                    return
                 
-                # Search and download from YouTube
-                result = await self.youtube_downloader.search_and_download(song_name)
+                # Sampled requests are traced until _resolve_song finishes
+                trace = tracing.tracer.start_trace('play', chat_id=chat_id, query=song_name)
+                with tracing.use(trace):
+                    # Send searching message
+                    searching_text = f"🔍 Searching for: **{song_name}**..."
+                    if admission.delay:
+                        tracing.annotate(deferred=round(admission.delay, 3), limit=admission.reason)
+                        searching_text += f"\n⏳ Busy, starting in {admission.delay:.0f}s"
+                    with tracing.span('reply'):
+                        search_msg = await update.message.reply_text(searching_text, parse_mode='Markdown')
+                    
+                    # Queue a placeholder right away and resolve it in the background
+                    song = Song(title=song_name, url='', query=song_name, pending=True)
+                    queue_position = self.queue_manager.add_to_queue(chat_id, song)
+                    
+                    if queue_position == -1:
+                        tracing.finish(error="queue full")
+                        await search_msg.edit_text(f"❌ Queue is full! (max {Config.MAX_QUEUE_SIZE} songs)")
+                        return
+                    
+                    self._spawn(self._resolve_song(chat_id, song, search_msg, admission.delay))
                 
-                if not result:
-                    await search_msg.edit_text("❌ No results found for your search!")
+            except Exception as e:
+                logging.error(f"Error in play command: {e}")
+                await update.message.reply_text("❌ An error occurred while processing your request!")
+        
+        async def playlist_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+            """Handle /playlist command"""
+            chat_id = update.effective_chat.id
+            
+            try:
+                if not context.args:
+                    await update.message.reply_text("❌ Please provide a playlist link!\nUsage: `/playlist <url>`")
                     return
                 
-                # Add to queue
-                queue_position = self.queue_manager.add_to_queue(chat_id, result)
+                url = context.args[0]
                 
-                if queue_position == 1:
-                    # Start playing immediately
-                    await search_msg.edit_text(f"🎵 **Now Playing:** {result['title']}", parse_mode='Markdown')
-                    success = await self.music_player.play_audio(chat_id, result['file_path'])
-                    
-                    if not success:
-                        await update.message.reply_text("❌ Failed to join voice chat! Make sure the bot has permission to join voice chats.")
-                        self.queue_manager.remove_from_queue(chat_id, result)
-                else:
-                    await search_msg.edit_text(f"✅ **Added to queue (#{queue_position}):** {result['title']}", parse_mode='Markdown')
+                user = update.effective_user
+                admission = self.admission.admit(chat_id, user.id if user else None)
+                if not admission.admitted:
+                    await update.message.reply_text(self._rejection_text(admission))
+                    return
+                
+                trace = tracing.tracer.start_trace('playlist', chat_id=chat_id, url=url)
+                with tracing.use(trace):
+                    with tracing.span('reply'):
+                        loading_msg = await update.message.reply_text("📃 Loading playlist...")
+                    self._spawn(self._load_playlist(chat_id, url, loading_msg, admission.delay))
                 
             except Exception as e:
-                logging.error(f"Error in play command: {e}")
+                logging.error(f"Error in playlist command: {e}")
                 await update.message.reply_text("❌ An error occurred while processing your request!")
         
         async def pause_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             """Handle /pause command"""
             chat_id = update.effective_chat.id
             
-            if await self.music_player.pause_audio(chat_id):
+            if await self.actors.call(chat_id, self.music_player.pause_audio, chat_id):
                 await update.message.reply_text("⏸️ **Paused** the current song", parse_mode='Markdown')
             else:
                 await update.message.reply_text("❌ No active playback to pause!")
@@ -118,7 +244,7 @@ class MusicBot:
             """Handle /resume command"""
             chat_id = update.effective_chat.id
             
-            if await self.music_player.resume_audio(chat_id):
+            if await self.actors.call(chat_id, self.music_player.resume_audio, chat_id):
                 await update.message.reply_text("▶️ **Resumed** playback", parse_mode='Markdown')
             else:
                 await update.message.reply_text("❌ No paused playback to resume!")
@@ -127,11 +253,8 @@ class MusicBot:
             """Handle /stop command"""
             chat_id = update.effective_chat.id
             
-            # Stop music and leave voice chat
-            await self.music_player.stop_audio(chat_id)
-            
-            # Clear queue
-            self.queue_manager.clear_queue(chat_id)
+            # Stop music, leave voice chat and clear the queue
+            await self.actors.call(chat_id, self._stop, chat_id)
             
             await update.message.reply_text("🛑 **Stopped** music and left voice chat", parse_mode='Markdown')
         
@@ -139,27 +262,22 @@ class MusicBot:
             """Handle /skip command"""
             chat_id = update.effective_chat.id
             
-            current_song = self.queue_manager.get_current_song(chat_id)
-            if not current_song:
-                await update.message.reply_text("❌ No song is currently playing!")
-                return
-            
-            # Remove current song and get next
-            self.queue_manager.remove_from_queue(chat_id, current_song)
-            next_song = self.queue_manager.get_current_song(chat_id)
+            skipped_song, next_song = await self.actors.call(chat_id, self._skip, chat_id)
             
-            if next_song:
-                await update.message.reply_text(f"⏭️ **Skipped!** Now playing: {next_song['title']}", parse_mode='Markdown')
-                await self.music_player.play_audio(chat_id, next_song['file_path'])
+            if not skipped_song:
+                await update.message.reply_text("❌ No song is currently playing!")
+            elif next_song and next_song.pending:
+                await update.message.reply_text(f"⏭️ **Skipped!** Up next: {next_song.title} (still searching)", parse_mode='Markdown')
+            elif next_song:
+                await update.message.reply_text(f"⏭️ **Skipped!** Now playing: {next_song.title}", parse_mode='Markdown')
             else:
-                await self.music_player.stop_audio(chat_id)
                 await update.message.reply_text("⏭️ **Skipped!** No more songs in queue")
         
         async def queue_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             """Handle /queue command"""
             chat_id = update.effective_chat.id
             
-            queue_list = self.queue_manager.get_queue(chat_id)
+            queue_list = self.queue_manager.get_queue(chat_id, limit=10)
             
             if not queue_list:
                 await update.message.reply_text("📝 **Queue is empty!**", parse_mode='Markdown')
@@ -168,42 +286,534 @@ class MusicBot:
             queue_text = "📝 **Current Queue:**\n\n"
             for i, song in enumerate(queue_list, 1):
                 status = "🎵 " if i == 1 else f"{i}. "
-                queue_text += f"{status}**{song['title']}**\n"
+                queue_text += f"{status}**{song.title}**\n"
                 
                 if i >= 10:  # Limit display to 10 songs
-                    remaining = len(queue_list) - 10
+                    remaining = self.queue_manager.get_queue_size(chat_id) - 10
                     if remaining > 0:
                         queue_text += f"\n... and {remaining} more songs"
                     break
             
             await update.message.reply_text(queue_text, parse_mode='Markdown')
         
+        async def slowest_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+            """Handle /slowest command, lists the slowest recent traced requests"""
+            user = update.effective_user
+            if not Config.OWNER_ID or user is None or user.id != Config.OWNER_ID:
+                await update.message.reply_text("❌ This command is for the bot owner only!")
+                return
+            
+            count = int(context.args[0]) if context.args and context.args[0].isdigit() else 5
+            traces = tracing.tracer.slowest(min(count, 20))
+            
+            if not traces:
+                await update.message.reply_text(
+                    f"No traced requests yet (sampling {tracing.tracer.sample_rate:.0%} of requests)"
+                )
+                return
+            
+            lines = [f"Slowest of the last {len(tracing.tracer.recent)} traced requests:"]
+            for trace in traces:
+                query = trace.root.attributes.get('query', '')
+                error = f" [{trace.root.error}]" if trace.root.error else ""
+                lines.append(f"\n{trace.summary()}{error}\n  {query}")
+            
+            # Plain text, queries may contain Markdown characters
+            await update.message.reply_text("\n".join(lines))
+        
         # Add handlers to application
+        # Sees every update before the command handlers
+        self.application.add_handler(TypeHandler(Update, self._note_first_update), group=-1)
         self.application.add_handler(CommandHandler("start", start_command))
         self.application.add_handler(CommandHandler("help", help_command))
         self.application.add_handler(CommandHandler("play", play_command))
+        self.application.add_handler(CommandHandler("playlist", playlist_command))
         self.application.add_handler(CommandHandler("pause", pause_command))
         self.application.add_handler(CommandHandler("resume", resume_command))
         self.application.add_handler(CommandHandler("stop", stop_command))
         self.application.add_handler(CommandHandler("skip", skip_command))
         self.application.add_handler(CommandHandler("queue", queue_command))
+        self.application.add_handler(CommandHandler("slowest", slowest_command))
+    
+    async def _play_song(self, chat_id: int, song: Song) -> bool:
+        """
+        Fetch a queued song and start it if it is still at the head of the queue
+        
+        The prefetched file, a progressive stream or a fresh download is
+        fetched outside the chat's actor, in that order of preference, so
+        the chat's other commands do not wait behind a download. Only the
+        start itself runs on the actor. Must not be awaited on the actor.
+        
+        Args:
+            chat_id: Chat ID where to play
+            song: Queued song record
+            
+        Returns:
+            bool: True if playback started, False otherwise
+        """
+        if song.pending:
+            # Started by _resolve_song once the search finishes
+            logging.info(f"Waiting for search to resolve in chat {chat_id}: {song.title}")
+            return False
+        
+        stream = None
+        file_path = song.file_path
+        if not file_path:
+            # Start playing while the rest of the track downloads
+            with tracing.span('stream'):
+                stream = await self.youtube_downloader.stream_audio(song.to_info(), chat_id=chat_id)
+                tracing.annotate(started=stream is not None)
+        
+        if stream is None:
+            with tracing.span('download'):
+                file_path = await self.prefetcher.ensure_ready(chat_id, song)
+            
+            if not file_path:
+                logging.error(f"Could not fetch song for chat {chat_id}: {song.title}")
+                return False
+        
+        try:
+            with tracing.span('play', mode='file' if stream is None else 'stream'):
+                return await self.actors.call(chat_id, self._start_if_head, chat_id, song, file_path, stream)
+        finally:
+            if stream is not None:
+                # Unless our playback attached to it, the stream finishes
+                # for the cache instead of throttling forever
+                stream.release()
+    
+    async def _play_or_drop(self, chat_id: int, song: Song):
+        """
+        Play a song that became the head, dropping it if it cannot be played
+        
+        Dropping the entry starts the song after it, so a failed download
+        does not leave the chat silent. Must not be awaited on the actor.
+        
+        Args:
+            chat_id: Chat ID where to play
+            song: Queued song record
+        """
+        if not await self._play_song(chat_id, song):
+            await self.actors.call(chat_id, self._drop_failed_head, chat_id, song.entry_id)
+    
+    async def _drop_failed_head(self, chat_id: int, entry_id: int):
+        """Drop an entry that failed to start if it is still the idle head, runs on the chat's actor"""
+        head = self.queue_manager.get_current_song(chat_id)
+        if head is None or head.entry_id != entry_id or head.pending:
+            # Moved on while fetching, or started by its resolution job later
+            return
+        if self.music_player.current_tag(chat_id) == entry_id:
+            return
+        
+        logging.warning(f"Dropping unplayable song from chat {chat_id}: {head.title}")
+        await self._drop_entry(chat_id, entry_id)
+    
+    async def _start_if_head(self, chat_id: int, song: Song, file_path: Optional[str],
+                             stream: Optional[ProgressiveStream]) -> bool:
+        """
+        Start a fetched song unless the queue moved on, runs on the chat's actor
+        
+        Args:
+            chat_id: Chat ID where to play
+            song: Queued song record
+            file_path: Downloaded file, used when there is no stream
+            stream: Progressive stream of the song
+            
+        Returns:
+            bool: True if the song is playing, False otherwise
+        """
+        head = self.queue_manager.get_current_song(chat_id)
+        if head is None or head.entry_id != song.entry_id:
+            # Skipped, removed or stopped while fetching
+            logging.info(f"Not starting {song.title} in chat {chat_id}, it left the head of the queue")
+            return False
+        
+        if self.music_player.current_tag(chat_id) == song.entry_id:
+            # Started by another job for the same head
+            return True
+        
+        if stream is not None:
+            return await self.music_player.play_stream(chat_id, stream, song.duration, song.entry_id)
+        return await self.music_player.play_audio(chat_id, file_path, song.duration, song.entry_id)
+    
+    async def _resolve_song(self, chat_id: int, song: Song, message=None, delay: float = 0.0):
+        """
+        Search for a pending queue entry and start it if it reached the head
+        
+        Args:
+            chat_id: Chat ID the entry is queued in
+            song: Pending song record
+            message: Placeholder message to update with the outcome
+            delay: Seconds to wait first, for requests deferred by admission control
+        """
+        error = None
+        try:
+            if delay:
+                with tracing.span('admission.wait'):
+                    await asyncio.sleep(delay)
+            with tracing.span('search'):
+                video_info = await self.youtube_downloader.search_youtube(song.query)
+            with tracing.span('resolve'):
+                status, start = await self.actors.call(chat_id, self._apply_resolution, chat_id, song, video_info)
+            if start:
+                with tracing.span('start'):
+                    status = await self._start_resolved(chat_id, song)
+            with tracing.span('edit'):
+                await self._edit_status(message, status)
+            
+        except Exception as e:
+            error = str(e)
+            logging.error(f"Error resolving song for chat {chat_id}: {e}")
+            self.actors.tell(chat_id, self._drop_entry, chat_id, song.entry_id)
+            await self._edit_status(message, "❌ An error occurred while processing your request!")
+        finally:
+            # Ends the trace started by play_command
+            tracing.finish(error)
     
-    async def _handle_song_finished(self, chat_id: int):
+    async def _load_playlist(self, chat_id: int, url: str, message=None, delay: float = 0.0):
+        """
+        Read a playlist and queue its songs, starting the first if nothing plays
+        
+        Args:
+            chat_id: Chat ID to queue the songs in
+            url: Playlist URL
+            message: Placeholder message to update with the outcome
+            delay: Seconds to wait first, for requests deferred by admission control
+        """
+        error = None
+        try:
+            if delay:
+                with tracing.span('admission.wait'):
+                    await asyncio.sleep(delay)
+            
+            with tracing.span('extract'):
+                playlist = await self.youtube_downloader.extract_playlist(url)
+            
+            if not playlist or not playlist['entries']:
+                await self._edit_status(message, "❌ Could not read any songs from that playlist!")
+                return
+            
+            songs = [Song.from_info(info) for info in playlist['entries']]
+            with tracing.span('enqueue', songs=len(songs)):
+                status, added_ids = await self.actors.call(chat_id, self._enqueue_playlist, chat_id, playlist['title'], songs)
+            
+            # Start the first song right away instead of after the whole
+            # playlist, skipping songs that cannot be fetched
+            skipped = 0
+            with tracing.span('start'):
+                while not self.music_player.is_active(chat_id):
+                    head = self.queue_manager.get_current_song(chat_id)
+                    if head is None or head.pending or head.entry_id not in added_ids:
+                        break
+                    if await self._play_song(chat_id, head):
+                        status += f"\n🎵 **Now Playing:** {head.title}"
+                        break
+                    await self.actors.call(chat_id, self._remove_entry, chat_id, head.entry_id)
+                    skipped += 1
+            
+            if skipped:
+                status += f"\n⏭️ Skipped {skipped} unavailable songs"
+            with tracing.span('edit'):
+                await self._edit_status(message, status)
+            
+        except Exception as e:
+            error = str(e)
+            logging.error(f"Error loading playlist for chat {chat_id}: {e}")
+            await self._edit_status(message, "❌ An error occurred while processing your request!")
+        finally:
+            # Ends the trace started by playlist_command
+            tracing.finish(error)
+    
+    async def _enqueue_playlist(self, chat_id: int, title: str, songs: List[Song]) -> Tuple[str, Set[int]]:
+        """
+        Queue playlist songs in one operation, runs on the chat's actor
+        
+        The prefetcher downloads the entries after the head as they come
+        within PREFETCH_DEPTH of it.
+        
+        Args:
+            chat_id: Chat ID
+            title: Playlist title
+            songs: Unresolved song records
+            
+        Returns:
+            Status text for the placeholder message and the IDs of the queued entries
+        """
+        added = self.queue_manager.add_many(chat_id, songs)
+        if not added:
+            return f"❌ Queue is full! (max {Config.MAX_QUEUE_SIZE} songs)", set()
+        
+        status = f"📃 **Added {len(added)} songs** from {title}"
+        if len(added) < len(songs):
+            status += f" ({len(songs) - len(added)} left out, max {Config.MAX_QUEUE_SIZE} songs)"
+        return status, {song.entry_id for song in added}
+    
+    async def _apply_resolution(self, chat_id: int, song: Song, video_info: Optional[Dict]) -> Tuple[str, bool]:
+        """
+        Fill in a pending entry with its search result, runs on the chat's actor
+        
+        Args:
+            chat_id: Chat ID the entry is queued in
+            song: Pending song record
+            video_info: Search result, None if nothing was found
+            
+        Returns:
+            Status text for the placeholder message, and whether the entry
+            reached an idle head and should be started
+        """
+        if not self.queue_manager.get_position(chat_id, song.entry_id):
+            # Skipped or cleared while searching
+            return f"⏭️ **Removed from queue:** {song.title}", False
+        
+        if not video_info:
+            await self._drop_entry(chat_id, song.entry_id)
+            return "❌ No results found for your search!", False
+        
+        resolved = Song.from_info(video_info)
+        self.queue_manager.update_entry(
+            chat_id, song.entry_id,
+            title=resolved.title, url=resolved.url, video_id=resolved.video_id,
+            duration=resolved.duration, uploader=resolved.uploader, pending=False,
+        )
+        
+        queue_position = self.queue_manager.get_position(chat_id, song.entry_id)
+        start = queue_position == 1 and not self.music_player.is_active(chat_id)
+        return f"✅ **Added to queue (#{queue_position}):** {song.title}", start
+    
+    async def _start_resolved(self, chat_id: int, song: Song) -> str:
+        """
+        Start a resolved entry that reached an idle head
+        
+        Args:
+            chat_id: Chat ID the entry is queued in
+            song: Resolved song record
+            
+        Returns:
+            Status text for the placeholder message
+        """
+        if await self._play_song(chat_id, song):
+            return f"🎵 **Now Playing:** {song.title}"
+        
+        if not self.queue_manager.get_position(chat_id, song.entry_id):
+            # Skipped or cleared while fetching
+            return f"⏭️ **Removed from queue:** {song.title}"
+        
+        await self.actors.call(chat_id, self._drop_entry, chat_id, song.entry_id)
+        return "❌ Failed to join voice chat! Make sure the bot has permission to join voice chats."
+    
+    def _download_saturation(self) -> float:
+        """Play downloads waiting per download slot, for admission control"""
+        if self._youtube_downloader is None:
+            return 0.0
+        return self._youtube_downloader.scheduler.saturation()
+    
+    @staticmethod
+    def _rejection_text(admission: Admission) -> str:
+        """Tell a user why their request was not accepted and when to retry"""
+        retry = max(1, round(admission.delay))
+        if admission.reason == 'user':
+            return f"⏳ You are adding songs too quickly, try again in {retry}s"
+        if admission.reason == 'chat':
+            return f"⏳ This chat is adding songs too quickly, try again in {retry}s"
+        return f"🚦 The bot is busy right now, try again in {retry}s"
+    
+    async def _remove_entry(self, chat_id: int, entry_id: int) -> bool:
+        """Remove a queue entry, runs on the chat's actor"""
+        return self.queue_manager.remove_entry(chat_id, entry_id)
+    
+    async def _drop_entry(self, chat_id: int, entry_id: int):
+        """Remove a queue entry and start whatever is at the head now"""
+        self.queue_manager.remove_entry(chat_id, entry_id)
+        await self._start_head(chat_id)
+    
+    async def _start_head(self, chat_id: int):
+        """Start fetching the head of a chat's queue if nothing is playing"""
+        song = self.queue_manager.get_current_song(chat_id)
+        if song and not song.pending and not self.music_player.is_active(chat_id):
+            self._spawn(self._play_or_drop(chat_id, song))
+    
+    async def _skip(self, chat_id: int):
+        """
+        Drop the current song and start the next one, runs on the chat's actor
+        
+        Returns:
+            Tuple of the skipped song and the new head, None where there is none
+        """
+        current_song = self.queue_manager.get_current_song(chat_id)
+        if not current_song:
+            return None, None
+        
+        self.queue_manager.remove_entry(chat_id, current_song.entry_id)
+        next_song = self.queue_manager.get_current_song(chat_id)
+        
+        await self.music_player.stop_audio(chat_id)
+        if next_song and not next_song.pending:
+            # Starts once fetched, a pending head is started by its resolution job
+            self._spawn(self._play_or_drop(chat_id, next_song))
+        return current_song, next_song
+    
+    async def _stop(self, chat_id: int):
+        """Stop playback and clear the queue, runs on the chat's actor"""
+        await self.music_player.stop_audio(chat_id)
+        self.queue_manager.clear_queue(chat_id)
+    
+    async def _edit_status(self, message, text: str):
+        """Replace the text of a status message, if there is one"""
+        if message is None:
+            return
+        try:
+            await message.edit_text(text, parse_mode='Markdown')
+        except Exception as e:
+            logging.error(f"Error editing status message: {e}")
+    
+    def _spawn(self, coro):
+        """Run a coroutine in the background, keeping a reference until it finishes"""
+        task = asyncio.create_task(coro)
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+        return task
+    
+    async def export_chat(self, chat_id: int) -> List[Dict]:
+        """
+        Hand a chat over to another process, stopping its playback here
+        
+        Args:
+            chat_id: Chat ID
+            
+        Returns:
+            Serialized queue of the chat
+        """
+        return await self.actors.call(chat_id, self._export_chat, chat_id)
+    
+    async def import_chat(self, chat_id: int, songs: List[Dict]):
+        """
+        Take over a chat exported by another process and resume its queue
+        
+        Args:
+            chat_id: Chat ID
+            songs: Serialized queue from export_chat()
+        """
+        await self.actors.call(chat_id, self._import_chat, chat_id, [Song.from_dict(song) for song in songs])
+    
+    async def _export_chat(self, chat_id: int) -> List[Dict]:
+        """Serialize and drop a chat's queue, runs on the chat's actor"""
+        songs = [song.to_dict() for song in self.queue_manager.get_queue(chat_id)]
+        await self._stop(chat_id)
+        return songs
+    
+    async def _import_chat(self, chat_id: int, songs: List[Song]):
+        """Queue the songs of an imported chat, runs on the chat's actor"""
+        for song in songs:
+            # Files of the other process live in its own cache
+            song.file_path = None
+            if self.queue_manager.add_to_queue(chat_id, song) == -1:
+                break
+            if song.pending:
+                self._spawn(self._resolve_song(chat_id, song))
+        
+        await self._resume_chat(chat_id)
+    
+    async def _on_track_finished(self, chat_id: int, entry_id: int):
+        """Hand an end-of-track event to the chat's actor"""
+        await self.actors.call(chat_id, self._handle_song_finished, chat_id, entry_id)
+    
+    async def _handle_song_finished(self, chat_id: int, entry_id: int):
         """Handle when a song finishes playing"""
-        # Remove current song from queue
         current_song = self.queue_manager.get_current_song(chat_id)
-        if current_song:
-            self.queue_manager.remove_from_queue(chat_id, current_song)
+        if not current_song or current_song.entry_id != entry_id:
+            # The song was skipped or removed before this event was handled
+            logging.info(f"Ignoring stale end of track for entry {entry_id} in chat {chat_id}")
+            return
+        
+        # Remove current song from queue
+        self.queue_manager.remove_entry(chat_id, entry_id)
         
-        # Play next song if available
+        # Play next song if available, fetching it off the actor
         next_song = self.queue_manager.get_current_song(chat_id)
         if next_song:
-            await self.music_player.play_audio(chat_id, next_song['file_path'])
+            self._spawn(self._play_or_drop(chat_id, next_song))
         else:
             # No more songs, leave voice chat
             await self.music_player.stop_audio(chat_id)
     
+    async def _post_init(self, application: Application):
+        """Defer slow startup work until updates are being received"""
+        if Config.METRICS_ENABLED and Config.METRICS_PORT:
+            self._metrics_server = WebhookServer(application, port=Config.METRICS_PORT, accept_updates=False)
+            await self._metrics_server.start()
+            self._metrics_server.ready = True
+        
+        self._spawn(self._warm_up())
+    
+    async def _warm_up(self):
+        """Build the components, resume recovered queues and prewarm yt-dlp"""
+        # Polling, or the webhook server, is live once the application runs
+        while not self.application.running:
+            await asyncio.sleep(0.05)
+        startup_timer.mark("live")
+        
+        # Replays the queue journal
+        chat_ids = self.queue_manager.get_active_chats()
+        startup_timer.mark("queues")
+        # Building the prefetcher builds the downloader and the player
+        self.prefetcher
+        # Pins the recovered queues before the first eviction check
+        self.storage.start()
+        startup_timer.mark("components")
+        
+        for chat_id in chat_ids:
+            # Searches interrupted by the restart
+            for song in self.queue_manager.get_queue(chat_id):
+                if song.pending:
+                    self._spawn(self._resolve_song(chat_id, song))
+            self._spawn(self.actors.call(chat_id, self._resume_chat, chat_id))
+        
+        if Config.YDL_PREWARM:
+            await self.youtube_downloader.prewarm()
+            startup_timer.mark("prewarm")
+        startup_timer.log()
+    
+    async def _note_first_update(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Log how long the first update after startup waited"""
+        if startup_timer.has("first_update"):
+            return
+        
+        startup_timer.mark("first_update")
+        message = update.effective_message
+        if message and message.date:
+            waited = time.time() - message.date.timestamp()
+            logging.info(f"First update since startup arrived {waited:.1f}s after it was sent")
+        startup_timer.log()
+    
+    async def _resume_chat(self, chat_id: int):
+        """Start playing the head of a recovered queue, runs on the chat's actor"""
+        song = self.queue_manager.get_current_song(chat_id)
+        if song and not self.music_player.is_active(chat_id):
+            logging.info(f"Resuming recovered queue for chat {chat_id}: {song.title}")
+            self.prefetcher.refresh(chat_id)
+            self._spawn(self._play_or_drop(chat_id, song))
+    
+    async def _post_shutdown(self, application: Application):
+        """Flush state before the process exits"""
+        if self._metrics_server is not None:
+            await self._metrics_server.stop()
+        tracing.tracer.close()
+        if self._storage is not None:
+            await self._storage.stop()
+        await self.actors.shutdown()
+        # Only components that were actually built
+        if self._prefetcher is not None:
+            await self._prefetcher.cancel_all()
+        if self._music_player is not None:
+            await self._music_player.cleanup()
+        if self._queue_manager is not None:
+            self._queue_manager.close()
+        if self._youtube_downloader is not None:
+            self._youtube_downloader.close()
+    
     def run(self):
         """Run the bot"""
         logging.info("Starting Music Bot...")
-        self.application.run_polling()
\ No newline at end of file
+        if Config.WEBHOOK_ENABLED:
+            run_webhook(self.application)
+        else:
+            self.application.run_polling()
\ No newline at end of file
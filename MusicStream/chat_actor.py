@@ -0,0 +1,186 @@
+"""
+Per-chat actors that serialize state changes of each chat
+"""
+
+import asyncio
+import contextvars
+import logging
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+import metrics
+from config import Config
+
+ACTORS = metrics.gauge('musicstream_chat_actors', 'Live chat actors and jobs waiting in their mailboxes', ['state'])
+
+class ChatActor:
+    """Runs the jobs sent to one chat one at a time, in arrival order"""
+
+    def __init__(self, chat_id: int, idle_timeout: float, on_idle: Callable[["ChatActor"], None]):
+        """
+        Initialize chat actor and start its mailbox loop
+
+        Args:
+            chat_id: Chat ID the actor owns
+            idle_timeout: Seconds without jobs before the actor retires
+            on_idle: Called with the actor when it retires
+        """
+        self.chat_id = chat_id
+        self.idle_timeout = idle_timeout
+        self.mailbox: asyncio.Queue = asyncio.Queue()
+        self.processed = 0
+        self.stopped = False
+
+        self._on_idle = on_idle
+        self.task = asyncio.create_task(self._run(), name=f"chat-actor-{chat_id}")
+
+    def send(self, func: Callable[..., Awaitable[Any]], *args) -> asyncio.Future:
+        """
+        Queue a job for the actor
+
+        Args:
+            func: Coroutine function to run
+            *args: Arguments for func
+
+        Returns:
+            Future resolved with the job's result
+        """
+        future = asyncio.get_running_loop().create_future()
+        # The job runs in the sender's context, e.g. its request trace
+        self.mailbox.put_nowait((func, args, future, contextvars.copy_context()))
+        return future
+
+    def stop(self):
+        """Cancel the running job and drop the queued ones"""
+        self.stopped = True
+        self.task.cancel()
+        while not self.mailbox.empty():
+            _, _, future, _ = self.mailbox.get_nowait()
+            future.cancel()
+
+    async def _run(self):
+        """Process the mailbox until the actor has been idle for idle_timeout"""
+        while True:
+            try:
+                func, args, future, context = await asyncio.wait_for(self.mailbox.get(), self.idle_timeout)
+            except asyncio.TimeoutError:
+                if self.mailbox.empty():
+                    self._on_idle(self)
+                    return
+                continue
+
+            if self.stopped:
+                # Before Python 3.12, wait_for drops a cancellation that
+                # arrives together with a job
+                future.cancel()
+                return
+
+            if future.cancelled():
+                # The sender gave up before the job started
+                continue
+
+            try:
+                # Cancelling the actor cancels the job task it awaits
+                result = await context.run(asyncio.create_task, func(*args))
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+            except Exception as e:
+                if not future.cancelled():
+                    future.set_exception(e)
+            else:
+                if not future.cancelled():
+                    future.set_result(result)
+            finally:
+                self.processed += 1
+
+class ActorRegistry:
+    """
+    Creates chat actors on demand and routes jobs to them
+
+    Jobs for one chat never overlap, jobs for different chats run
+    concurrently. A job must not wait on another job of its own chat,
+    that would deadlock the actor.
+    """
+
+    def __init__(self, idle_timeout: Optional[float] = None):
+        """
+        Initialize actor registry
+
+        Args:
+            idle_timeout: Seconds before an idle actor retires (defaults to ACTOR_IDLE_TIMEOUT)
+        """
+        self.idle_timeout = Config.ACTOR_IDLE_TIMEOUT if idle_timeout is None else idle_timeout
+        self.actors: Dict[int, ChatActor] = {}
+        self.closed = False
+
+        ACTORS.set_function(lambda: {(state,): value for state, value in self.stats().items()})
+
+    async def call(self, chat_id: int, func: Callable[..., Awaitable[Any]], *args) -> Any:
+        """
+        Run a job on a chat's actor and wait for its result
+
+        Args:
+            chat_id: Chat ID
+            func: Coroutine function to run
+            *args: Arguments for func
+
+        Returns:
+            The job's result, exceptions are re-raised, cancelled after shutdown
+        """
+        return await self._send(chat_id, func, *args)
+
+    def tell(self, chat_id: int, func: Callable[..., Awaitable[Any]], *args):
+        """
+        Queue a job on a chat's actor without waiting for it
+
+        Args:
+            chat_id: Chat ID
+            func: Coroutine function to run
+            *args: Arguments for func
+        """
+        future = self._send(chat_id, func, *args)
+        future.add_done_callback(self._log_error)
+
+    def stats(self) -> Dict[str, int]:
+        """Get the number of live actors and jobs waiting in their mailboxes"""
+        return {
+            'actors': len(self.actors),
+            'backlog': sum(actor.mailbox.qsize() for actor in self.actors.values()),
+        }
+
+    async def shutdown(self):
+        """Stop every actor, dropping jobs that have not started"""
+        self.closed = True
+        actors = list(self.actors.values())
+        self.actors.clear()
+
+        for actor in actors:
+            actor.stop()
+        await asyncio.gather(*(actor.task for actor in actors), return_exceptions=True)
+        logging.info(f"Stopped {len(actors)} chat actors")
+
+    def _send(self, chat_id: int, func: Callable[..., Awaitable[Any]], *args) -> asyncio.Future:
+        """Queue a job on a chat's actor, the future is cancelled after shutdown"""
+        if self.closed:
+            future = asyncio.get_running_loop().create_future()
+            future.cancel()
+            return future
+        return self._actor(chat_id).send(func, *args)
+
+    def _actor(self, chat_id: int) -> ChatActor:
+        """Get the actor of a chat, starting one if needed"""
+        actor = self.actors.get(chat_id)
+        if actor is None:
+            actor = self.actors[chat_id] = ChatActor(chat_id, self.idle_timeout, self._retire)
+        return actor
+
+    def _retire(self, actor: ChatActor):
+        """Forget an actor that stopped after being idle"""
+        if self.actors.get(actor.chat_id) is actor:
+            del self.actors[actor.chat_id]
+
+    @staticmethod
+    def _log_error(future: asyncio.Future):
+        """Log errors of jobs nobody waits for"""
+        if not future.cancelled() and future.exception():
+            logging.error(f"Error in chat actor job: {future.exception()}")
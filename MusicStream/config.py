@@ -22,13 +22,115 @@ class Config:
     DOWNLOAD_DIR: str = os.getenv("DOWNLOAD_DIR", "./downloads")
     MAX_DOWNLOAD_SIZE: int = int(os.getenv("MAX_DOWNLOAD_SIZE", "104857600"))  # 100MB
     
+    # Cache settings
+    CACHE_MAX_BYTES: int = int(os.getenv("CACHE_MAX_BYTES", "2147483648"))  # 2GB
+    # Background eviction starts above the high watermark and frees down to
+    # the low one, both fractions of CACHE_MAX_BYTES
+    STORAGE_HIGH_WATERMARK: float = float(os.getenv("STORAGE_HIGH_WATERMARK", "0.9"))
+    STORAGE_LOW_WATERMARK: float = float(os.getenv("STORAGE_LOW_WATERMARK", "0.75"))
+    STORAGE_CHECK_INTERVAL: float = float(os.getenv("STORAGE_CHECK_INTERVAL", "60"))  # seconds
+    STORAGE_ORPHAN_MAX_AGE: float = float(os.getenv("STORAGE_ORPHAN_MAX_AGE", "86400"))  # seconds before untracked files go
+    SEARCH_CACHE_TTL: int = int(os.getenv("SEARCH_CACHE_TTL", "3600"))  # seconds
+    SEARCH_CACHE_SIZE: int = int(os.getenv("SEARCH_CACHE_SIZE", "5000"))
+    
     # Audio settings
     AUDIO_BITRATE: str = os.getenv("AUDIO_BITRATE", "128k")
     AUDIO_FORMAT: str = os.getenv("AUDIO_FORMAT", "mp3")
     
+    # Keep the codec YouTube serves when it is one of PLAYABLE_CODECS, only
+    # remuxing it, instead of transcoding every download to AUDIO_FORMAT
+    TRANSCODE_FREE: bool = os.getenv("TRANSCODE_FREE", "true").lower() == "true"
+    PLAYABLE_CODECS: str = os.getenv("PLAYABLE_CODECS", "opus,aac,mp3,vorbis")  # in order of preference
+    MEDIA_WORKERS: int = int(os.getenv("MEDIA_WORKERS", "2"))  # processes for ffmpeg jobs
+    
+    # Encode each cached track once into 48 kHz Opus frames that the voice
+    # chat player sends as they are, instead of transcoding on every play
+    OPUS_FRAMES: bool = os.getenv("OPUS_FRAMES", "false").lower() == "true"
+    OPUS_BITRATE: str = os.getenv("OPUS_BITRATE", "128k")  # when the source is not Opus already
+    
+    # Measure the loudness of each cached track once, in the media worker
+    # pool, and encode its Opus frames with a fixed normalization gain.
+    # Only runs with OPUS_FRAMES, nothing else applies the gain
+    LOUDNESS_ANALYSIS: bool = os.getenv("LOUDNESS_ANALYSIS", "true").lower() == "true"
+    LOUDNESS_TARGET: float = float(os.getenv("LOUDNESS_TARGET", "-16"))  # integrated LUFS
+    LOUDNESS_MAX_PEAK: float = float(os.getenv("LOUDNESS_MAX_PEAK", "-1"))  # dBTP after the gain
+    
     # Queue settings
     MAX_QUEUE_SIZE: int = int(os.getenv("MAX_QUEUE_SIZE", "20"))
     
+    # Playlist settings
+    PLAYLIST_MAX_SONGS: int = int(os.getenv("PLAYLIST_MAX_SONGS", "50"))  # entries read from one playlist
+    
+    # Queue persistence settings
+    STATE_DIR: str = os.getenv("STATE_DIR", "./state")
+    QUEUE_PERSISTENCE: bool = os.getenv("QUEUE_PERSISTENCE", "true").lower() == "true"
+    QUEUE_JOURNAL_FLUSH_INTERVAL: float = float(os.getenv("QUEUE_JOURNAL_FLUSH_INTERVAL", "0.2"))  # seconds
+    QUEUE_JOURNAL_BATCH_SIZE: int = int(os.getenv("QUEUE_JOURNAL_BATCH_SIZE", "1000"))
+    QUEUE_JOURNAL_FSYNC: bool = os.getenv("QUEUE_JOURNAL_FSYNC", "true").lower() == "true"
+    QUEUE_SNAPSHOT_INTERVAL: int = int(os.getenv("QUEUE_SNAPSHOT_INTERVAL", "10000"))  # journal records
+    
+    # Worker pools
+    DOWNLOAD_WORKERS: int = int(os.getenv("DOWNLOAD_WORKERS", "4"))
+    DOWNLOAD_MAX_IN_FLIGHT: int = int(os.getenv("DOWNLOAD_MAX_IN_FLIGHT", "4"))
+    SEARCH_WORKERS: int = int(os.getenv("SEARCH_WORKERS", "4"))
+    
+    # Pooled YoutubeDL instances
+    YDL_PREWARM: bool = os.getenv("YDL_PREWARM", "true").lower() == "true"
+    YDL_MAX_USES: int = int(os.getenv("YDL_MAX_USES", "200"))  # calls before an instance is rebuilt
+    YDL_MAX_IDLE: float = float(os.getenv("YDL_MAX_IDLE", "600"))  # idle seconds before an instance is rebuilt
+    
+    # Admission control of /play, token buckets refilled per second up to a burst
+    RATE_LIMIT_ENABLED: bool = os.getenv("RATE_LIMIT_ENABLED", "true").lower() == "true"
+    RATE_LIMIT_USER_RATE: float = float(os.getenv("RATE_LIMIT_USER_RATE", "0.2"))
+    RATE_LIMIT_USER_BURST: float = float(os.getenv("RATE_LIMIT_USER_BURST", "5"))
+    RATE_LIMIT_CHAT_RATE: float = float(os.getenv("RATE_LIMIT_CHAT_RATE", "0.5"))
+    RATE_LIMIT_CHAT_BURST: float = float(os.getenv("RATE_LIMIT_CHAT_BURST", "10"))
+    RATE_LIMIT_GLOBAL_RATE: float = float(os.getenv("RATE_LIMIT_GLOBAL_RATE", "20"))
+    RATE_LIMIT_GLOBAL_BURST: float = float(os.getenv("RATE_LIMIT_GLOBAL_BURST", "100"))
+    RATE_LIMIT_MAX_DELAY: float = float(os.getenv("RATE_LIMIT_MAX_DELAY", "5"))  # longest deferral, seconds
+    RATE_LIMIT_SHED_BACKLOG: float = float(os.getenv("RATE_LIMIT_SHED_BACKLOG", "8"))  # pending play downloads per slot
+    
+    # Chat actors
+    ACTOR_IDLE_TIMEOUT: float = float(os.getenv("ACTOR_IDLE_TIMEOUT", "300"))  # seconds
+    
+    # Worker processes, chats are sharded across them when greater than 1
+    SHARD_COUNT: int = int(os.getenv("SHARD_COUNT", "1"))
+    
+    # Webhook settings, updates are long polled when disabled
+    WEBHOOK_ENABLED: bool = os.getenv("WEBHOOK_ENABLED", "false").lower() == "true"
+    WEBHOOK_URL: str = os.getenv("WEBHOOK_URL", "")  # public base URL registered with Telegram
+    WEBHOOK_PATH: str = os.getenv("WEBHOOK_PATH", "/telegram")
+    WEBHOOK_SECRET: str = os.getenv("WEBHOOK_SECRET", "")
+    WEBHOOK_HOST: str = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+    WEBHOOK_MAX_BODY: int = int(os.getenv("WEBHOOK_MAX_BODY", "1048576"))  # bytes per request
+    PORT: int = int(os.getenv("PORT", "8080"))
+    
+    # Metrics, served on /metrics of a separate server on METRICS_PORT, and
+    # on the public webhook port only to requests carrying METRICS_TOKEN
+    METRICS_ENABLED: bool = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+    METRICS_PORT: int = int(os.getenv("METRICS_PORT", "0"))
+    METRICS_TOKEN: str = os.getenv("METRICS_TOKEN", "")  # bearer token, required on every port when set
+    
+    # Tracing of /play requests, exported when TRACE_FILE or TRACE_OTLP_ENDPOINT is set
+    TRACE_SAMPLE_RATE: float = float(os.getenv("TRACE_SAMPLE_RATE", "0.1"))  # fraction of requests traced
+    TRACE_FILE: str = os.getenv("TRACE_FILE", "")  # JSON lines file
+    TRACE_OTLP_ENDPOINT: str = os.getenv("TRACE_OTLP_ENDPOINT", "")  # e.g. http://localhost:4318/v1/traces
+    TRACE_RECENT: int = int(os.getenv("TRACE_RECENT", "200"))  # traces kept for /slowest
+    TRACE_SLOW_SECONDS: float = float(os.getenv("TRACE_SLOW_SECONDS", "10"))  # slower traces are logged
+    
+    # Telegram user ID allowed to use admin commands
+    OWNER_ID: int = int(os.getenv("OWNER_ID", "0"))
+    
+    # Progressive streaming settings
+    STREAMING_ENABLED: bool = os.getenv("STREAMING_ENABLED", "true").lower() == "true"
+    STREAM_MIN_BUFFER: int = int(os.getenv("STREAM_MIN_BUFFER", "262144"))  # 256KB before playback starts
+    STREAM_MAX_AHEAD: int = int(os.getenv("STREAM_MAX_AHEAD", "4194304"))  # 4MB ahead of the listener
+    STREAM_START_TIMEOUT: int = int(os.getenv("STREAM_START_TIMEOUT", "15"))  # seconds
+    
+    # Prefetch settings
+    PREFETCH_DEPTH: int = int(os.getenv("PREFETCH_DEPTH", "2"))  # songs after the current one
+    PREFETCH_CONCURRENCY: int = int(os.getenv("PREFETCH_CONCURRENCY", "4"))  # across all chats
+    
     # FFMPEG path
     FFMPEG_PATH: str = os.getenv("FFMPEG_PATH", "ffmpeg")
     
@@ -37,6 +139,8 @@ class Config:
         """Validate required configuration"""
         if not cls.BOT_TOKEN:
             raise ValueError("BOT_TOKEN is required")
+        if cls.WEBHOOK_ENABLED and not cls.WEBHOOK_SECRET:
+            raise ValueError("WEBHOOK_SECRET is required in webhook mode")
         # Note: API_ID, API_HASH, and BOT_USERNAME are optional for basic functionality
         # They would be required for actual voice chat integration
         return True
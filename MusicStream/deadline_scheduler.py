@@ -0,0 +1,134 @@
+"""
+Heap-based deadline scheduler running on the asyncio event loop
+"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+from typing import Callable, Dict, Hashable, List, Optional
+
+class _Deadline:
+    """A pending callback in the deadline heap"""
+
+    __slots__ = ('when', 'seq', 'key', 'callback', 'active')
+
+    def __init__(self, when: float, seq: int, key: Hashable, callback: Callable[[], None]):
+        self.when = when
+        self.seq = seq
+        self.key = key
+        self.callback = callback
+        self.active = True
+
+    def __lt__(self, other: "_Deadline") -> bool:
+        return (self.when, self.seq) < (other.when, other.seq)
+
+class DeadlineScheduler:
+    """Fires callbacks at per-key deadlines using one heap and a single loop timer"""
+
+    def __init__(self):
+        """Initialize deadline scheduler"""
+        self._heap: List[_Deadline] = []
+        self._deadlines: Dict[Hashable, _Deadline] = {}
+        self._seq = itertools.count()
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._timer_when: Optional[float] = None
+
+    def schedule(self, key: Hashable, delay: float, callback: Callable[[], None]):
+        """
+        Schedule a callback, replacing any pending deadline for the key
+
+        Args:
+            key: Deadline owner, e.g. a chat ID
+            delay: Seconds from now until the callback fires
+            callback: Function called on the event loop at the deadline
+        """
+        self.cancel(key)
+
+        loop = asyncio.get_running_loop()
+        deadline = _Deadline(loop.time() + max(0.0, delay), next(self._seq), key, callback)
+        heapq.heappush(self._heap, deadline)
+        self._deadlines[key] = deadline
+        self._rearm()
+
+    def cancel(self, key: Hashable) -> Optional[float]:
+        """
+        Cancel the pending deadline for a key
+
+        Args:
+            key: Deadline owner
+
+        Returns:
+            Seconds that were left until the deadline, or None if nothing was pending
+        """
+        deadline = self._deadlines.pop(key, None)
+        if deadline is None:
+            return None
+
+        # Lazy deletion, the heap entry is skipped when it reaches the top
+        deadline.active = False
+        if len(self._heap) > 64 and len(self._deadlines) < len(self._heap) // 2:
+            self._heap = [d for d in self._heap if d.active]
+            heapq.heapify(self._heap)
+
+        remaining = max(0.0, deadline.when - asyncio.get_running_loop().time())
+        self._rearm()
+        return remaining
+
+    def remaining(self, key: Hashable) -> Optional[float]:
+        """Get the seconds left until a key's deadline, or None if nothing is pending"""
+        deadline = self._deadlines.get(key)
+        if deadline is None:
+            return None
+        return max(0.0, deadline.when - asyncio.get_running_loop().time())
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._deadlines
+
+    def __len__(self) -> int:
+        return len(self._deadlines)
+
+    def clear(self):
+        """Cancel every pending deadline"""
+        self._heap.clear()
+        self._deadlines.clear()
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+            self._timer_when = None
+
+    def _rearm(self):
+        """Point the loop timer at the earliest active deadline"""
+        while self._heap and not self._heap[0].active:
+            heapq.heappop(self._heap)
+
+        when = self._heap[0].when if self._heap else None
+        if when == self._timer_when:
+            return
+
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        self._timer_when = when
+        if when is not None:
+            self._timer = asyncio.get_running_loop().call_at(when, self._fire)
+
+    def _fire(self):
+        """Run every callback whose deadline has passed"""
+        self._timer = None
+        self._timer_when = None
+        now = asyncio.get_running_loop().time()
+
+        while self._heap and self._heap[0].when <= now:
+            deadline = heapq.heappop(self._heap)
+            if not deadline.active:
+                continue
+
+            del self._deadlines[deadline.key]
+            try:
+                deadline.callback()
+            except Exception as e:
+                logging.error(f"Error in deadline callback for {deadline.key}: {e}")
+
+        self._rearm()
@@ -0,0 +1,234 @@
+"""
+Dedicated download worker pool with per-chat fair scheduling
+"""
+
+import asyncio
+import contextvars
+import logging
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Deque, Dict, Hashable, List, Optional
+
+import tracing
+from config import Config
+
+# Priority levels, lower runs first
+PRIORITY_PLAY = 0
+PRIORITY_PREFETCH = 1
+
+# Wait statistics are kept for this many chats, least recently served first out
+_WAIT_STATS_CHATS = 1000
+
+class _Job:
+    """A blocking call waiting for a download worker"""
+
+    __slots__ = ('chat_id', 'priority', 'func', 'key', 'future', 'enqueued_at', 'context')
+
+    def __init__(self, chat_id: int, priority: int, func: Callable[[], Any],
+                 key: Optional[Hashable], future: asyncio.Future):
+        self.chat_id = chat_id
+        self.priority = priority
+        self.func = func
+        self.key = key
+        self.future = future
+        self.enqueued_at = time.monotonic()
+        # The worker runs func in the caller's context, e.g. its request trace
+        self.context = contextvars.copy_context()
+
+class DownloadScheduler:
+    """Runs blocking download calls on its own thread pool, round-robin across chats"""
+
+    def __init__(self, workers: Optional[int] = None, max_in_flight: Optional[int] = None):
+        """
+        Initialize download scheduler
+
+        Args:
+            workers: Number of worker threads (defaults to DOWNLOAD_WORKERS)
+            max_in_flight: Global cap on running jobs (defaults to DOWNLOAD_MAX_IN_FLIGHT)
+        """
+        self.workers = Config.DOWNLOAD_WORKERS if workers is None else workers
+        self.max_in_flight = min(
+            self.workers,
+            Config.DOWNLOAD_MAX_IN_FLIGHT if max_in_flight is None else max_in_flight
+        )
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="download")
+
+        # One round-robin ring of chat_id -> pending jobs per priority level
+        self.pending: List["OrderedDict[int, Deque[_Job]]"] = [
+            OrderedDict() for _ in (PRIORITY_PLAY, PRIORITY_PREFETCH)
+        ]
+        self.in_flight = 0
+        self.closed = False
+
+        # chat_id -> {'jobs', 'total_wait', 'max_wait'} for dispatched jobs,
+        # most recently served chat last
+        self.wait_stats: "OrderedDict[int, Dict[str, float]]" = OrderedDict()
+
+        logging.info(f"Download scheduler initialized ({self.workers} workers, {self.max_in_flight} in flight)")
+
+    async def run(self, func: Callable[[], Any], chat_id: int = 0,
+                  priority: int = PRIORITY_PLAY, key: Optional[Hashable] = None) -> Any:
+        """
+        Run a blocking call on a download worker
+
+        Args:
+            func: Zero-argument blocking function
+            chat_id: Chat the work is done for, used for fairness
+            priority: PRIORITY_PLAY or PRIORITY_PREFETCH
+            key: Optional key that allows the job to be promoted later
+
+        Returns:
+            Result of func
+        """
+        if self.closed:
+            raise RuntimeError("download scheduler is shut down")
+
+        job = _Job(chat_id, priority, func, key, asyncio.get_running_loop().create_future())
+        self.pending[priority].setdefault(chat_id, deque()).append(job)
+        # Cancelling the caller cancels the job future, a job that has not
+        # started yet then leaves its queue
+        job.future.add_done_callback(lambda future: self._discard(job) if future.cancelled() else None)
+        self._dispatch()
+
+        return await job.future
+
+    def promote(self, key: Hashable) -> bool:
+        """
+        Move pending prefetch jobs with the given key to play priority
+
+        Args:
+            key: Key passed to run()
+
+        Returns:
+            True if a job was promoted, False otherwise
+        """
+        promoted = False
+        ring = self.pending[PRIORITY_PREFETCH]
+
+        for chat_id in list(ring):
+            jobs = ring[chat_id]
+            for job in [job for job in jobs if job.key == key]:
+                jobs.remove(job)
+                job.priority = PRIORITY_PLAY
+                self.pending[PRIORITY_PLAY].setdefault(chat_id, deque()).appendleft(job)
+                promoted = True
+            if not jobs:
+                del ring[chat_id]
+
+        if promoted:
+            logging.info(f"Promoted download to play priority: {key}")
+        return promoted
+
+    def stats(self) -> Dict:
+        """
+        Get scheduler saturation and per-chat queue statistics
+
+        Returns:
+            Dictionary with global counters and per-chat depth and wait times
+        """
+        now = time.monotonic()
+        chats: Dict[int, Dict] = {}
+
+        for ring in self.pending:
+            for chat_id, jobs in ring.items():
+                live_jobs = [job for job in jobs if not job.future.done()]
+                if not live_jobs:
+                    continue
+                chat = chats.setdefault(chat_id, {'depth': 0, 'oldest_wait': 0.0})
+                chat['depth'] += len(live_jobs)
+                chat['oldest_wait'] = max(chat['oldest_wait'], now - live_jobs[0].enqueued_at)
+
+        for chat_id, stats in self.wait_stats.items():
+            chat = chats.setdefault(chat_id, {'depth': 0, 'oldest_wait': 0.0})
+            chat['avg_wait'] = stats['total_wait'] / stats['jobs']
+            chat['max_wait'] = stats['max_wait']
+
+        return {
+            'workers': self.workers,
+            'max_in_flight': self.max_in_flight,
+            'in_flight': self.in_flight,
+            'pending': sum(chat['depth'] for chat in chats.values()),
+            'chats': chats,
+        }
+
+    def saturation(self) -> float:
+        """Get the play priority jobs waiting per download slot, 0 while there is capacity"""
+        pending = sum(len(jobs) for jobs in self.pending[PRIORITY_PLAY].values())
+        return pending / max(1, self.max_in_flight)
+
+    def shutdown(self):
+        """Stop the worker threads once running jobs finish"""
+        self.closed = True
+        for ring in self.pending:
+            for jobs in ring.values():
+                for job in jobs:
+                    job.future.cancel()
+            ring.clear()
+
+        self.executor.shutdown(wait=False)
+
+    def _discard(self, job: _Job):
+        """Drop a cancelled job that is still waiting, so it no longer counts as pending"""
+        ring = self.pending[job.priority]
+        jobs = ring.get(job.chat_id)
+        if jobs is None:
+            return
+        try:
+            jobs.remove(job)
+        except ValueError:
+            # Already dispatched
+            return
+        if not jobs:
+            del ring[job.chat_id]
+
+    def _next_job(self) -> Optional[_Job]:
+        """Pop the next job, highest priority first and round-robin across chats"""
+        for ring in self.pending:
+            while ring:
+                chat_id, jobs = ring.popitem(last=False)
+                job = jobs.popleft()
+                if jobs:
+                    # Chat goes to the back of the ring
+                    ring[chat_id] = jobs
+                if not job.future.done():
+                    return job
+        return None
+
+    def _dispatch(self):
+        """Start pending jobs while there is capacity"""
+        while self.in_flight < self.max_in_flight and not self.closed:
+            job = self._next_job()
+            if job is None:
+                return
+
+            wait = time.monotonic() - job.enqueued_at
+            stats = self.wait_stats.pop(job.chat_id, None) or {'jobs': 0, 'total_wait': 0.0, 'max_wait': 0.0}
+            self.wait_stats[job.chat_id] = stats
+            if len(self.wait_stats) > _WAIT_STATS_CHATS:
+                self.wait_stats.popitem(last=False)
+            stats['jobs'] += 1
+            stats['total_wait'] += wait
+            stats['max_wait'] = max(stats['max_wait'], wait)
+            job.context.run(tracing.record, 'download.wait', wait)
+
+            self.in_flight += 1
+            exec_future = asyncio.get_running_loop().run_in_executor(self.executor, job.context.run, job.func)
+            exec_future.add_done_callback(lambda f, job=job: self._finished(job, f))
+
+    def _finished(self, job: _Job, exec_future: asyncio.Future):
+        """Hand a job's outcome to its caller and start the next job"""
+        self.in_flight -= 1
+
+        if not job.future.done():
+            if exec_future.cancelled():
+                job.future.cancel()
+            elif exec_future.exception() is not None:
+                job.future.set_exception(exec_future.exception())
+            else:
+                job.future.set_result(exec_future.result())
+        elif not exec_future.cancelled():
+            # Caller went away, just consume the outcome
+            exec_future.exception()
+
+        self._dispatch()
@@ -0,0 +1,118 @@
+"""
+Offline loudness analysis of cached tracks
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+from typing import Dict, Iterable, Optional
+
+import metrics
+from audio_cache import AudioCache
+from audio_processing import MediaProcessPool, analyze_loudness
+from config import Config
+
+LOUDNESS_ANALYSES = metrics.counter('musicstream_loudness_analyses_total', 'Loudness analyses of cached tracks', ['result'])
+
+async def analyze_entry(cache: AudioCache, pool: MediaProcessPool, video_id: str,
+                        force: bool = False) -> Optional[Dict]:
+    """
+    Measure the loudness of a cached track and store it in its index entry
+
+    Tracks that were analyzed before are skipped.
+
+    Args:
+        cache: AudioCache holding the track
+        pool: Media pool the analysis runs in
+        video_id: YouTube video ID
+        force: Analyze again even if the entry has a measurement
+
+    Returns:
+        The measurement or None if the track is not cached or could not be analyzed
+    """
+    entry = cache.get_entry(video_id)
+    if entry is None:
+        return None
+    if entry.get('loudness') and not force:
+        return entry['loudness']
+
+    source = os.path.join(cache.cache_dir, entry['file_name'])
+    try:
+        measurement = await pool.run(
+            analyze_loudness, source, Config.LOUDNESS_TARGET, Config.LOUDNESS_MAX_PEAK, Config.FFMPEG_PATH
+        )
+    except Exception as e:
+        LOUDNESS_ANALYSES.inc(result='error')
+        logging.warning(f"Could not analyze loudness of {video_id}: {e}")
+        return None
+
+    LOUDNESS_ANALYSES.inc(result='ok')
+    cache.update(video_id, loudness=measurement)
+    logging.info(f"Loudness of {video_id}: {measurement['integrated']} LUFS, "
+                 f"{measurement['true_peak']} dBTP, gain {measurement['gain']:+.2f} dB")
+    return measurement
+
+async def analyze_cache(cache: AudioCache, pool: MediaProcessPool, video_ids: Optional[Iterable[str]] = None,
+                        force: bool = False) -> Dict[str, int]:
+    """
+    Analyze every cached track that has no measurement yet
+
+    Args:
+        cache: AudioCache to go through
+        pool: Media pool the analyses run in, its workers bound the parallelism
+        video_ids: Tracks to analyze (defaults to the whole cache)
+        force: Analyze tracks that have a measurement again
+
+    Returns:
+        Number of tracks analyzed, skipped and failed
+    """
+    if video_ids is None:
+        video_ids = cache.video_ids()
+
+    counts = {'analyzed': 0, 'skipped': 0, 'failed': 0}
+
+    async def analyze(video_id: str):
+        entry = cache.get_entry(video_id)
+        if entry is None:
+            return
+        if entry.get('loudness') and not force:
+            counts['skipped'] += 1
+            return
+        if await analyze_entry(cache, pool, video_id, force) is None:
+            counts['failed'] += 1
+        else:
+            counts['analyzed'] += 1
+
+    await asyncio.gather(*(analyze(video_id) for video_id in video_ids))
+    cache.flush()
+    return counts
+
+def main():
+    """Analyze the tracks of a download directory and print the counts as JSON"""
+    parser = argparse.ArgumentParser(description="Measure the loudness of cached tracks")
+    parser.add_argument('--dir', default=Config.DOWNLOAD_DIR, help="Download directory holding the cache")
+    parser.add_argument('--workers', type=int, default=None, help="Worker processes (defaults to MEDIA_WORKERS)")
+    parser.add_argument('--force', action='store_true', help="Analyze tracks that have a measurement again")
+    parser.add_argument('--verbose', action='store_true', help="Log each track")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO if args.verbose else logging.WARNING
+    )
+
+    # The cache index is rewritten by whichever process saves last, so run
+    # this while the bot is stopped
+    cache = AudioCache(args.dir)
+    pool = MediaProcessPool(args.workers)
+    try:
+        counts = asyncio.run(analyze_cache(cache, pool, force=args.force))
+    finally:
+        pool.shutdown()
+
+    print(json.dumps(counts))
+
+if __name__ == "__main__":
+    main()
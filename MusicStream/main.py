@@ -3,9 +3,11 @@
 Main entry point for the Telegram Music Bot
 """
 
-import asyncio
+# Imported first so startup timing covers every other import
+from startup_timing import startup_timer
+
 import logging
-from bot import MusicBot
+from config import Config
 
 def main():
     """Main function to start the bot"""
@@ -15,8 +17,16 @@ def main():
         level=logging.INFO
     )
     
-    # Create and run the bot
-    bot = MusicBot()
+    # Create and run the bot, or a supervisor running one bot per shard,
+    # importing only the one that runs
+    if Config.SHARD_COUNT > 1:
+        from shard_supervisor import ShardSupervisor
+        startup_timer.mark("imports")
+        bot = ShardSupervisor()
+    else:
+        from bot import MusicBot
+        startup_timer.mark("imports")
+        bot = MusicBot()
     
     try:
         bot.run()
@@ -0,0 +1,292 @@
+"""
+Counters, gauges and histograms exposed in the Prometheus text format
+"""
+
+import bisect
+import math
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+# Seconds, from cache hits to slow downloads
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+LabelValues = Tuple[str, ...]
+
+class _PerThread:
+    """
+    Storage with one cell per recording thread
+
+    Recording only touches the calling thread's cell, so it needs no lock.
+    Scrapes sum the cells, reading values other threads may be updating,
+    which can only make a scrape miss the latest few observations.
+    """
+
+    def __init__(self, factory: Callable[[], Dict]):
+        self._factory = factory
+        self._local = threading.local()
+        self._cells: List[Dict] = []
+        self._lock = threading.Lock()
+
+    def cell(self) -> Dict:
+        """Get the calling thread's cell, creating it on first use"""
+        try:
+            return self._local.cell
+        except AttributeError:
+            cell = self._local.cell = self._factory()
+            with self._lock:
+                self._cells.append(cell)
+            return cell
+
+    def cells(self) -> List[Dict]:
+        """Get the cells of every thread that recorded something"""
+        with self._lock:
+            return list(self._cells)
+
+class _Metric:
+    """Metric with a name, help text and label names"""
+
+    TYPE = ''
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labels)
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        """Label values in the order of the label names"""
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _format_labels(self, values: LabelValues, extra: Iterable[Tuple[str, str]] = ()) -> str:
+        """Render label pairs, empty when there are none"""
+        pairs = list(zip(self.labelnames, values)) + list(extra)
+        if not pairs:
+            return ''
+        escaped = (f'{name}="{_escape(value)}"' for name, value in pairs)
+        return '{' + ','.join(escaped) + '}'
+
+    def samples(self) -> List[str]:
+        """Sample lines of this metric"""
+        raise NotImplementedError
+
+    def render(self) -> str:
+        """HELP, TYPE and sample lines of this metric"""
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.TYPE}"]
+        lines.extend(self.samples())
+        return '\n'.join(lines)
+
+class Counter(_Metric):
+    """Monotonically increasing count, aggregated per thread"""
+
+    TYPE = 'counter'
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        super().__init__(name, documentation, labels)
+        self._values = _PerThread(lambda: defaultdict(float))
+
+    def inc(self, amount: float = 1.0, **labels):
+        """
+        Increase the counter
+
+        Args:
+            amount: Non-negative increment
+            **labels: Value of every label of the counter
+        """
+        self._values.cell()[self._key(labels)] += amount
+
+    def value(self, **labels) -> float:
+        """Get the current total for a set of label values"""
+        key = self._key(labels)
+        return sum(cell.get(key, 0.0) for cell in self._values.cells())
+
+    def totals(self) -> Dict[LabelValues, float]:
+        """Get the totals of every set of label values"""
+        totals: Dict[LabelValues, float] = defaultdict(float)
+        for cell in self._values.cells():
+            for key, value in list(cell.items()):
+                totals[key] += value
+        return totals
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{self._format_labels(key)} {_number(value)}"
+                for key, value in sorted(self.totals().items())]
+
+class Gauge(_Metric):
+    """
+    Value that goes up and down
+
+    Set it from the event loop, or give it a function evaluated on each
+    scrape, which costs nothing between scrapes.
+    """
+
+    TYPE = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        super().__init__(name, documentation, labels)
+        self._values: Dict[LabelValues, float] = {}
+        self._function: Optional[Callable[[], Union[float, Dict[LabelValues, float]]]] = None
+
+    def set(self, value: float, **labels):
+        """Set the gauge"""
+        self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1.0, **labels):
+        """Increase the gauge"""
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels):
+        """Decrease the gauge"""
+        self.inc(-amount, **labels)
+
+    def set_function(self, function: Callable[[], Union[float, Dict[LabelValues, float]]]):
+        """
+        Compute the gauge on each scrape
+
+        Args:
+            function: Returns the value, or a dict of label values to values
+                for a gauge with labels
+        """
+        self._function = function
+
+    def values(self) -> Dict[LabelValues, float]:
+        """Get the current value of every set of label values"""
+        if self._function is None:
+            return dict(self._values)
+
+        result = self._function()
+        if isinstance(result, dict):
+            return {tuple(str(value) for value in key): value for key, value in result.items()}
+        return {(): result}
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{self._format_labels(key)} {_number(value)}"
+                for key, value in sorted(self.values().items())]
+
+class Histogram(_Metric):
+    """Distribution of observations in fixed buckets, aggregated per thread"""
+
+    TYPE = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+        # Per label values: observations per bucket (last one is +Inf), sum
+        self._values = _PerThread(lambda: {})
+
+    def observe(self, value: float, **labels):
+        """
+        Record an observation
+
+        Args:
+            value: Observed value, e.g. seconds
+            **labels: Value of every label of the histogram
+        """
+        cell = self._values.cell()
+        key = self._key(labels)
+        state = cell.get(key)
+        if state is None:
+            state = cell[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        state[0][bisect.bisect_left(self.buckets, value)] += 1
+        state[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of the with block in seconds"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def snapshot(self) -> Dict[LabelValues, Tuple[List[int], float]]:
+        """Get the bucket counts and sum of every set of label values"""
+        merged: Dict[LabelValues, Tuple[List[int], float]] = {}
+        for cell in self._values.cells():
+            for key, (counts, total) in list(cell.items()):
+                if key in merged:
+                    merged_counts, merged_total = merged[key]
+                    merged[key] = ([a + b for a, b in zip(merged_counts, counts)], merged_total + total)
+                else:
+                    merged[key] = (list(counts), total)
+        return merged
+
+    def samples(self) -> List[str]:
+        lines = []
+        for key, (counts, total) in sorted(self.snapshot().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                le = '+Inf' if bound == math.inf else _number(bound)
+                lines.append(f"{self.name}_bucket{self._format_labels(key, [('le', le)])} {cumulative}")
+            lines.append(f"{self.name}_sum{self._format_labels(key)} {_number(total)}")
+            lines.append(f"{self.name}_count{self._format_labels(key)} {cumulative}")
+        return lines
+
+class Registry:
+    """Named metrics rendered together"""
+
+    def __init__(self):
+        self.metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric) -> _Metric:
+        """Add a metric, returning the one already registered under its name"""
+        with self._lock:
+            existing = self.metrics.get(metric.name)
+            if existing is not None:
+                if type(existing) is not type(metric) or existing.labelnames != metric.labelnames:
+                    raise ValueError(f"Metric {metric.name} is already registered differently")
+                return existing
+            self.metrics[metric.name] = metric
+            return metric
+
+    def render(self) -> str:
+        """Render every metric in the Prometheus text format"""
+        with self._lock:
+            metrics = list(self.metrics.values())
+
+        blocks = []
+        for metric in metrics:
+            try:
+                blocks.append(metric.render())
+            except Exception as e:
+                blocks.append(f"# {metric.name} unavailable: {e}")
+        return '\n'.join(blocks) + '\n'
+
+REGISTRY = Registry()
+
+def counter(name: str, documentation: str, labels: Sequence[str] = ()) -> Counter:
+    """Create or get a counter of the default registry"""
+    return REGISTRY.register(Counter(name, documentation, labels))
+
+def gauge(name: str, documentation: str, labels: Sequence[str] = ()) -> Gauge:
+    """Create or get a gauge of the default registry"""
+    return REGISTRY.register(Gauge(name, documentation, labels))
+
+def histogram(name: str, documentation: str, labels: Sequence[str] = (),
+              buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+    """Create or get a histogram of the default registry"""
+    return REGISTRY.register(Histogram(name, documentation, labels, buckets))
+
+def render() -> str:
+    """Render the default registry"""
+    return REGISTRY.render()
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _number(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+# Process level gauges
+gauge('musicstream_threads', 'Live threads in the process').set_function(threading.active_count)
@@ -8,31 +8,74 @@ import asyncio
 import logging
 import os
 import subprocess
-from typing import Dict, Optional
-import threading
-import time
+from typing import Awaitable, Callable, Dict, Hashable, List, Optional
 
+import metrics
+import tracing
+from audio_metadata import AudioMetadata, DEFAULT_DURATION
+from audio_stream import ProgressiveStream
 from config import Config
+from deadline_scheduler import DeadlineScheduler
+from opus_frames import OpusFrameFile, open_frames
+
+PLAYBACKS = metrics.gauge('musicstream_playbacks', 'Chats with a current track', ['state'])
+
+class _Playback:
+    """Playback state of one chat"""
+    
+    __slots__ = ('file_path', 'duration', 'tag', 'stream', 'frames', 'frame_cursor', 'process',
+                 'paused', 'paused_remaining')
+    
+    def __init__(self, file_path: str, duration: float, tag: Hashable = None,
+                 stream: Optional[ProgressiveStream] = None, frames: Optional[OpusFrameFile] = None):
+        self.file_path = file_path
+        self.duration = duration
+        # Caller's identifier of the track, handed back when it ends
+        self.tag = tag
+        self.stream = stream
+        # Pre-encoded Opus frames and the next one to send
+        self.frames = frames
+        self.frame_cursor = 0
+        self.process: Optional[subprocess.Popen] = None
+        self.paused = False
+        self.paused_remaining = 0.0
 
 class MusicPlayer:
     """Handles music playback simulation for voice chats"""
     
-    def __init__(self):
-        """Initialize music player"""
-        self.active_streams: Dict[int, bool] = {}
-        self.paused_streams: Dict[int, bool] = {}
-        self.current_processes: Dict[int, subprocess.Popen] = {}
-        self.playback_threads: Dict[int, threading.Thread] = {}
+    def __init__(self, cache=None):
+        """
+        Initialize music player
+        
+        Args:
+            cache: AudioCache used to store and look up track metadata
+        """
+        self.metadata = AudioMetadata(cache)
+        
+        # Playback state of every chat with an active track
+        self.playbacks: Dict[int, _Playback] = {}
+        
+        # End-of-track deadlines for every chat
+        self.deadlines = DeadlineScheduler()
+        
+        # Coroutine function called with the chat ID and track tag when a
+        # track ends by itself
+        self.on_track_finished: Optional[Callable[[int, Hashable], Awaitable[None]]] = None
+        
+        PLAYBACKS.set_function(self._playback_counts)
         
         logging.info("Music player initialized")
     
-    async def play_audio(self, chat_id: int, file_path: str) -> bool:
+    async def play_audio(self, chat_id: int, file_path: str, duration: Optional[float] = None,
+                         tag: Hashable = None) -> bool:
         """
         Play audio file in voice chat
         
         Args:
             chat_id: Chat ID where to play
             file_path: Path to audio file
+            duration: Known track duration in seconds, probed if not given
+            tag: Identifier passed to on_track_finished when the track ends
             
         Returns:
             bool: True if successful, False otherwise
@@ -43,43 +86,16 @@ class MusicPlayer:
                 return False
             
             # Stop any existing playback for this chat
-            if chat_id in self.active_streams:
+            if chat_id in self.playbacks:
                 await self.stop_audio(chat_id)
             
-            # Start new playback simulation
-            self.active_streams[chat_id] = True
-            self.paused_streams[chat_id] = False
-            
-            # Simulate audio playback with a thread
-            def simulate_playback():
-                try:
-                    # This simulates playing audio - in real implementation,
-                    # this would connect to Telegram voice chat
-                    logging.info(f"🎵 Starting playback simulation for chat {chat_id}: {os.path.basename(file_path)}")
-                    
-                    # Get audio duration using ffprobe if available
-                    duration = self._get_audio_duration(file_path)
-                    
-                    # Simulate playback time
-                    start_time = time.time()
-                    while (chat_id in self.active_streams and 
-                           time.time() - start_time < duration and
-                           not self.paused_streams.get(chat_id, False)):
-                        time.sleep(1)
-                    
-                    # Clean up when finished
-                    if chat_id in self.active_streams and not self.paused_streams.get(chat_id, False):
-                        logging.info(f"🎵 Finished playing: {os.path.basename(file_path)}")
-                        self.active_streams.pop(chat_id, None)
-                        self.paused_streams.pop(chat_id, None)
-                        
-                except Exception as e:
-                    logging.error(f"Error in playback simulation: {e}")
-            
-            # Start playback thread
-            thread = threading.Thread(target=simulate_playback, daemon=True)
-            self.playback_threads[chat_id] = thread
-            thread.start()
+            # Resolve the duration from the cheapest source that knows it
+            with tracing.span('probe', known=bool(duration)):
+                track_duration = await self.metadata.get_duration(file_path, duration)
+            
+            # Start new playback simulation, this would normally connect
+            # to the Telegram voice chat
+            self._start(chat_id, _Playback(file_path, track_duration, tag))
             
             logging.info(f"Started audio playback simulation for chat {chat_id}: {file_path}")
             return True
@@ -88,24 +104,120 @@ class MusicPlayer:
             logging.error(f"Error playing audio in chat {chat_id}: {e}")
             return False
     
-    def _get_audio_duration(self, file_path: str) -> float:
-        """Get audio file duration in seconds"""
+    async def play_stream(self, chat_id: int, stream: ProgressiveStream, duration: Optional[float] = None,
+                          tag: Hashable = None) -> bool:
+        """
+        Play a progressive stream that is still being downloaded
+        
+        Args:
+            chat_id: Chat ID where to play
+            stream: Buffered ProgressiveStream
+            duration: Known track duration in seconds
+            tag: Identifier passed to on_track_finished when the track ends
+            
+        Returns:
+            bool: True if successful, False otherwise
+        """
         try:
-            # Try to get duration using ffprobe
-            result = subprocess.run([
-                'ffprobe', '-v', 'quiet', '-show_entries', 
-                'format=duration', '-of', 'csv=p=0', file_path
-            ], capture_output=True, text=True, timeout=10)
-            
-            if result.returncode == 0 and result.stdout.strip():
-                return float(result.stdout.strip())
-            else:
-                # Default duration if ffprobe fails
-                return 180.0  # 3 minutes
-                
+            # Stop any existing playback for this chat
+            if chat_id in self.playbacks:
+                await self.stop_audio(chat_id)
+            
+            track_duration = duration or stream.duration or DEFAULT_DURATION
+            
+            # Start new playback simulation, a voice chat client would read
+            # the audio through stream.read() as it arrives
+            self._start(chat_id, _Playback(stream.final_path, track_duration, tag, stream))
+            
+            # Our playback position throttles how far ahead ffmpeg may write
+            stream.attach_clock(chat_id, lambda: self.get_position(chat_id))
+            
+            logging.info(f"Started streaming playback simulation for chat {chat_id}: {stream.video_id}")
+            return True
+            
         except Exception as e:
-            logging.warning(f"Could not get audio duration: {e}")
-            return 180.0  # Default 3 minutes
+            logging.error(f"Error playing stream in chat {chat_id}: {e}")
+            return False
+    
+    def _start(self, chat_id: int, playback: _Playback):
+        """Make a playback current and schedule its end"""
+        self.playbacks[chat_id] = playback
+        self.deadlines.schedule(chat_id, playback.duration, lambda: self._track_finished(chat_id))
+    
+    def _playback_counts(self) -> Dict:
+        """Playback gauges, computed on each scrape"""
+        paused = sum(1 for playback in self.playbacks.values() if playback.paused)
+        streaming = sum(1 for playback in self.playbacks.values() if playback.stream is not None)
+        return {
+            ('playing',): len(self.playbacks) - paused,
+            ('paused',): paused,
+            ('streaming',): streaming,
+        }
+    
+    def get_position(self, chat_id: int) -> float:
+        """
+        Get the playback position of a chat
+        
+        Args:
+            chat_id: Chat ID
+            
+        Returns:
+            Seconds played of the current track, 0 if nothing is playing
+        """
+        playback = self.playbacks.get(chat_id)
+        if playback is None:
+            return 0.0
+        
+        if playback.paused:
+            remaining = playback.paused_remaining
+        else:
+            remaining = self.deadlines.remaining(chat_id) or 0.0
+        return max(0.0, playback.duration - remaining)
+    
+    def _track_finished(self, chat_id: int):
+        """Handle the end-of-track deadline of a chat"""
+        playback = self.playbacks.pop(chat_id, None)
+        if playback is None:
+            return
+        
+        logging.info(f"🎵 Finished playing: {os.path.basename(playback.file_path or '')}")
+        self._release(chat_id, playback)
+        
+        if self.on_track_finished is not None:
+            task = asyncio.create_task(self.on_track_finished(chat_id, playback.tag))
+            task.add_done_callback(self._log_callback_error)
+    
+    @staticmethod
+    def _release(chat_id: int, playback: _Playback):
+        """Stop the process and stream listener of a finished playback"""
+        if playback.process is not None:
+            try:
+                playback.process.terminate()
+            except Exception:
+                pass
+        if playback.stream is not None:
+            playback.stream.detach_clock(chat_id)
+        if playback.frames is not None:
+            playback.frames.close()
+    
+    @staticmethod
+    def _log_callback_error(task: asyncio.Task):
+        """Log errors raised by the track finished callback"""
+        if not task.cancelled() and task.exception():
+            logging.error(f"Error handling finished track: {task.exception()}")
+    
+    async def probe_duration(self, file_path: str, video_id: Optional[str] = None) -> float:
+        """
+        Get audio file duration without blocking the event loop
+        
+        Args:
+            file_path: Path to audio file
+            video_id: Cache key of the file, if known
+            
+        Returns:
+            Duration in seconds
+        """
+        return await self.metadata.get_duration(file_path, video_id=video_id)
     
     async def pause_audio(self, chat_id: int) -> bool:
         """
@@ -118,10 +230,12 @@ class MusicPlayer:
             bool: True if successful, False otherwise
         """
         try:
-            if chat_id not in self.active_streams or self.paused_streams.get(chat_id, False):
+            playback = self.playbacks.get(chat_id)
+            if playback is None or playback.paused:
                 return False
             
-            self.paused_streams[chat_id] = True
+            playback.paused = True
+            playback.paused_remaining = self.deadlines.cancel(chat_id) or 0.0
             logging.info(f"Paused audio simulation in chat {chat_id}")
             return True
             
@@ -140,10 +254,12 @@ class MusicPlayer:
             bool: True if successful, False otherwise
         """
         try:
-            if chat_id not in self.active_streams or not self.paused_streams.get(chat_id, False):
+            playback = self.playbacks.get(chat_id)
+            if playback is None or not playback.paused:
                 return False
             
-            self.paused_streams[chat_id] = False
+            playback.paused = False
+            self.deadlines.schedule(chat_id, playback.paused_remaining, lambda: self._track_finished(chat_id))
             logging.info(f"Resumed audio simulation in chat {chat_id}")
             return True
             
@@ -162,24 +278,11 @@ class MusicPlayer:
             bool: True if successful, False otherwise
         """
         try:
-            if chat_id in self.active_streams:
-                # Stop the simulation
-                del self.active_streams[chat_id]
-                
-                if chat_id in self.paused_streams:
-                    del self.paused_streams[chat_id]
-                
-                # Stop any running processes
-                if chat_id in self.current_processes:
-                    try:
-                        self.current_processes[chat_id].terminate()
-                        del self.current_processes[chat_id]
-                    except:
-                        pass
-                
-                # Clean up thread reference
-                if chat_id in self.playback_threads:
-                    del self.playback_threads[chat_id]
+            playback = self.playbacks.pop(chat_id, None)
+            if playback is not None:
+                # Drop the end-of-track deadline and stop the simulation
+                self.deadlines.cancel(chat_id)
+                self._release(chat_id, playback)
                 
                 logging.info(f"Stopped audio simulation and left voice chat {chat_id}")
             
@@ -189,27 +292,36 @@ class MusicPlayer:
             logging.error(f"Error stopping audio in chat {chat_id}: {e}")
             return False
     
+    def is_active(self, chat_id: int) -> bool:
+        """Check if a track is loaded in chat, playing or paused"""
+        return chat_id in self.playbacks
+    
     def is_playing(self, chat_id: int) -> bool:
         """Check if audio is currently playing in chat"""
-        return chat_id in self.active_streams and not self.paused_streams.get(chat_id, False)
+        playback = self.playbacks.get(chat_id)
+        return playback is not None and not playback.paused
     
     def is_paused(self, chat_id: int) -> bool:
         """Check if audio is paused in chat"""
-        return chat_id in self.active_streams and self.paused_streams.get(chat_id, False)
+        playback = self.playbacks.get(chat_id)
+        return playback is not None and playback.paused
+    
+    def current_tag(self, chat_id: int) -> Hashable:
+        """Get the tag of the track loaded in chat, None if there is none"""
+        playback = self.playbacks.get(chat_id)
+        return playback.tag if playback is not None else None
     
     async def cleanup(self):
         """Clean up resources"""
         # Stop all active streams
-        for chat_id in list(self.active_streams.keys()):
+        for chat_id in list(self.playbacks.keys()):
             try:
                 await self.stop_audio(chat_id)
             except Exception as e:
                 logging.error(f"Error stopping audio in chat {chat_id}: {e}")
         
-        self.active_streams.clear()
-        self.paused_streams.clear()
-        self.current_processes.clear()
-        self.playback_threads.clear()
+        self.playbacks.clear()
+        self.deadlines.clear()
         
         logging.info("Music player cleaned up")
 
@@ -220,8 +332,8 @@ class TelegramVoiceChatPlayer(MusicPlayer):
     This would require additional libraries like py-tgcalls or similar.
     """
     
-    def __init__(self):
-        super().__init__()
+    def __init__(self, cache=None):
+        super().__init__(cache)
         self.voice_chat_client = None
         logging.info("Telegram voice chat player initialized (requires additional setup)")
     
@@ -232,11 +344,61 @@ class TelegramVoiceChatPlayer(MusicPlayer):
         logging.warning("Voice chat client setup not implemented - using simulation mode")
         pass
     
-    async def play_audio(self, chat_id: int, file_path: str) -> bool:
+    async def play_audio(self, chat_id: int, file_path: str, duration: Optional[float] = None,
+                         tag: Hashable = None) -> bool:
         """Override to add actual voice chat functionality when available"""
         # Try to setup voice chat client first
         if self.voice_chat_client is None:
             await self._setup_voice_chat_client()
         
-        # For now, use simulation
-        return await super().play_audio(chat_id, file_path)
\ No newline at end of file
+        frames = self._open_frames(file_path)
+        if frames is None:
+            # No frames yet, the file would be transcoded for this play
+            return await super().play_audio(chat_id, file_path, duration, tag)
+        
+        try:
+            if chat_id in self.playbacks:
+                await self.stop_audio(chat_id)
+            
+            self._start(chat_id, _Playback(file_path, frames.duration or duration or DEFAULT_DURATION, tag,
+                                           frames=frames))
+            logging.info(f"Started Opus frame playback for chat {chat_id}: {frames.path}")
+            return True
+            
+        except Exception as e:
+            frames.close()
+            logging.error(f"Error playing audio in chat {chat_id}: {e}")
+            return False
+    
+    def read_frames(self, chat_id: int, lead: float = 0.1) -> List[bytes]:
+        """
+        Take the Opus packets that are due in a chat
+        
+        A voice chat client calls this on its send tick. Packets are
+        sliced from the memory-mapped frame file, nothing is decoded. The
+        track's loudness normalization gain was applied when the frames
+        were encoded.
+        
+        Args:
+            chat_id: Chat ID
+            lead: Seconds of audio to hand out ahead of the playback position
+            
+        Returns:
+            Packets not sent yet, empty when paused or not playing frames
+        """
+        playback = self.playbacks.get(chat_id)
+        if playback is None or playback.frames is None or playback.paused:
+            return []
+        
+        end = min(playback.frames.frame_count, playback.frames.frame_at(self.get_position(chat_id) + lead) + 1)
+        packets = [playback.frames.frame(index) for index in range(playback.frame_cursor, end)]
+        playback.frame_cursor = max(playback.frame_cursor, end)
+        return packets
+    
+    def _open_frames(self, file_path: str) -> Optional[OpusFrameFile]:
+        """Open the Opus frame sidecar of a cached file, if it has one"""
+        cache = self.metadata.cache
+        video_id = cache.video_id_for(file_path) if cache is not None else None
+        if video_id is None:
+            return None
+        return open_frames(cache.sidecar_path(video_id, 'frames'))
\ No newline at end of file
@@ -0,0 +1,269 @@
+"""
+Packetized Opus frame files that voice chats play without transcoding
+"""
+
+import mmap
+import os
+import struct
+from array import array
+from typing import BinaryIO, Iterator, Optional, Tuple
+
+# Sample rate of Opus timestamps, whatever the source was
+SAMPLE_RATE = 48000
+
+MAGIC = b'MSOPUSF1'
+
+# magic, channels, flags, pre-skip samples, sample rate, frame count,
+# total samples, offset of the index
+_HEADER = struct.Struct('<8sBBHIIQQ')
+
+# Byte offset and first sample of a packet. The index has one more record
+# than there are packets, marking the end of the data.
+_INDEX_RECORD = struct.Struct('<QQ')
+
+# Ogg page header up to the segment table
+_OGG_PAGE = struct.Struct('<4sBBqIIIB')
+
+# Frame length in 48 kHz samples for each Opus TOC configuration
+_FRAME_SAMPLES = [480, 960, 1920, 2880] * 3 + [480, 960] * 2 + [120, 240, 480, 960] * 4
+
+def packet_samples(packet: bytes) -> int:
+    """
+    Get the number of 48 kHz samples an Opus packet decodes to
+
+    Args:
+        packet: Opus packet
+
+    Returns:
+        Samples per channel, 0 for an empty or malformed packet
+    """
+    if not packet:
+        return 0
+    toc = packet[0]
+    code = toc & 0x03
+    if code == 0:
+        frames = 1
+    elif code in (1, 2):
+        frames = 2
+    elif len(packet) > 1:
+        frames = packet[1] & 0x3F
+    else:
+        return 0
+    return _FRAME_SAMPLES[toc >> 3] * frames
+
+def is_ogg_opus(path: str) -> bool:
+    """Check if a file is an Ogg stream starting with an Opus header"""
+    try:
+        with open(path, 'rb') as f:
+            page = f.read(_OGG_PAGE.size + 255 + 8)
+    except OSError:
+        return False
+    if not page.startswith(b'OggS') or len(page) < _OGG_PAGE.size:
+        return False
+    segments = page[_OGG_PAGE.size - 1]
+    body = _OGG_PAGE.size + segments
+    return page[body:body + 8] == b'OpusHead'
+
+def read_ogg_opus(f: BinaryIO) -> Tuple[int, int, Iterator[bytes]]:
+    """
+    Demultiplex the first Opus stream of an Ogg file
+
+    Args:
+        f: File opened for binary reading
+
+    Returns:
+        Channel count, pre-skip samples and an iterator over the audio packets
+
+    Raises:
+        ValueError: If the file is not Ogg Opus
+    """
+    packets = _ogg_packets(f)
+    head = next(packets, None)
+    if head is None or not head[1].startswith(b'OpusHead') or len(head[1]) < 19:
+        raise ValueError("not an Ogg Opus stream")
+    serial = head[0]
+    channels = head[1][9]
+    pre_skip = struct.unpack_from('<H', head[1], 10)[0]
+
+    def audio() -> Iterator[bytes]:
+        for packet_serial, packet in packets:
+            if packet_serial != serial or packet.startswith(b'OpusTags'):
+                continue
+            yield packet
+
+    return channels, pre_skip, audio()
+
+def _ogg_packets(f: BinaryIO) -> Iterator[Tuple[int, bytes]]:
+    """Yield (serial, packet) for every packet of an Ogg file, in page order"""
+    partial = {}
+    while True:
+        header = f.read(_OGG_PAGE.size)
+        if len(header) < _OGG_PAGE.size:
+            return
+        capture, _, header_type, _, serial, _, _, segments = _OGG_PAGE.unpack(header)
+        if capture != b'OggS':
+            raise ValueError("lost Ogg page sync")
+
+        lacing = f.read(segments)
+        body = f.read(sum(lacing))
+
+        # A continued page extends the packet left open by the previous one
+        buffer = partial.pop(serial, b'') if header_type & 0x01 else b''
+        position = 0
+        for size in lacing:
+            buffer += body[position:position + size]
+            position += size
+            if size < 255:
+                yield serial, buffer
+                buffer = b''
+        if buffer:
+            partial[serial] = buffer
+
+def write_frames(target: str, channels: int, pre_skip: int, packets: Iterator[bytes]) -> int:
+    """
+    Write Opus packets into a frame file with an offset index
+
+    The file is written next to itself and renamed once complete.
+
+    Args:
+        target: Output path
+        channels: Channel count of the stream
+        pre_skip: Samples the decoder drops at the start
+        packets: Opus packets in playback order
+
+    Returns:
+        Number of frames written
+    """
+    part_path = target + ".part"
+    offsets = array('Q')
+    starts = array('Q')
+
+    try:
+        with open(part_path, 'wb') as f:
+            f.write(b'\0' * _HEADER.size)
+            offset = _HEADER.size
+            samples = 0
+            for packet in packets:
+                if not packet:
+                    continue
+                offsets.append(offset)
+                starts.append(samples)
+                f.write(packet)
+                offset += len(packet)
+                samples += packet_samples(packet)
+
+            index = bytearray()
+            for record in zip(offsets, starts):
+                index += _INDEX_RECORD.pack(*record)
+            index += _INDEX_RECORD.pack(offset, samples)
+            f.write(index)
+
+            f.seek(0)
+            f.write(_HEADER.pack(MAGIC, channels, 0, pre_skip, SAMPLE_RATE, len(offsets), samples, offset))
+        os.replace(part_path, target)
+    finally:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+    return len(offsets)
+
+class OpusFrameFile:
+    """
+    Memory-mapped frame file
+
+    Packets are sliced out of the mapping, so the page cache holding a
+    popular track is shared by every chat playing it.
+    """
+
+    def __init__(self, path: str):
+        """
+        Open a frame file
+
+        Args:
+            path: Path of a file written by write_frames
+
+        Raises:
+            ValueError: If the file is not a frame file
+        """
+        self.path = path
+        self._file = open(path, 'rb')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            (magic, self.channels, _, self.pre_skip, self.sample_rate,
+             self.frame_count, self.total_samples, self._index_offset) = _HEADER.unpack_from(self._map, 0)
+            if magic != MAGIC:
+                raise ValueError(f"not an Opus frame file: {path}")
+        except Exception:
+            self.close()
+            raise
+
+    @property
+    def duration(self) -> float:
+        """Playback length in seconds"""
+        return max(0, self.total_samples - self.pre_skip) / self.sample_rate
+
+    def frame(self, index: int) -> bytes:
+        """Get the Opus packet at an index"""
+        start, _ = self._record(index)
+        end, _ = self._record(index + 1)
+        return self._map[start:end]
+
+    def position(self, index: int) -> float:
+        """Get the playback time in seconds at which a frame starts"""
+        _, start = self._record(index)
+        return max(0, start - self.pre_skip) / self.sample_rate
+
+    def frame_at(self, seconds: float) -> int:
+        """
+        Find the frame playing at a time
+
+        Args:
+            seconds: Playback time
+
+        Returns:
+            Frame index, frame_count past the end
+        """
+        target = int(seconds * self.sample_rate) + self.pre_skip
+        if target >= self.total_samples:
+            return self.frame_count
+
+        low, high = 0, self.frame_count - 1
+        while low < high:
+            middle = (low + high + 1) // 2
+            if self._record(middle)[1] <= target:
+                low = middle
+            else:
+                high = middle - 1
+        return low
+
+    def frames(self, start: int = 0) -> Iterator[bytes]:
+        """Iterate over the packets from a frame index on"""
+        for index in range(start, self.frame_count):
+            yield self.frame(index)
+
+    def close(self):
+        """Unmap and close the file"""
+        mapping = getattr(self, '_map', None)
+        if mapping is not None:
+            mapping.close()
+            self._map = None
+        self._file.close()
+
+    def __enter__(self) -> "OpusFrameFile":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _record(self, index: int) -> Tuple[int, int]:
+        if not 0 <= index <= self.frame_count:
+            raise IndexError(f"frame {index} out of range")
+        return _INDEX_RECORD.unpack_from(self._map, self._index_offset + index * _INDEX_RECORD.size)
+
+def open_frames(path: Optional[str]) -> Optional[OpusFrameFile]:
+    """Open a frame file, None if it is missing or unreadable"""
+    if not path:
+        return None
+    try:
+        return OpusFrameFile(path)
+    except (OSError, ValueError):
+        return None
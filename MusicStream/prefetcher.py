@@ -0,0 +1,150 @@
+"""
+Background prefetching of upcoming queue entries
+"""
+
+import asyncio
+import logging
+from typing import Dict, Optional, Set
+
+from config import Config
+from download_scheduler import PRIORITY_PLAY, PRIORITY_PREFETCH
+from song_queue import Song
+
+class Prefetcher:
+    """Downloads and probes the next songs of each chat's queue ahead of playback"""
+
+    def __init__(self, youtube_downloader, queue_manager, music_player,
+                 depth: Optional[int] = None, concurrency: Optional[int] = None):
+        """
+        Initialize prefetcher
+
+        Args:
+            youtube_downloader: YouTubeDownloader used to fetch audio
+            queue_manager: QueueManager whose queues are watched
+            music_player: MusicPlayer used to probe durations
+            depth: Number of songs after the current one to prefetch (defaults to PREFETCH_DEPTH)
+                The current song itself is fetched by the playback path.
+            concurrency: Global cap on concurrent prefetches (defaults to PREFETCH_CONCURRENCY)
+        """
+        self.youtube_downloader = youtube_downloader
+        self.queue_manager = queue_manager
+        self.music_player = music_player
+        self.depth = Config.PREFETCH_DEPTH if depth is None else depth
+        self.concurrency = Config.PREFETCH_CONCURRENCY if concurrency is None else concurrency
+
+        # chat_id -> video_id -> prefetch task
+        self.tasks: Dict[int, Dict[str, asyncio.Task]] = {}
+        # chat_id -> video IDs whose prefetch failed, retried only on demand
+        self.failed: Dict[int, Set[str]] = {}
+
+        self._semaphore = asyncio.Semaphore(max(1, self.concurrency))
+
+        queue_manager.add_listener(self.refresh)
+
+        logging.info(f"Prefetcher initialized (depth={self.depth}, concurrency={self.concurrency})")
+
+    def refresh(self, chat_id: int):
+        """
+        Reconcile prefetch tasks with the current queue of a chat
+
+        Starts tasks for upcoming songs that are not downloaded yet and
+        cancels tasks for songs that left the prefetch window. A task for
+        the song that just became the head keeps running, playback joins
+        it through ensure_ready().
+
+        Args:
+            chat_id: Chat ID whose queue changed
+        """
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            # Queue mutated outside the event loop, nothing to schedule on
+            return
+
+        queue = self.queue_manager.get_queue(chat_id, limit=self.depth + 1)
+        upcoming = queue[1:]
+        failed = self.failed.get(chat_id, set())
+        wanted = {
+            song.video_id: song for song in upcoming
+            if song.video_id and not song.file_path and song.video_id not in failed
+        }
+
+        chat_tasks = self.tasks.setdefault(chat_id, {})
+        head_id = queue[0].video_id if queue else None
+
+        for video_id in list(chat_tasks):
+            if video_id not in wanted and video_id != head_id:
+                chat_tasks.pop(video_id).cancel()
+                logging.info(f"Cancelled prefetch for chat {chat_id}: {video_id}")
+
+        for video_id, song in wanted.items():
+            if video_id not in chat_tasks:
+                task = asyncio.create_task(self._prefetch(chat_id, song))
+                task.add_done_callback(lambda t, c=chat_id, v=video_id: self._forget(c, v, t))
+                chat_tasks[video_id] = task
+
+        if not chat_tasks:
+            self.tasks.pop(chat_id, None)
+        if not queue:
+            self.failed.pop(chat_id, None)
+
+    async def ensure_ready(self, chat_id: int, song: Song) -> Optional[str]:
+        """
+        Get the local file for a song, waiting for or starting its download
+
+        Args:
+            chat_id: Chat ID the song is queued in
+            song: Queued song record
+
+        Returns:
+            Path to the audio file or None if it could not be fetched
+        """
+        if song.file_path:
+            return song.file_path
+
+        # Joins a prefetch download that is already running and promotes
+        # one that is still waiting for a worker
+        self.failed.get(chat_id, set()).discard(song.video_id)
+        return await self._fetch(chat_id, song, PRIORITY_PLAY)
+
+    async def cancel_all(self):
+        """Cancel every running prefetch"""
+        tasks = [task for chat_tasks in self.tasks.values() for task in chat_tasks.values()]
+        for task in tasks:
+            task.cancel()
+
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.tasks.clear()
+        self.failed.clear()
+
+    async def _prefetch(self, chat_id: int, song: Song) -> Optional[str]:
+        """Fetch one upcoming song under the global concurrency cap"""
+        async with self._semaphore:
+            logging.info(f"Prefetching for chat {chat_id}: {song.title}")
+            file_path = await self._fetch(chat_id, song, PRIORITY_PREFETCH)
+
+        if not file_path:
+            self.failed.setdefault(chat_id, set()).add(song.video_id)
+        return file_path
+
+    async def _fetch(self, chat_id: int, song: Song, priority: int) -> Optional[str]:
+        """Download and probe a song and store the results in the queue"""
+        file_path = await self.youtube_downloader.download_audio(song.to_info(), chat_id=chat_id, priority=priority)
+        if not file_path:
+            logging.error(f"Failed to fetch song for chat {chat_id}: {song.title}")
+            return None
+
+        duration = song.duration or await self.music_player.probe_duration(file_path, song.video_id)
+        self.queue_manager.update_songs(chat_id, song.video_id, file_path=file_path, duration=duration)
+        return file_path
+
+    def _forget(self, chat_id: int, video_id: str, task: asyncio.Task):
+        """Drop a finished prefetch task"""
+        chat_tasks = self.tasks.get(chat_id)
+        if chat_tasks and chat_tasks.get(video_id) is task:
+            del chat_tasks[video_id]
+            if not chat_tasks:
+                del self.tasks[chat_id]
+
+        if not task.cancelled() and task.exception():
+            logging.error(f"Prefetch failed for chat {chat_id}: {task.exception()}")
@@ -2,79 +2,295 @@
 Queue management for music playback
 """
 
+import itertools
 import logging
-from typing import Dict, List, Optional
+import os
+import random
+from typing import Callable, Dict, List, Optional, Set
 from collections import defaultdict
 
+import metrics
 from config import Config
+from song_queue import Song, SongQueue
+
+QUEUED = metrics.gauge('musicstream_queued', 'Chats with a queue and songs queued across them', ['kind'])
+QUEUE_DEPTH = metrics.histogram('musicstream_queue_depth', 'Songs in a chat queue after each change',
+                                buckets=(0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000))
 
 class QueueManager:
     """Manages music queues for different chats"""
     
-    def __init__(self):
-        """Initialize queue manager"""
+    def __init__(self, journal=None):
+        """
+        Initialize queue manager
+        
+        Args:
+            journal: Optional QueueJournal that persists queue mutations
+        """
         # Dictionary to store queues for each chat
-        self.queues: Dict[int, List[Dict]] = defaultdict(list)
+        self.queues: Dict[int, SongQueue] = defaultdict(SongQueue)
+        
+        # Source of stable entry IDs, unique across all chats
+        self._entry_ids = itertools.count(1)
+        
+        # Callbacks notified with the chat ID whenever a queue changes
+        self.listeners: List[Callable[[int], None]] = []
+        
+        self.journal = journal
+        if journal is not None:
+            self._recover()
+        
+        QUEUED.set_function(self._queued_counts)
         
         logging.info("Queue manager initialized")
     
-    def add_to_queue(self, chat_id: int, song_info: Dict) -> int:
+    def _recover(self):
+        """Restore queues from the journal"""
+        last_entry_id = 0
+        
+        for chat_id, queue in self.journal.load().items():
+            for song in queue:
+                # Downloads may have been evicted while we were down
+                if song.file_path and not os.path.exists(song.file_path):
+                    song.file_path = None
+                last_entry_id = max(last_entry_id, song.entry_id)
+            self.queues[chat_id] = queue
+        
+        self._entry_ids = itertools.count(last_entry_id + 1)
+    
+    def _record(self, op: Dict):
+        """Persist a queue mutation and compact the journal when it grows too long"""
+        if self.journal is None:
+            return
+        
+        try:
+            self.journal.record(op)
+            if self.journal.ops_since_snapshot >= Config.QUEUE_SNAPSHOT_INTERVAL:
+                self.journal.compact(self.queues)
+        except Exception as e:
+            logging.error(f"Error journaling queue change: {e}")
+    
+    def add_listener(self, callback: Callable[[int], None]):
+        """
+        Register a callback for queue changes
+        
+        Args:
+            callback: Function called with the chat ID after each queue mutation
+        """
+        self.listeners.append(callback)
+    
+    def _queued_counts(self) -> Dict:
+        """Queue gauges, computed on each scrape"""
+        depths = [len(queue) for queue in self.queues.values() if queue]
+        return {('chats',): len(depths), ('songs',): sum(depths)}
+    
+    def _notify(self, chat_id: int):
+        """Notify listeners that a chat's queue changed"""
+        queue = self.queues.get(chat_id)
+        QUEUE_DEPTH.observe(len(queue) if queue is not None else 0)
+        for callback in self.listeners:
+            try:
+                callback(chat_id)
+            except Exception as e:
+                logging.error(f"Error in queue listener: {e}")
+    
+    def add_to_queue(self, chat_id: int, song: Song) -> int:
         """
         Add a song to the queue
         
         Args:
             chat_id: Chat ID
-            song_info: Song information dictionary
+            song: Song record, its entry_id is assigned here
             
         Returns:
             Position in queue (1-based)
         """
         try:
+            queue = self.queues[chat_id]
+            
             # Check queue size limit
-            if len(self.queues[chat_id]) >= Config.MAX_QUEUE_SIZE:
+            if len(queue) >= Config.MAX_QUEUE_SIZE:
                 logging.warning(f"Queue full for chat {chat_id}")
                 return -1
             
             # Add song to queue
-            self.queues[chat_id].append(song_info)
-            position = len(self.queues[chat_id])
+            song.entry_id = next(self._entry_ids)
+            queue.append(song)
+            position = len(queue)
+            self._record({'op': 'add', 'chat': chat_id, 'song': song.to_dict()})
             
-            logging.info(f"Added song to queue for chat {chat_id}: {song_info['title']} (position {position})")
+            logging.info(f"Added song to queue for chat {chat_id}: {song.title} (position {position})")
+            self._notify(chat_id)
             return position
             
         except Exception as e:
             logging.error(f"Error adding song to queue: {e}")
             return -1
     
-    def remove_from_queue(self, chat_id: int, song_info: Dict) -> bool:
+    def add_many(self, chat_id: int, songs: List[Song]) -> List[Song]:
+        """
+        Append several songs to the queue in one journaled operation
+        
+        Songs that do not fit under MAX_QUEUE_SIZE are left out.
+        
+        Args:
+            chat_id: Chat ID
+            songs: Song records, their entry_ids are assigned here
+            
+        Returns:
+            The songs that were added, in queue order
+        """
+        try:
+            queue = self.queues[chat_id]
+            added = songs[:max(0, Config.MAX_QUEUE_SIZE - len(queue))]
+            if not added:
+                logging.warning(f"Queue full for chat {chat_id}")
+                return []
+            
+            for song in added:
+                song.entry_id = next(self._entry_ids)
+            queue.extend(added)
+            self._record({'op': 'add_many', 'chat': chat_id, 'songs': [song.to_dict() for song in added]})
+            
+            logging.info(f"Added {len(added)} songs to queue for chat {chat_id} (now {len(queue)})")
+            self._notify(chat_id)
+            return added
+            
+        except Exception as e:
+            logging.error(f"Error adding songs to queue: {e}")
+            return []
+    
+    def remove_from_queue(self, chat_id: int, song: Song) -> bool:
         """
         Remove a song from the queue
         
         Args:
             chat_id: Chat ID
-            song_info: Song information dictionary
+            song: Queued song record
+            
+        Returns:
+            True if removed, False otherwise
+        """
+        return self.remove_entry(chat_id, song.entry_id)
+    
+    def remove_entry(self, chat_id: int, entry_id: int) -> bool:
+        """
+        Remove a queue entry by its ID
+        
+        Args:
+            chat_id: Chat ID
+            entry_id: Stable entry ID
             
         Returns:
             True if removed, False otherwise
         """
         try:
-            queue = self.queues[chat_id]
+            queue = self.queues.get(chat_id)
+            removed_song = queue.remove(entry_id) if queue is not None else None
             
-            # Find and remove the song
-            for i, song in enumerate(queue):
-                if song['title'] == song_info['title'] and song['url'] == song_info['url']:
-                    removed_song = queue.pop(i)
-                    logging.info(f"Removed song from queue for chat {chat_id}: {removed_song['title']}")
-                    return True
+            if removed_song is None:
+                logging.warning(f"Entry {entry_id} not found in queue for chat {chat_id}")
+                return False
             
-            logging.warning(f"Song not found in queue for chat {chat_id}: {song_info['title']}")
-            return False
+            self._record({'op': 'remove', 'chat': chat_id, 'entry': entry_id})
+            logging.info(f"Removed song from queue for chat {chat_id}: {removed_song.title}")
+            self._notify(chat_id)
+            return True
             
         except Exception as e:
             logging.error(f"Error removing song from queue: {e}")
             return False
     
-    def get_current_song(self, chat_id: int) -> Optional[Dict]:
+    def update_songs(self, chat_id: int, video_id: str, **fields) -> int:
+        """
+        Update fields of every queued entry for a video
+        
+        Used to attach download results to queued songs. This does not
+        change the order of the queue, so listeners are not notified.
+        
+        Args:
+            chat_id: Chat ID
+            video_id: YouTube video ID of the entries to update
+            **fields: Fields to set on each matching entry
+            
+        Returns:
+            Number of updated entries
+        """
+        try:
+            queue = self.queues.get(chat_id)
+            songs = queue.entries_for_video(video_id) if queue is not None else []
+            
+            for song in songs:
+                for field, value in fields.items():
+                    setattr(song, field, value)
+            
+            if songs:
+                self._record({'op': 'update', 'chat': chat_id, 'video_id': video_id, 'fields': fields})
+            return len(songs)
+            
+        except Exception as e:
+            logging.error(f"Error updating songs in queue: {e}")
+            return 0
+    
+    def update_entry(self, chat_id: int, entry_id: int, **fields) -> bool:
+        """
+        Update fields of one queue entry
+        
+        Used to fill in pending entries once their search resolves. The
+        entry may become eligible for prefetching, so listeners are notified.
+        
+        Args:
+            chat_id: Chat ID
+            entry_id: Stable entry ID
+            **fields: Fields to set on the entry
+            
+        Returns:
+            True if updated, False if the entry is no longer queued
+        """
+        try:
+            queue = self.queues.get(chat_id)
+            if queue is None or queue.update(entry_id, **fields) is None:
+                return False
+            
+            self._record({'op': 'update', 'chat': chat_id, 'entry': entry_id, 'fields': fields})
+            self._notify(chat_id)
+            return True
+            
+        except Exception as e:
+            logging.error(f"Error updating queue entry: {e}")
+            return False
+    
+    def get_position(self, chat_id: int, entry_id: int) -> int:
+        """
+        Get the position of a queue entry
+        
+        Args:
+            chat_id: Chat ID
+            entry_id: Stable entry ID
+            
+        Returns:
+            Position in queue (1-based), 0 if the entry is not queued
+        """
+        queue = self.queues.get(chat_id)
+        if queue is None:
+            return 0
+        return queue.position_of(entry_id) + 1
+    
+    def get_active_chats(self) -> List[int]:
+        """
+        Get the chats that have songs queued
+        
+        Returns:
+            List of chat IDs
+        """
+        return [chat_id for chat_id, queue in self.queues.items() if queue]
+    
+    def close(self):
+        """Flush and close the journal"""
+        if self.journal is not None:
+            self.journal.close()
+    
+    def get_current_song(self, chat_id: int) -> Optional[Song]:
         """
         Get the currently playing song (first in queue)
         
@@ -85,10 +301,10 @@ class QueueManager:
             Current song info or None if queue is empty
         """
         try:
-            queue = self.queues[chat_id]
+            queue = self.queues.get(chat_id)
             
             if queue:
-                return queue[0]
+                return queue.head()
             
             return None
             
@@ -96,7 +312,7 @@ class QueueManager:
             logging.error(f"Error getting current song: {e}")
             return None
     
-    def get_next_song(self, chat_id: int) -> Optional[Dict]:
+    def get_next_song(self, chat_id: int) -> Optional[Song]:
         """
         Get the next song in queue (second in queue)
         
@@ -107,10 +323,10 @@ class QueueManager:
             Next song info or None if not available
         """
         try:
-            queue = self.queues[chat_id]
+            queue = self.queues.get(chat_id)
             
-            if len(queue) > 1:
-                return queue[1]
+            if queue is not None and len(queue) > 1:
+                return queue.at(1)
             
             return None
             
@@ -118,23 +334,40 @@ class QueueManager:
             logging.error(f"Error getting next song: {e}")
             return None
     
-    def get_queue(self, chat_id: int) -> List[Dict]:
+    def get_queue(self, chat_id: int, limit: Optional[int] = None) -> List[Song]:
         """
-        Get the full queue for a chat
+        Get the queue for a chat
         
         Args:
             chat_id: Chat ID
+            limit: Maximum number of songs from the front of the queue
             
         Returns:
-            List of song information dictionaries
+            List of song records in queue order
         """
         try:
-            return self.queues[chat_id].copy()
+            queue = self.queues.get(chat_id)
+            if queue is None:
+                return []
+            return list(itertools.islice(queue, limit))
             
         except Exception as e:
             logging.error(f"Error getting queue: {e}")
             return []
     
+    def get_video_ids(self, chat_id: int) -> Set[str]:
+        """
+        Get the videos queued in a chat, including the current one
+        
+        Args:
+            chat_id: Chat ID
+            
+        Returns:
+            Set of video IDs
+        """
+        queue = self.queues.get(chat_id)
+        return queue.video_ids() if queue is not None else set()
+    
     def clear_queue(self, chat_id: int) -> bool:
         """
         Clear the entire queue for a chat
@@ -148,8 +381,10 @@ class QueueManager:
         try:
             if chat_id in self.queues:
                 queue_size = len(self.queues[chat_id])
-                self.queues[chat_id].clear()
+                del self.queues[chat_id]
+                self._record({'op': 'clear', 'chat': chat_id})
                 logging.info(f"Cleared queue for chat {chat_id} ({queue_size} songs)")
+                self._notify(chat_id)
                 return True
             
             return False
@@ -169,7 +404,8 @@ class QueueManager:
             Queue size
         """
         try:
-            return len(self.queues[chat_id])
+            queue = self.queues.get(chat_id)
+            return len(queue) if queue is not None else 0
             
         except Exception as e:
             logging.error(f"Error getting queue size: {e}")
@@ -188,8 +424,8 @@ class QueueManager:
             True if moved, False otherwise
         """
         try:
-            queue = self.queues[chat_id]
-            queue_size = len(queue)
+            queue = self.queues.get(chat_id)
+            queue_size = len(queue) if queue is not None else 0
             
             # Convert to 0-based indexing and validate
             from_idx = from_position - 1
@@ -200,10 +436,11 @@ class QueueManager:
                 return False
             
             # Move the song
-            song = queue.pop(from_idx)
-            queue.insert(to_idx, song)
+            song = queue.move(from_idx, to_idx)
+            self._record({'op': 'move', 'chat': chat_id, 'entry': song.entry_id, 'to': to_idx})
             
-            logging.info(f"Moved song in queue for chat {chat_id}: {song['title']} ({from_position} -> {to_position})")
+            logging.info(f"Moved song in queue for chat {chat_id}: {song.title} ({from_position} -> {to_position})")
+            self._notify(chat_id)
             return True
             
         except Exception as e:
@@ -222,24 +459,28 @@ class QueueManager:
             True if shuffled, False otherwise
         """
         try:
-            import random
-            
-            queue = self.queues[chat_id]
+            queue = self.queues.get(chat_id)
             
-            if len(queue) <= 1:
+            if queue is None or len(queue) <= 1:
                 return False
             
+            # Shuffle entry IDs so the new order can be journaled
+            order = [song.entry_id for song in queue]
+            
             if preserve_current and queue:
                 # Keep current song at front, shuffle the rest
-                current_song = queue[0]
-                remaining_songs = queue[1:]
-                random.shuffle(remaining_songs)
-                self.queues[chat_id] = [current_song] + remaining_songs
+                remaining = order[1:]
+                random.shuffle(remaining)
+                order = order[:1] + remaining
             else:
                 # Shuffle entire queue
-                random.shuffle(queue)
+                random.shuffle(order)
+            
+            queue.reorder(order)
+            self._record({'op': 'shuffle', 'chat': chat_id, 'order': order})
             
             logging.info(f"Shuffled queue for chat {chat_id}")
+            self._notify(chat_id)
             return True
             
         except Exception as e:
@@ -257,13 +498,13 @@ class QueueManager:
             Dictionary with queue status information
         """
         try:
-            queue = self.queues[chat_id]
+            queue = self.queues.get(chat_id) or SongQueue()
             
             return {
                 'size': len(queue),
                 'max_size': Config.MAX_QUEUE_SIZE,
-                'current_song': queue[0] if queue else None,
-                'next_song': queue[1] if len(queue) > 1 else None,
+                'current_song': queue.head(),
+                'next_song': queue.at(1) if len(queue) > 1 else None,
                 'has_more': len(queue) > 2,
                 'is_full': len(queue) >= Config.MAX_QUEUE_SIZE,
             }
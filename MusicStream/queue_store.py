@@ -0,0 +1,257 @@
+"""
+Journaled persistence for chat queues
+"""
+
+import json
+import logging
+import os
+import threading
+from typing import Dict, List, Optional
+
+from config import Config
+from song_queue import Song, SongQueue
+
+def apply_op(queues: Dict[int, SongQueue], op: Dict):
+    """
+    Apply one journaled queue mutation
+
+    Args:
+        queues: Queues to mutate, keyed by chat ID
+        op: Journal record
+    """
+    kind = op['op']
+    chat_id = op['chat']
+
+    if kind == 'clear':
+        queues.pop(chat_id, None)
+        return
+
+    queue = queues.get(chat_id)
+    if queue is None:
+        queue = queues[chat_id] = SongQueue()
+
+    if kind == 'add':
+        queue.append(Song.from_dict(op['song']))
+    elif kind == 'add_many':
+        queue.extend([Song.from_dict(song) for song in op['songs']])
+    elif kind == 'remove':
+        if queue.remove(op['entry']) is None:
+            raise KeyError(op['entry'])
+    elif kind == 'move':
+        if queue.move_entry(op['entry'], op['to']) is None:
+            raise KeyError(op['entry'])
+    elif kind == 'shuffle':
+        queue.reorder(op['order'])
+    elif kind == 'update' and 'entry' in op:
+        if queue.update(op['entry'], **op['fields']) is None:
+            raise KeyError(op['entry'])
+    elif kind == 'update':
+        for song in queue.entries_for_video(op['video_id']):
+            for field, value in op['fields'].items():
+                setattr(song, field, value)
+    else:
+        raise ValueError(f"Unknown journal operation: {kind}")
+
+    if not queue:
+        del queues[chat_id]
+
+class QueueJournal:
+    """Append-only queue journal with batched writes and snapshot compaction"""
+
+    SNAPSHOT_FILE = "queues.snapshot.json"
+    JOURNAL_FILE = "queues.journal"
+
+    def __init__(self, state_dir: Optional[str] = None):
+        """
+        Initialize queue journal
+
+        Args:
+            state_dir: Directory for the snapshot and journal (defaults to STATE_DIR)
+        """
+        self.state_dir = state_dir or Config.STATE_DIR
+        self.snapshot_path = os.path.join(self.state_dir, self.SNAPSHOT_FILE)
+        self.journal_path = os.path.join(self.state_dir, self.JOURNAL_FILE)
+        self.flush_interval = Config.QUEUE_JOURNAL_FLUSH_INTERVAL
+        self.batch_size = Config.QUEUE_JOURNAL_BATCH_SIZE
+
+        # Sequence number of the last recorded operation
+        self.seq = 0
+        # Operations recorded since the last snapshot
+        self.ops_since_snapshot = 0
+
+        self._buffer: List[str] = []
+        self._snapshot: Optional[Dict] = None
+        self._closing = False
+        self._cond = threading.Condition()
+        self._writer: Optional[threading.Thread] = None
+
+        os.makedirs(self.state_dir, exist_ok=True)
+
+    def load(self) -> Dict[int, SongQueue]:
+        """
+        Recover queues from the latest snapshot and the journal behind it
+
+        Returns:
+            Recovered queues keyed by chat ID
+        """
+        queues: Dict[int, SongQueue] = {}
+        snapshot_seq = 0
+
+        try:
+            with open(self.snapshot_path, 'r') as f:
+                snapshot = json.load(f)
+            snapshot_seq = snapshot['seq']
+            queues = {int(chat_id): SongQueue([Song.from_dict(song) for song in songs])
+                      for chat_id, songs in snapshot['queues'].items()}
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logging.error(f"Error loading queue snapshot: {e}")
+
+        self.seq = snapshot_seq
+        replayed = 0
+        # End of the last complete record
+        valid_end = 0
+
+        try:
+            with open(self.journal_path, 'rb') as f:
+                for line in f:
+                    try:
+                        if not line.endswith(b'\n'):
+                            raise ValueError("missing newline")
+                        op = json.loads(line)
+                    except ValueError:
+                        # Torn write at the end of the journal
+                        logging.warning("Ignoring incomplete queue journal record")
+                        break
+                    valid_end += len(line)
+
+                    if op['seq'] <= snapshot_seq:
+                        # Already part of the snapshot
+                        continue
+
+                    try:
+                        apply_op(queues, op)
+                    except (IndexError, KeyError, TypeError, ValueError) as e:
+                        logging.error(f"Skipping invalid queue journal record {op.get('seq')}: {e}")
+                    self.seq = op['seq']
+                    replayed += 1
+
+            if os.path.getsize(self.journal_path) > valid_end:
+                # New records must not be appended behind the torn one,
+                # replay would stop there
+                os.truncate(self.journal_path, valid_end)
+                logging.warning(f"Truncated queue journal to its last complete record ({valid_end} bytes)")
+        except FileNotFoundError:
+            pass
+
+        self.ops_since_snapshot = replayed
+        logging.info(f"Recovered {sum(len(q) for q in queues.values())} queued songs "
+                     f"in {len(queues)} chats ({replayed} journal records replayed)")
+        return queues
+
+    def record(self, op: Dict):
+        """
+        Queue a mutation for the next batched journal write
+
+        Args:
+            op: Journal record without sequence number
+        """
+        with self._cond:
+            self.seq += 1
+            op['seq'] = self.seq
+            self._buffer.append(json.dumps(op, separators=(',', ':')))
+            self.ops_since_snapshot += 1
+
+            if len(self._buffer) == 1 or len(self._buffer) >= self.batch_size:
+                self._cond.notify()
+            self._ensure_writer()
+
+    def compact(self, queues: Dict[int, SongQueue]):
+        """
+        Replace the journal with a snapshot of the current queues
+
+        The queues are copied here, encoding and writing the snapshot
+        happens in the writer thread.
+
+        Args:
+            queues: Current queues keyed by chat ID
+        """
+        data = {str(chat_id): [song.to_dict() for song in queue]
+                for chat_id, queue in queues.items() if queue}
+        with self._cond:
+            self._snapshot = {'seq': self.seq, 'queues': data}
+            # Everything buffered so far is contained in the snapshot
+            self._buffer.clear()
+            self.ops_since_snapshot = 0
+            self._cond.notify()
+            self._ensure_writer()
+
+    def close(self):
+        """Flush pending writes and stop the writer thread"""
+        with self._cond:
+            self._closing = True
+            self._cond.notify()
+            writer = self._writer
+
+        if writer is not None:
+            writer.join()
+        logging.info("Queue journal closed")
+
+    def _ensure_writer(self):
+        """Start the writer thread on first use"""
+        if self._writer is None and not self._closing:
+            self._writer = threading.Thread(target=self._run, name="queue-journal", daemon=True)
+            self._writer.start()
+
+    def _run(self):
+        """Write batches of journal records in the background"""
+        while True:
+            with self._cond:
+                while not (self._buffer or self._snapshot or self._closing):
+                    self._cond.wait()
+
+                if not self._closing and len(self._buffer) < self.batch_size and self._snapshot is None:
+                    # Give concurrent mutations a moment to join this batch
+                    self._cond.wait(self.flush_interval)
+
+                lines, self._buffer = self._buffer, []
+                snapshot, self._snapshot = self._snapshot, None
+                closing = self._closing
+
+            try:
+                if snapshot is not None:
+                    self._write_snapshot(snapshot)
+                if lines:
+                    self._append(lines)
+            except Exception as e:
+                logging.error(f"Error writing queue journal: {e}")
+
+            if closing:
+                with self._cond:
+                    if not (self._buffer or self._snapshot):
+                        return
+
+    def _append(self, lines: List[str]):
+        """Append records to the journal with a single write and fsync"""
+        with open(self.journal_path, 'a') as f:
+            f.write('\n'.join(lines) + '\n')
+            f.flush()
+            if Config.QUEUE_JOURNAL_FSYNC:
+                os.fsync(f.fileno())
+
+    def _write_snapshot(self, snapshot: Dict):
+        """Atomically replace the snapshot, then start a new journal"""
+        tmp_path = self.snapshot_path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(json.dumps(snapshot, separators=(',', ':')))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+
+        # Records up to the snapshot's sequence number are skipped on replay,
+        # so a crash before this truncation is harmless
+        with open(self.journal_path, 'w') as f:
+            f.flush()
+            os.fsync(f.fileno())
+        logging.info("Compacted queue journal into snapshot")
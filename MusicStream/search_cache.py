@@ -0,0 +1,127 @@
+"""
+In-process cache for YouTube search results
+"""
+
+import logging
+import re
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+import metrics
+from config import Config
+
+CACHE_REQUESTS = metrics.counter('musicstream_cache_requests_total', 'Cache lookups', ['cache', 'result'])
+
+# Phrases that do not change which video a search resolves to
+NOISE_PHRASES = (
+    'official music video',
+    'official lyric video',
+    'official video',
+    'official audio',
+    'lyric video',
+    'music video',
+    'lyrics',
+    'lyric',
+    'audio',
+    'hd',
+    'hq',
+)
+
+_PUNCTUATION_RE = re.compile(r'[^\w\s]+', re.UNICODE)
+_NOISE_RE = re.compile(r'\b(?:' + '|'.join(re.escape(p) for p in NOISE_PHRASES) + r')\b')
+_WHITESPACE_RE = re.compile(r'\s+')
+
+def normalize_query(query: str) -> str:
+    """
+    Normalize a search query so near-identical requests share a cache entry
+
+    Args:
+        query: Raw search query
+
+    Returns:
+        Normalized query string
+    """
+    text = query.casefold()
+    text = _PUNCTUATION_RE.sub(' ', text).replace('_', ' ')
+    stripped = _NOISE_RE.sub(' ', text)
+
+    normalized = _WHITESPACE_RE.sub(' ', stripped).strip()
+    if not normalized:
+        # The query consisted only of noise words, keep them
+        normalized = _WHITESPACE_RE.sub(' ', text).strip()
+
+    return normalized
+
+class SearchCache:
+    """TTL cache of search results with a bounded number of entries"""
+
+    def __init__(self, ttl: Optional[float] = None, max_entries: Optional[int] = None):
+        """
+        Initialize search cache
+
+        Args:
+            ttl: Seconds a result stays valid (defaults to SEARCH_CACHE_TTL)
+            max_entries: Maximum number of cached queries (defaults to SEARCH_CACHE_SIZE)
+        """
+        self.ttl = Config.SEARCH_CACHE_TTL if ttl is None else ttl
+        self.max_entries = Config.SEARCH_CACHE_SIZE if max_entries is None else max_entries
+
+        # Normalized key -> (expiry timestamp, result), least recently used first
+        self.entries: "OrderedDict[str, Tuple[float, Dict]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+        logging.info(f"Search cache initialized (ttl={self.ttl}s, max_entries={self.max_entries})")
+
+    def get(self, key: str) -> Optional[Dict]:
+        """
+        Get a cached search result
+
+        Args:
+            key: Normalized query key
+
+        Returns:
+            Copy of the cached result or None on a miss
+        """
+        item = self.entries.get(key)
+        if item is None:
+            self.misses += 1
+            CACHE_REQUESTS.inc(cache='search', result='miss')
+            return None
+
+        expires_at, result = item
+        if expires_at <= time.monotonic():
+            del self.entries[key]
+            self.misses += 1
+            CACHE_REQUESTS.inc(cache='search', result='miss')
+            return None
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        CACHE_REQUESTS.inc(cache='search', result='hit')
+        return dict(result)
+
+    def put(self, key: str, result: Dict):
+        """
+        Store a search result
+
+        Args:
+            key: Normalized query key
+            result: Search result dict
+        """
+        if self.max_entries <= 0 or self.ttl <= 0:
+            return
+
+        self.entries[key] = (time.monotonic() + self.ttl, dict(result))
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        """Drop all cached results"""
+        self.entries.clear()
+
+    def __len__(self) -> int:
+        return len(self.entries)
@@ -0,0 +1,375 @@
+"""
+Multi-process deployment with chats sharded across worker processes
+"""
+
+import asyncio
+import bisect
+import hashlib
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from telegram import Update
+from telegram.ext import Application, ContextTypes, TypeHandler
+
+from config import Config
+from telegram_request import TimedRequest
+from webhook_server import WebhookServer, run_webhook
+
+class HashRing:
+    """Consistent hash ring mapping chat IDs to shard IDs"""
+
+    def __init__(self, nodes: Iterable[int] = (), vnodes: int = 64):
+        """
+        Initialize hash ring
+
+        Args:
+            nodes: Initial shard IDs
+            vnodes: Points on the ring per shard, more points spread chats more evenly
+        """
+        self.vnodes = vnodes
+        self.nodes: List[int] = []
+        self._points: List[int] = []
+        self._owners: List[int] = []
+
+        for node in nodes:
+            self.add(node)
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'big')
+
+    def add(self, node: int):
+        """Add a shard, taking over roughly 1/n of the chats"""
+        if node in self.nodes:
+            return
+
+        self.nodes.append(node)
+        for replica in range(self.vnodes):
+            point = self._hash(f"shard-{node}-{replica}")
+            index = bisect.bisect(self._points, point)
+            self._points.insert(index, point)
+            self._owners.insert(index, node)
+
+    def remove(self, node: int):
+        """Remove a shard, its chats move to the neighbouring points"""
+        if node not in self.nodes:
+            return
+
+        self.nodes.remove(node)
+        kept = [(point, owner) for point, owner in zip(self._points, self._owners) if owner != node]
+        self._points = [point for point, _ in kept]
+        self._owners = [owner for _, owner in kept]
+
+    def node_for(self, chat_id: int) -> int:
+        """Get the shard owning a chat"""
+        if not self._points:
+            raise LookupError("hash ring is empty")
+
+        index = bisect.bisect(self._points, self._hash(str(chat_id))) % len(self._points)
+        return self._owners[index]
+
+def _relay(source: multiprocessing.Queue, name: str) -> asyncio.Queue:
+    """
+    Forward messages of a process queue onto the running event loop
+
+    A dedicated thread blocks on the process queue, so no default executor
+    thread is parked on it for the life of the process. The thread ends
+    after relaying None or a ('stop',) message.
+
+    Args:
+        source: Queue filled by another process
+        name: Name of the reader thread
+
+    Returns:
+        Queue the messages arrive in, in order
+    """
+    loop = asyncio.get_running_loop()
+    target: asyncio.Queue = asyncio.Queue()
+
+    def read():
+        while True:
+            message = source.get()
+            try:
+                loop.call_soon_threadsafe(target.put_nowait, message)
+            except RuntimeError:
+                # The event loop is closed
+                return
+            if message is None or message == ('stop',):
+                return
+
+    threading.Thread(target=read, name=name, daemon=True).start()
+    return target
+
+def run_worker(shard_id: int, inbox: multiprocessing.Queue, outbox: multiprocessing.Queue):
+    """
+    Entry point of a shard worker process
+
+    Args:
+        shard_id: Shard ID, selects the worker's state and download directories
+        inbox: Messages from the supervisor
+        outbox: Messages to the supervisor
+    """
+    logging.basicConfig(
+        format=f'%(asctime)s - shard-{shard_id} - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+
+    # Shards keep their own journal and cache, chats stay on one shard. The
+    # cache index, its byte accounting and the pins of queued tracks live
+    # in the process, so a shared directory would let one shard evict
+    # files another is playing. CACHE_MAX_BYTES applies to each shard.
+    Config.STATE_DIR = os.path.join(Config.STATE_DIR, f"shard-{shard_id}")
+    Config.DOWNLOAD_DIR = os.path.join(Config.DOWNLOAD_DIR, f"shard-{shard_id}")
+    os.makedirs(Config.DOWNLOAD_DIR, exist_ok=True)
+    if Config.METRICS_PORT:
+        # One metrics port per shard, following the supervisor's
+        Config.METRICS_PORT += 1 + shard_id
+
+    try:
+        asyncio.run(_serve_worker(shard_id, inbox, outbox))
+    except KeyboardInterrupt:
+        pass
+
+async def _serve_worker(shard_id: int, inbox: multiprocessing.Queue, outbox: multiprocessing.Queue):
+    """Run a MusicBot fed with updates from the supervisor instead of polling"""
+    from bot import MusicBot
+
+    bot = MusicBot()
+    application = bot.application
+
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+
+    # Let the supervisor know which chats were recovered from our journal
+    outbox.put(('chats', shard_id, bot.queue_manager.get_active_chats()))
+    logging.info(f"Shard {shard_id} ready")
+
+    messages = _relay(inbox, f"shard-{shard_id}-inbox")
+    try:
+        while True:
+            message = await messages.get()
+            kind = message[0]
+
+            if kind == 'update':
+                await application.update_queue.put(Update.de_json(message[1], application.bot))
+            elif kind == 'export':
+                chat_id = message[1]
+                songs = await bot.export_chat(chat_id)
+                outbox.put(('exported', shard_id, chat_id, songs))
+            elif kind == 'import':
+                await bot.import_chat(message[1], message[2])
+            elif kind == 'stop':
+                break
+            else:
+                logging.error(f"Unknown supervisor message: {kind}")
+    finally:
+        await application.stop()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+        await application.shutdown()
+        logging.info(f"Shard {shard_id} stopped")
+
+class ShardSupervisor:
+    """Polls Telegram and routes each update to the worker owning its chat"""
+
+    CHECK_INTERVAL = 5.0
+
+    def __init__(self, shard_count: Optional[int] = None):
+        """
+        Initialize shard supervisor
+
+        Args:
+            shard_count: Number of worker processes (defaults to SHARD_COUNT)
+        """
+        Config.validate()
+
+        self.shard_count = max(1, Config.SHARD_COUNT if shard_count is None else shard_count)
+        self.ring = HashRing(range(self.shard_count))
+
+        # Spawned workers import everything fresh instead of sharing our state
+        self._context = multiprocessing.get_context('spawn')
+        self.workers: Dict[int, multiprocessing.Process] = {}
+        self.inboxes: Dict[int, multiprocessing.Queue] = {}
+        self.outbox = self._context.Queue()
+
+        # chat_id -> shard holding the chat's queue and player state
+        self.chat_shards: Dict[int, int] = {}
+        # chat_id -> (source shard, updates held back until the move completes)
+        self.migrating: Dict[int, Tuple[int, List[Dict]]] = {}
+
+        self._tasks: List[asyncio.Task] = []
+        self._metrics_server: Optional[WebhookServer] = None
+
+        self.application = (
+            Application.builder()
+            .token(Config.BOT_TOKEN)
+            .request(TimedRequest(connection_pool_size=256))
+            .post_init(self._post_init)
+            .post_shutdown(self._post_shutdown)
+            .concurrent_updates(True)
+            .build()
+        )
+        self.application.add_handler(TypeHandler(Update, self._route))
+
+        logging.info(f"Shard supervisor initialized ({self.shard_count} shards)")
+
+    def _start_worker(self, shard_id: int):
+        """Start or restart the process of a shard"""
+        inbox = self._context.Queue()
+        process = self._context.Process(
+            target=run_worker,
+            args=(shard_id, inbox, self.outbox),
+            name=f"shard-{shard_id}",
+            daemon=True,
+        )
+        process.start()
+        self.inboxes[shard_id] = inbox
+        self.workers[shard_id] = process
+        logging.info(f"Started shard {shard_id} (pid {process.pid})")
+
+    async def _route(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Forward an update to the shard of its chat"""
+        chat_id = update.effective_chat.id if update.effective_chat else 0
+        data = update.to_dict()
+
+        if chat_id in self.migrating:
+            self.migrating[chat_id][1].append(data)
+            return
+
+        shard_id = self.chat_shards.get(chat_id)
+        if shard_id is None:
+            shard_id = self.chat_shards[chat_id] = self.ring.node_for(chat_id)
+        self.inboxes[shard_id].put(('update', data))
+
+    def add_worker(self):
+        """Add a shard and move the chats it now owns"""
+        shard_id = self.shard_count
+        self.shard_count += 1
+        self.ring.add(shard_id)
+        self._start_worker(shard_id)
+        self.rebalance()
+
+    def rebalance(self, chat_ids: Optional[Iterable[int]] = None):
+        """
+        Move chats whose state lives on a shard that no longer owns them
+
+        Args:
+            chat_ids: Chats to check, all known chats if not given
+        """
+        moved = 0
+        for chat_id in list(self.chat_shards if chat_ids is None else chat_ids):
+            source = self.chat_shards[chat_id]
+            if chat_id in self.migrating or self.ring.node_for(chat_id) == source:
+                continue
+
+            self.migrating[chat_id] = (source, [])
+            self.inboxes[source].put(('export', chat_id))
+            moved += 1
+
+        if moved:
+            logging.info(f"Rebalancing {moved} chats across {self.shard_count} shards")
+
+    def _handle_message(self, message: Tuple):
+        """Process a message from a worker"""
+        kind = message[0]
+
+        if kind == 'chats':
+            _, shard_id, chat_ids = message
+            for chat_id in chat_ids:
+                self.chat_shards[chat_id] = shard_id
+            self.rebalance(chat_ids)
+
+        elif kind == 'exported':
+            _, shard_id, chat_id, songs = message
+            _, held = self.migrating.pop(chat_id, (shard_id, []))
+            target = self.ring.node_for(chat_id)
+            self.chat_shards[chat_id] = target
+
+            # The inbox is FIFO, so held updates run after the import
+            self.inboxes[target].put(('import', chat_id, songs))
+            for data in held:
+                self.inboxes[target].put(('update', data))
+            logging.info(f"Moved chat {chat_id} from shard {shard_id} to shard {target} ({len(songs)} songs)")
+
+        else:
+            logging.error(f"Unknown worker message: {kind}")
+
+    async def _read_outbox(self):
+        """Handle worker messages on the event loop"""
+        messages = _relay(self.outbox, "shard-outbox")
+        while True:
+            message = await messages.get()
+            if message is None:
+                return
+            try:
+                self._handle_message(message)
+            except Exception as e:
+                logging.error(f"Error handling worker message: {e}")
+
+    async def _watch_workers(self):
+        """Restart workers that died"""
+        while True:
+            await asyncio.sleep(self.CHECK_INTERVAL)
+            for shard_id, process in list(self.workers.items()):
+                if process.is_alive():
+                    continue
+
+                logging.error(f"Shard {shard_id} exited with code {process.exitcode}, restarting")
+                self._start_worker(shard_id)
+
+                # Moves out of the dead shard never completed, its journal
+                # still holds those chats
+                for chat_id, (source, _) in self.migrating.items():
+                    if source == shard_id:
+                        self.inboxes[shard_id].put(('export', chat_id))
+
+    async def _post_init(self, application: Application):
+        """Start the workers and the supervisor's background tasks"""
+        if Config.METRICS_ENABLED and Config.METRICS_PORT:
+            self._metrics_server = WebhookServer(application, port=Config.METRICS_PORT, accept_updates=False)
+            await self._metrics_server.start()
+            self._metrics_server.ready = True
+
+        for shard_id in range(self.shard_count):
+            self._start_worker(shard_id)
+
+        self._tasks = [
+            asyncio.create_task(self._read_outbox()),
+            asyncio.create_task(self._watch_workers()),
+        ]
+
+        if hasattr(signal, 'SIGUSR1'):
+            asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, self.add_worker)
+
+    async def _post_shutdown(self, application: Application):
+        """Stop the workers, letting each flush its journal and cache"""
+        if self._metrics_server is not None:
+            await self._metrics_server.stop()
+
+        for task in self._tasks:
+            task.cancel()
+
+        for inbox in self.inboxes.values():
+            inbox.put(('stop',))
+        for process in self.workers.values():
+            await asyncio.get_running_loop().run_in_executor(None, process.join, 30)
+            if process.is_alive():
+                process.terminate()
+
+        # Unblock the outbox reader thread
+        self.outbox.put(None)
+        logging.info("Shard supervisor stopped")
+
+    def run(self):
+        """Run the supervisor"""
+        logging.info("Starting shard supervisor...")
+        if Config.WEBHOOK_ENABLED:
+            run_webhook(self.application)
+        else:
+            self.application.run_polling()
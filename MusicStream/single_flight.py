@@ -0,0 +1,81 @@
+"""
+Single-flight deduplication of concurrent identical async calls
+"""
+
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+class SingleFlight:
+    """Shares one in-flight task between concurrent callers using the same key"""
+
+    def __init__(self, name: str = "single-flight"):
+        """
+        Initialize single-flight group
+
+        Args:
+            name: Name used in log messages
+        """
+        self.name = name
+        self.tasks: Dict[Hashable, asyncio.Task] = {}
+        self.waiters: Dict[Hashable, int] = {}
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Run func once per key and let every concurrent caller await its result
+
+        Exceptions raised by func propagate to every waiter. Cancelling a
+        waiter only cancels that waiter, the shared task keeps running for
+        the others and is only cancelled once no waiter is left.
+
+        Args:
+            key: Deduplication key
+            func: Zero-argument coroutine function doing the actual work
+
+        Returns:
+            Result of the shared call
+        """
+        task = self.tasks.get(key)
+
+        if task is None:
+            task = asyncio.ensure_future(func())
+            self.tasks[key] = task
+            task.add_done_callback(lambda t: self._forget(key, t))
+        else:
+            logging.info(f"Joining in-flight {self.name} call for {key}")
+
+        self.waiters[key] = self.waiters.get(key, 0) + 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if not task.done() and self.waiters.get(key) == 1 and self.tasks.get(key) is task:
+                # Callers arriving before the task has wound down start afresh
+                del self.tasks[key]
+                task.cancel()
+            raise
+        finally:
+            self._release(key)
+
+    def in_flight(self, key: Hashable) -> bool:
+        """Check if a call for key is currently running"""
+        return key in self.tasks
+
+    def _release(self, key: Hashable):
+        """Drop one waiter of a key"""
+        count = self.waiters.get(key, 0) - 1
+        if count > 0:
+            self.waiters[key] = count
+        else:
+            self.waiters.pop(key, None)
+
+    def _forget(self, key: Hashable, task: asyncio.Task):
+        """Remove a finished task so the next call starts fresh"""
+        if self.tasks.get(key) is task:
+            del self.tasks[key]
+
+        # Mark the exception as retrieved in case every waiter was cancelled
+        if not task.cancelled():
+            task.exception()
+
+    def __len__(self) -> int:
+        return len(self.tasks)
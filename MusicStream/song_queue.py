@@ -0,0 +1,395 @@
+"""
+Compact song records and an indexed queue structure
+"""
+
+import random
+from dataclasses import dataclass
+from typing import Dict, Iterator, List, Optional, Set
+
+@dataclass(slots=True)
+class Song:
+    """A queued song"""
+
+    title: str
+    url: str
+    video_id: Optional[str] = None
+    duration: float = 0
+    uploader: str = 'Unknown'
+    file_path: Optional[str] = None
+    # Search query of an entry that is still being resolved
+    query: Optional[str] = None
+    pending: bool = False
+    # Stable ID of the queue entry, assigned by QueueManager
+    entry_id: int = 0
+
+    @classmethod
+    def from_info(cls, video_info: Dict, **fields) -> "Song":
+        """
+        Create a song from a yt-dlp video info dict
+
+        Args:
+            video_info: Video information dict as returned by YouTubeDownloader
+            **fields: Additional record fields
+
+        Returns:
+            Song record
+        """
+        return cls(
+            title=video_info.get('title', 'Unknown Title'),
+            url=video_info.get('url', ''),
+            video_id=video_info.get('id'),
+            duration=video_info.get('duration') or 0,
+            uploader=video_info.get('uploader', 'Unknown'),
+            **fields,
+        )
+
+    def to_info(self) -> Dict:
+        """Get the video info dict expected by YouTubeDownloader"""
+        return {
+            'id': self.video_id,
+            'title': self.title,
+            'url': self.url,
+            'duration': self.duration,
+            'uploader': self.uploader,
+        }
+
+    def to_dict(self) -> Dict:
+        """Serialize the record"""
+        return {
+            'title': self.title,
+            'url': self.url,
+            'video_id': self.video_id,
+            'duration': self.duration,
+            'uploader': self.uploader,
+            'file_path': self.file_path,
+            'query': self.query,
+            'pending': self.pending,
+            'entry_id': self.entry_id,
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "Song":
+        """Deserialize a record created by to_dict()"""
+        return cls(**data)
+
+class _Node:
+    """Treap node holding one queue entry"""
+
+    __slots__ = ('song', 'priority', 'left', 'right', 'parent', 'size')
+
+    def __init__(self, song: Song):
+        self.song = song
+        self.priority = random.random()
+        self.left: Optional[_Node] = None
+        self.right: Optional[_Node] = None
+        self.parent: Optional[_Node] = None
+        self.size = 1
+
+def _size(node: Optional[_Node]) -> int:
+    return node.size if node is not None else 0
+
+def _update(node: _Node):
+    node.size = 1 + _size(node.left) + _size(node.right)
+
+def _merge(a: Optional[_Node], b: Optional[_Node]) -> Optional[_Node]:
+    """Concatenate two treaps, every entry of a comes before b"""
+    if a is None:
+        return b
+    if b is None:
+        return a
+
+    if a.priority > b.priority:
+        a.right = _merge(a.right, b)
+        a.right.parent = a
+        _update(a)
+        return a
+
+    b.left = _merge(a, b.left)
+    b.left.parent = b
+    _update(b)
+    return b
+
+def _split(node: Optional[_Node], count: int):
+    """Split a treap into its first count entries and the rest"""
+    if node is None:
+        return None, None
+
+    if count <= _size(node.left):
+        left, right = _split(node.left, count)
+        node.left = right
+        if right is not None:
+            right.parent = node
+        if left is not None:
+            left.parent = None
+        _update(node)
+        return left, node
+
+    left, right = _split(node.right, count - _size(node.left) - 1)
+    node.right = left
+    if left is not None:
+        left.parent = node
+    if right is not None:
+        right.parent = None
+    _update(node)
+    return node, right
+
+def _build(nodes: List[_Node]) -> Optional[_Node]:
+    """
+    Build a treap from nodes in queue order in O(n)
+
+    The stack holds the right spine of the tree built so far. A node
+    takes the lower-priority part of the spine as its left subtree, every
+    node leaving the spine is complete and gets its size.
+    """
+    stack: List[_Node] = []
+    for node in nodes:
+        last = None
+        while stack and stack[-1].priority < node.priority:
+            last = stack.pop()
+            _update(last)
+        node.left = last
+        if last is not None:
+            last.parent = node
+        if stack:
+            stack[-1].right = node
+            node.parent = stack[-1]
+        stack.append(node)
+
+    root = stack[0] if stack else None
+    while stack:
+        _update(stack.pop())
+    return root
+
+class SongQueue:
+    """
+    Ordered queue of songs with stable entry IDs
+
+    Entries live in an implicit treap ordered by position, with parent
+    pointers so an entry can be located from its ID. Lookup by ID is O(1),
+    removal by ID, head pop, positional access and moves are O(log n)
+    expected. Building a queue from a list, as on recovery, is O(n).
+    """
+
+    __slots__ = ('_root', '_nodes', '_by_video')
+
+    def __init__(self, songs: Optional[List[Song]] = None):
+        self._root: Optional[_Node] = None
+        self._nodes: Dict[int, _Node] = {}
+        # video_id -> entry IDs, for attaching download results
+        self._by_video: Dict[str, Set[int]] = {}
+
+        if songs:
+            self.extend(songs)
+
+    def __len__(self) -> int:
+        return _size(self._root)
+
+    def __bool__(self) -> bool:
+        return self._root is not None
+
+    def __contains__(self, entry_id: int) -> bool:
+        return entry_id in self._nodes
+
+    def __iter__(self) -> Iterator[Song]:
+        """Iterate over songs in queue order"""
+        stack = []
+        node = self._root
+        while stack or node is not None:
+            while node is not None:
+                stack.append(node)
+                node = node.left
+            node = stack.pop()
+            yield node.song
+            node = node.right
+
+    def append(self, song: Song):
+        """Add a song at the end of the queue"""
+        node = _Node(song)
+        self._index(node)
+        self._root = _merge(self._root, node)
+        self._root.parent = None
+
+    def extend(self, songs: List[Song]):
+        """Add songs at the end of the queue, in O(len(songs)) expected"""
+        nodes = [_Node(song) for song in songs]
+        for node in nodes:
+            self._index(node)
+        self._root = _merge(self._root, _build(nodes))
+        if self._root is not None:
+            self._root.parent = None
+
+    def insert(self, position: int, song: Song):
+        """Insert a song at a 0-based position"""
+        node = _Node(song)
+        self._index(node)
+        self._insert_node(position, node)
+
+    def get(self, entry_id: int) -> Optional[Song]:
+        """Get a song by entry ID"""
+        node = self._nodes.get(entry_id)
+        return node.song if node is not None else None
+
+    def at(self, position: int) -> Song:
+        """Get the song at a 0-based position"""
+        return self._node_at(position).song
+
+    def head(self) -> Optional[Song]:
+        """Get the first song without removing it"""
+        node = self._root
+        if node is None:
+            return None
+        while node.left is not None:
+            node = node.left
+        return node.song
+
+    def popleft(self) -> Optional[Song]:
+        """Remove and return the first song"""
+        song = self.head()
+        if song is not None:
+            self.remove(song.entry_id)
+        return song
+
+    def position_of(self, entry_id: int) -> int:
+        """
+        Get the 0-based position of an entry
+
+        Returns:
+            Position or -1 if the entry is not queued
+        """
+        node = self._nodes.get(entry_id)
+        if node is None:
+            return -1
+
+        position = _size(node.left)
+        while node.parent is not None:
+            if node is node.parent.right:
+                position += _size(node.parent.left) + 1
+            node = node.parent
+        return position
+
+    def remove(self, entry_id: int) -> Optional[Song]:
+        """
+        Remove an entry by ID
+
+        Returns:
+            The removed song or None if it was not queued
+        """
+        node = self._nodes.pop(entry_id, None)
+        if node is None:
+            return None
+
+        self._unindex_video(node.song)
+        self._detach(node)
+        return node.song
+
+    def update(self, entry_id: int, **fields) -> Optional[Song]:
+        """
+        Set fields of an entry
+
+        Returns:
+            The updated song or None if it is not queued
+        """
+        node = self._nodes.get(entry_id)
+        if node is None:
+            return None
+
+        song = node.song
+        self._unindex_video(song)
+        for field, value in fields.items():
+            setattr(song, field, value)
+        if song.video_id:
+            self._by_video.setdefault(song.video_id, set()).add(entry_id)
+        return song
+
+    def move(self, from_position: int, to_position: int) -> Song:
+        """Move the entry at one 0-based position to another"""
+        node = self._node_at(from_position)
+        self._detach(node)
+        self._insert_node(to_position, node)
+        return node.song
+
+    def move_entry(self, entry_id: int, to_position: int) -> Optional[Song]:
+        """Move an entry, given by ID, to a 0-based position"""
+        node = self._nodes.get(entry_id)
+        if node is None:
+            return None
+        self._detach(node)
+        self._insert_node(to_position, node)
+        return node.song
+
+    def reorder(self, entry_ids: List[int]):
+        """Rebuild the queue in the given order of entry IDs"""
+        songs = [self._nodes[entry_id].song for entry_id in entry_ids]
+        self.clear()
+        self.extend(songs)
+
+    def entries_for_video(self, video_id: str) -> List[Song]:
+        """Get every queued entry of a video"""
+        return [self._nodes[entry_id].song for entry_id in self._by_video.get(video_id, ())]
+
+    def video_ids(self) -> Set[str]:
+        """Get the IDs of every queued video"""
+        return set(self._by_video)
+
+    def clear(self):
+        """Remove every entry"""
+        self._root = None
+        self._nodes.clear()
+        self._by_video.clear()
+
+    def _index(self, node: _Node):
+        """Register a new node in the ID indexes"""
+        self._nodes[node.song.entry_id] = node
+        if node.song.video_id:
+            self._by_video.setdefault(node.song.video_id, set()).add(node.song.entry_id)
+
+    def _unindex_video(self, song: Song):
+        """Drop an entry from the video index"""
+        entries = self._by_video.get(song.video_id)
+        if entries is not None:
+            entries.discard(song.entry_id)
+            if not entries:
+                del self._by_video[song.video_id]
+
+    def _node_at(self, position: int) -> _Node:
+        """Find the node at a 0-based position"""
+        if not 0 <= position < len(self):
+            raise IndexError("queue position out of range")
+
+        node = self._root
+        while True:
+            left_size = _size(node.left)
+            if position < left_size:
+                node = node.left
+            elif position == left_size:
+                return node
+            else:
+                position -= left_size + 1
+                node = node.right
+
+    def _insert_node(self, position: int, node: _Node):
+        """Link a detached node in at a 0-based position"""
+        left, right = _split(self._root, position)
+        self._root = _merge(_merge(left, node), right)
+        self._root.parent = None
+
+    def _detach(self, node: _Node):
+        """Unlink a node from the treap, keeping it in the ID index"""
+        replacement = _merge(node.left, node.right)
+        parent = node.parent
+        if replacement is not None:
+            replacement.parent = parent
+
+        if parent is None:
+            self._root = replacement
+        elif parent.left is node:
+            parent.left = replacement
+        else:
+            parent.right = replacement
+
+        while parent is not None:
+            parent.size -= 1
+            parent = parent.parent
+
+        node.left = node.right = node.parent = None
+        node.size = 1
@@ -0,0 +1,54 @@
+"""
+Startup phase timing
+"""
+
+import logging
+import time
+from typing import List, Optional, Tuple
+
+class StartupTimer:
+    """Records when each startup phase ended, relative to process start"""
+
+    def __init__(self, origin: Optional[float] = None):
+        """
+        Initialize startup timer
+
+        Args:
+            origin: perf_counter() value phases are measured from (defaults to now)
+        """
+        self.origin = time.perf_counter() if origin is None else origin
+        self.phases: List[Tuple[str, float]] = []
+
+    def mark(self, phase: str) -> float:
+        """
+        Record the end of a phase
+
+        Args:
+            phase: Phase name, e.g. 'imports'
+
+        Returns:
+            Seconds since the origin
+        """
+        elapsed = time.perf_counter() - self.origin
+        self.phases.append((phase, elapsed))
+        return elapsed
+
+    def has(self, phase: str) -> bool:
+        """Check whether a phase was already recorded"""
+        return any(name == phase for name, _ in self.phases)
+
+    def report(self) -> str:
+        """Format the duration of every phase and the total"""
+        parts = []
+        previous = 0.0
+        for phase, elapsed in self.phases:
+            parts.append(f"{phase} {(elapsed - previous) * 1000:.0f}ms")
+            previous = elapsed
+        return f"Startup timing: {', '.join(parts)} (total {previous * 1000:.0f}ms)"
+
+    def log(self):
+        """Log the report"""
+        logging.info(self.report())
+
+# Started when main.py imports this module, before anything else
+startup_timer = StartupTimer()
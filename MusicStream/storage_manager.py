@@ -0,0 +1,153 @@
+"""
+Disk usage tracking and background eviction of the download directory
+"""
+
+import asyncio
+import logging
+from typing import Dict, Optional, Set
+
+import metrics
+from audio_cache import AudioCache
+from config import Config
+
+EVICTED_BYTES = metrics.counter('musicstream_storage_evicted_bytes_total', 'Bytes removed from the download directory', ['reason'])
+STORAGE = metrics.gauge('musicstream_storage', 'Download directory bytes by state, and pinned tracks', ['state'])
+
+class StorageManager:
+    """
+    Keeps the download directory between watermarks without scanning it
+
+    Sizes and last access times come from the cache index, which is
+    built with one directory scan at startup. Tracks queued or playing
+    in any chat are pinned and never evicted.
+    """
+
+    def __init__(self, cache: AudioCache, queue_manager=None, high_watermark: Optional[float] = None,
+                 low_watermark: Optional[float] = None, interval: Optional[float] = None,
+                 orphan_max_age: Optional[float] = None):
+        """
+        Initialize storage manager
+
+        Args:
+            cache: AudioCache of the download directory
+            queue_manager: QueueManager whose queued tracks are pinned
+            high_watermark: Fraction of the cache budget that triggers eviction (defaults to STORAGE_HIGH_WATERMARK)
+            low_watermark: Fraction of the cache budget eviction frees down to (defaults to STORAGE_LOW_WATERMARK)
+            interval: Seconds between usage checks (defaults to STORAGE_CHECK_INTERVAL)
+            orphan_max_age: Seconds before untracked files are removed (defaults to STORAGE_ORPHAN_MAX_AGE)
+        """
+        self.cache = cache
+        self.queue_manager = queue_manager
+        high = Config.STORAGE_HIGH_WATERMARK if high_watermark is None else high_watermark
+        low = Config.STORAGE_LOW_WATERMARK if low_watermark is None else low_watermark
+        self.high_bytes = int(cache.max_bytes * high)
+        self.low_bytes = int(cache.max_bytes * min(low, high))
+        self.interval = Config.STORAGE_CHECK_INTERVAL if interval is None else interval
+        self.orphan_max_age = Config.STORAGE_ORPHAN_MAX_AGE if orphan_max_age is None else orphan_max_age
+
+        # video_id -> number of chats with the track queued or playing
+        self.pins: Dict[str, int] = {}
+        # chat_id -> video IDs pinned for the chat
+        self._chat_pins: Dict[int, Set[str]] = {}
+
+        self._task: Optional[asyncio.Task] = None
+
+        cache.is_pinned = self.is_pinned
+        if queue_manager is not None:
+            queue_manager.add_listener(self.refresh)
+            # Queues recovered from the journal
+            for chat_id in queue_manager.get_active_chats():
+                self.refresh(chat_id)
+
+        STORAGE.set_function(self._usage_state)
+
+        logging.info(f"Storage manager initialized (high={self.high_bytes}, low={self.low_bytes} bytes)")
+
+    def refresh(self, chat_id: int):
+        """
+        Update the pins of a chat after its queue changed
+
+        Args:
+            chat_id: Chat ID whose queue changed
+        """
+        video_ids = self.queue_manager.get_video_ids(chat_id)
+        old_ids = self._chat_pins.get(chat_id, set())
+
+        for video_id in video_ids - old_ids:
+            self.pins[video_id] = self.pins.get(video_id, 0) + 1
+        for video_id in old_ids - video_ids:
+            count = self.pins.get(video_id, 0) - 1
+            if count > 0:
+                self.pins[video_id] = count
+            else:
+                self.pins.pop(video_id, None)
+
+        if video_ids:
+            self._chat_pins[chat_id] = video_ids
+        else:
+            self._chat_pins.pop(chat_id, None)
+
+    def is_pinned(self, video_id: str) -> bool:
+        """Check if a track is queued or playing in any chat"""
+        return video_id in self.pins
+
+    def usage(self) -> int:
+        """Get the bytes used by cached tracks and untracked files"""
+        return self.cache.total_bytes + self.cache.orphan_bytes()
+
+    def evict(self) -> int:
+        """
+        Remove old untracked files and, above the high watermark, the least
+        recently used unpinned tracks down to the low watermark
+
+        Returns:
+            Number of bytes freed
+        """
+        freed = self.cache.remove_orphans(self.orphan_max_age)
+        EVICTED_BYTES.inc(freed, reason='orphan')
+
+        if self.usage() > self.high_bytes:
+            budget = max(0, self.low_bytes - self.cache.orphan_bytes())
+            evicted = self.cache.evict(budget)
+            EVICTED_BYTES.inc(evicted, reason='watermark')
+            freed += evicted
+
+            if self.usage() > self.high_bytes:
+                logging.warning(f"Download directory still above its high watermark, "
+                                f"{self.usage()} bytes with {len(self.pins)} tracks pinned")
+
+        return freed
+
+    def start(self):
+        """Start the periodic eviction task, checking right away"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the periodic eviction task"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        """Check usage every interval, deleting files off the event loop"""
+        while True:
+            try:
+                freed = await asyncio.to_thread(self.evict)
+                if freed:
+                    logging.info(f"Freed {freed} bytes in the download directory, {self.usage()} bytes used")
+            except Exception as e:
+                logging.error(f"Error evicting downloads: {e}")
+            await asyncio.sleep(self.interval)
+
+    def _usage_state(self) -> Dict:
+        """Storage gauges, computed on each scrape"""
+        return {
+            ('cached',): self.cache.total_bytes,
+            ('untracked',): self.cache.orphan_bytes(),
+            ('pinned_tracks',): len(self.pins),
+        }
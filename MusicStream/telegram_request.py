@@ -0,0 +1,35 @@
+"""
+Bot API transport recording call latency
+"""
+
+import time
+from typing import Optional, Tuple
+
+from telegram.request import HTTPXRequest, RequestData
+
+import metrics
+
+REQUEST_SECONDS = metrics.histogram(
+    'musicstream_telegram_request_seconds', 'Bot API call latency', ['method'])
+REQUESTS = metrics.counter(
+    'musicstream_telegram_requests_total', 'Bot API calls by HTTP status, "error" when no response came', ['method', 'status'])
+
+class TimedRequest(HTTPXRequest):
+    """HTTPXRequest timing every Bot API call by method"""
+
+    async def do_request(self, url: str, method: str, request_data: Optional[RequestData] = None,
+                         *args, **kwargs) -> Tuple[int, bytes]:
+        """Send a request, recording its latency and status"""
+        # Bot API method names are the last path segment, e.g. sendMessage
+        api_method = url.rsplit('/', 1)[-1]
+        started = time.perf_counter()
+        try:
+            status, payload = await super().do_request(url, method, request_data, *args, **kwargs)
+        except Exception:
+            REQUESTS.inc(method=api_method, status='error')
+            raise
+        finally:
+            REQUEST_SECONDS.observe(time.perf_counter() - started, method=api_method)
+
+        REQUESTS.inc(method=api_method, status=str(status))
+        return status, payload
@@ -0,0 +1,16 @@
+"""
+Minimal Ogg Opus writer for test inputs, usable without the bot's modules
+"""
+
+import struct
+
+def _page(serial: int, sequence: int, header_type: int, packet: bytes) -> bytes:
+    header = struct.pack('<4sBBqIIIB', b'OggS', 0, header_type, 0, serial, sequence, 0, 1)
+    return header + bytes([len(packet)]) + packet
+
+def ogg_opus(packets) -> bytes:
+    """Build a stereo Ogg Opus stream holding one packet, shorter than 255 bytes, per page"""
+    head = b'OpusHead' + struct.pack('<BBHIhB', 1, 2, 312, 48000, 0, 0)
+    pages = [_page(7, 0, 0x02, head), _page(7, 1, 0, b'OpusTags' + bytes(8))]
+    pages += [_page(7, index + 2, 0, packet) for index, packet in enumerate(packets)]
+    return b''.join(pages)
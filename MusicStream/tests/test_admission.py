@@ -0,0 +1,84 @@
+"""
+Token bucket rate limits of /play requests
+"""
+
+import pytest
+
+import admission
+from admission import AdmissionController, TokenBucket
+from config import Config
+
+class _Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = _Clock()
+    monkeypatch.setattr(admission.time, 'monotonic', clock)
+    monkeypatch.setattr(Config, 'RATE_LIMIT_USER_RATE', 1.0)
+    monkeypatch.setattr(Config, 'RATE_LIMIT_USER_BURST', 2.0)
+    monkeypatch.setattr(Config, 'RATE_LIMIT_CHAT_RATE', 10.0)
+    monkeypatch.setattr(Config, 'RATE_LIMIT_CHAT_BURST', 100.0)
+    monkeypatch.setattr(Config, 'RATE_LIMIT_GLOBAL_RATE', 1.0)
+    monkeypatch.setattr(Config, 'RATE_LIMIT_GLOBAL_BURST', 4.0)
+    return clock
+
+def test_token_bucket_refills_and_goes_into_debt():
+    bucket = TokenBucket(rate=2.0, burst=3.0, now=0.0)
+
+    assert bucket.delay(3.0, 0.0) == 0.0
+    bucket.take(3.0, 0.0)
+    assert bucket.delay(1.0, 0.0) == pytest.approx(0.5)
+
+    bucket.take(1.0, 0.0)
+    assert bucket.delay(1.0, 0.0) == pytest.approx(1.0)
+    assert not bucket.full(0.0)
+
+    # Refilling stops at the burst size
+    assert bucket.full(10.0)
+    assert bucket.tokens == 3.0
+
+def test_user_limit_defers_then_rejects(clock):
+    controller = AdmissionController(enabled=True, max_delay=1.5, shed_backlog=0)
+
+    assert controller.admit(1, user_id=10).delay == 0
+    assert controller.admit(1, user_id=10).delay == 0
+
+    deferred = controller.admit(1, user_id=10)
+    assert deferred.admitted and deferred.reason == 'user'
+    assert deferred.delay == pytest.approx(1.0)
+
+    rejected = controller.admit(1, user_id=10)
+    assert not rejected.admitted and rejected.reason == 'user'
+    assert rejected.delay == pytest.approx(2.0)
+
+    # Other users of the chat are not held back
+    assert controller.admit(1, user_id=11).delay == 0
+
+    # The deferred request's tokens were taken, the rejected one's were not
+    clock.now += 2.0
+    assert controller.admit(1, user_id=10).delay == 0
+
+def test_backlog_raises_global_cost_and_sheds(clock):
+    saturation = 1.0
+    controller = AdmissionController(saturation=lambda: saturation, enabled=True, max_delay=1.5, shed_backlog=3)
+
+    # Every request costs 2 global tokens while one play download per slot waits
+    assert controller.admit(1).delay == 0
+    assert controller.admit(2).delay == 0
+    rejected = controller.admit(3)
+    assert not rejected.admitted and rejected.reason == 'global'
+
+    saturation = 3.0
+    busy = controller.admit(4)
+    assert not busy.admitted and busy.reason == 'busy'
+
+def test_disabled_controller_admits_everything(clock):
+    controller = AdmissionController(saturation=lambda: 100.0, enabled=False)
+
+    assert all(controller.admit(1, user_id=10).admitted for _ in range(100))
+    assert controller.stats() == {'users': 0, 'chats': 0}
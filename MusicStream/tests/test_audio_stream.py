@@ -0,0 +1,56 @@
+"""
+Progressive streams finish for the cache when nobody plays them
+"""
+
+import asyncio
+import sys
+
+import pytest
+
+from audio_stream import ProgressiveStream
+from config import Config
+
+# Writes 1 MB of audio in 10 kB chunks, then exits
+FAKE_FFMPEG = '''#!{python}
+import sys
+for _ in range(100):
+    sys.stdout.buffer.write(b'x' * 10000)
+'''
+
+@pytest.fixture
+def ffmpeg(tmp_path, monkeypatch):
+    path = tmp_path / 'ffmpeg'
+    path.write_text(FAKE_FFMPEG.format(python=sys.executable))
+    path.chmod(0o755)
+    monkeypatch.setattr(Config, 'FFMPEG_PATH', str(path))
+
+def make_stream(tmp_path):
+    return ProgressiveStream('video', 'http://example.invalid/audio', str(tmp_path / 'video.mp3'),
+                             duration=60, min_buffer=10000, max_ahead=100000)
+
+def test_unplayed_stream_waits_for_a_listener(tmp_path, ffmpeg):
+    async def scenario():
+        stream = make_stream(tmp_path)
+        assert await stream.start()
+        assert await stream.wait_ready(5)
+        await asyncio.sleep(0.3)
+        try:
+            assert not stream.complete.is_set()
+            assert stream.bytes_written < 1000000
+        finally:
+            await stream.cancel()
+
+    asyncio.run(scenario())
+
+def test_released_stream_completes(tmp_path, ffmpeg):
+    async def scenario():
+        stream = make_stream(tmp_path)
+        assert await stream.start()
+        assert await stream.wait_ready(5)
+        await asyncio.sleep(0.1)
+
+        stream.release()
+        assert await asyncio.wait_for(stream.wait_complete(), 5) == str(tmp_path / 'video.mp3')
+        assert stream.bytes_written == 1000000
+
+    asyncio.run(scenario())
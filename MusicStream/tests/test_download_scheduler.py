@@ -0,0 +1,133 @@
+"""
+Download scheduler fairness, wait statistics and cancelled jobs leaving its queues
+"""
+
+import asyncio
+import threading
+
+import download_scheduler
+from download_scheduler import PRIORITY_PLAY, PRIORITY_PREFETCH, DownloadScheduler
+
+async def _blocked_scheduler():
+    """A scheduler with one download slot, taken by a job that waits for the returned event"""
+    scheduler = DownloadScheduler(workers=1, max_in_flight=1)
+    release = threading.Event()
+    running = asyncio.ensure_future(scheduler.run(release.wait, chat_id=0))
+    await asyncio.sleep(0)
+    return scheduler, release, running
+
+def test_cancelled_play_jobs_do_not_count_towards_saturation():
+    async def scenario():
+        scheduler, release, running = await _blocked_scheduler()
+        try:
+            jobs = [asyncio.ensure_future(scheduler.run(lambda: None, chat_id=chat_id, priority=PRIORITY_PLAY))
+                    for chat_id in (1, 1, 2)]
+            await asyncio.sleep(0)
+            assert scheduler.saturation() == 3
+
+            for job in jobs[:2]:
+                job.cancel()
+            await asyncio.sleep(0)
+            assert scheduler.saturation() == 1
+            assert scheduler.stats()['pending'] == 1
+
+            release.set()
+            await running
+            await jobs[2]
+            assert scheduler.saturation() == 0
+        finally:
+            release.set()
+            scheduler.shutdown()
+
+    asyncio.run(scenario())
+
+def test_cancelled_prefetch_is_not_promoted():
+    async def scenario():
+        scheduler, release, running = await _blocked_scheduler()
+        try:
+            prefetches = [asyncio.ensure_future(scheduler.run(lambda: None, chat_id=chat_id,
+                                                              priority=PRIORITY_PREFETCH, key='video'))
+                          for chat_id in range(5)]
+            await asyncio.sleep(0)
+            for prefetch in prefetches:
+                prefetch.cancel()
+            await asyncio.sleep(0)
+
+            # A play request for the same video no longer finds the prefetches
+            assert not scheduler.promote('video')
+            assert scheduler.saturation() == 0
+            assert not any(scheduler.pending)
+        finally:
+            release.set()
+            await running
+            scheduler.shutdown()
+
+    asyncio.run(scenario())
+
+def test_jobs_run_round_robin_across_chats_and_play_before_prefetch():
+    async def scenario():
+        scheduler, release, running = await _blocked_scheduler()
+        order = []
+        try:
+            jobs = [asyncio.ensure_future(scheduler.run(lambda name=name: order.append(name), chat_id=chat_id,
+                                                        priority=priority))
+                    for name, chat_id, priority in (
+                        ('prefetch 1', 1, PRIORITY_PREFETCH),
+                        ('play 1a', 1, PRIORITY_PLAY),
+                        ('play 1b', 1, PRIORITY_PLAY),
+                        ('play 1c', 1, PRIORITY_PLAY),
+                        ('play 2a', 2, PRIORITY_PLAY),
+                        ('play 3a', 3, PRIORITY_PLAY),
+                        ('play 2b', 2, PRIORITY_PLAY),
+                    )]
+            await asyncio.sleep(0)
+
+            release.set()
+            await running
+            await asyncio.gather(*jobs)
+            # A chat with a long queue does not hold back the others
+            assert order == ['play 1a', 'play 2a', 'play 3a', 'play 1b', 'play 2b', 'play 1c', 'prefetch 1']
+        finally:
+            release.set()
+            scheduler.shutdown()
+
+    asyncio.run(scenario())
+
+def test_promoted_prefetch_runs_first_in_its_chat():
+    async def scenario():
+        scheduler, release, running = await _blocked_scheduler()
+        order = []
+        try:
+            jobs = [asyncio.ensure_future(scheduler.run(lambda name=name: order.append(name), chat_id=1,
+                                                        priority=priority, key=name))
+                    for name, priority in (('play', PRIORITY_PLAY), ('prefetch', PRIORITY_PREFETCH))]
+            await asyncio.sleep(0)
+            assert scheduler.promote('prefetch')
+            assert scheduler.saturation() == 2
+
+            release.set()
+            await running
+            await asyncio.gather(*jobs)
+            assert order == ['prefetch', 'play']
+        finally:
+            release.set()
+            scheduler.shutdown()
+
+    asyncio.run(scenario())
+
+def test_wait_stats_are_kept_for_recently_served_chats(monkeypatch):
+    monkeypatch.setattr(download_scheduler, '_WAIT_STATS_CHATS', 3)
+
+    async def scenario():
+        scheduler = DownloadScheduler(workers=1, max_in_flight=1)
+        try:
+            for chat_id in (1, 2, 3, 1, 4):
+                await scheduler.run(lambda: None, chat_id=chat_id)
+
+            assert list(scheduler.wait_stats) == [3, 1, 4]
+            assert scheduler.wait_stats[1]['jobs'] == 2
+            assert set(scheduler.stats()['chats']) == {1, 3, 4}
+        finally:
+            scheduler.shutdown()
+
+    asyncio.run(scenario())
@@ -0,0 +1,133 @@
+"""
+The loudness normalization gain ends up in the Opus frames voice chats play
+"""
+
+import asyncio
+import os
+import sys
+
+import pytest
+
+from audio_processing import encode_opus_frames
+from config import Config
+from music_player import TelegramVoiceChatPlayer
+from ogg import ogg_opus
+from opus_frames import OpusFrameFile
+from youtube_downloader import YouTubeDownloader
+
+# One 20 ms SILK frame per packet (TOC config 3, code 0)
+TOC = bytes([3 << 3])
+
+# Answers loudnorm analyses like a loud master (gain -6.5 dB towards -16 LUFS)
+# and writes Ogg Opus whose packets name the volume filter it was given
+FAKE_FFMPEG = '''#!{python}
+import json, sys
+sys.path.insert(0, {tests!r})
+from ogg import ogg_opus
+args = sys.argv[1:]
+with open({log!r}, 'a') as log:
+    log.write(json.dumps(args) + '\\n')
+if any('loudnorm' in arg for arg in args):
+    sys.stderr.write('{{"input_i": "-9.50", "input_tp": "-0.20", "input_lra": "5.10"}}\\n')
+    sys.exit(0)
+volume = args[args.index('-af') + 1] if '-af' in args else 'none'
+with open(args[-1], 'wb') as f:
+    f.write(ogg_opus([{toc!r} + volume.encode()] * 5))
+'''
+
+@pytest.fixture
+def ffmpeg(tmp_path):
+    """Path of the fake ffmpeg and a function returning the calls it got"""
+    log = tmp_path / 'ffmpeg.log'
+    path = tmp_path / 'ffmpeg'
+    path.write_text(FAKE_FFMPEG.format(python=sys.executable, tests=os.path.dirname(__file__),
+                                       log=str(log), toc=TOC))
+    path.chmod(0o755)
+
+    def calls():
+        return log.read_text().splitlines() if log.exists() else []
+    return str(path), calls
+
+def read_packets(path):
+    with OpusFrameFile(path) as frames:
+        return list(frames.frames())
+
+def test_opus_source_is_repacketized_without_gain(tmp_path, ffmpeg):
+    ffmpeg_path, calls = ffmpeg
+    source = tmp_path / 'track.opus'
+    source.write_bytes(ogg_opus([TOC + b'original'] * 3))
+
+    encode_opus_frames(str(source), str(tmp_path / 'track.frames'), '128k', ffmpeg_path)
+
+    assert calls() == []
+    assert read_packets(str(tmp_path / 'track.frames')) == [TOC + b'original'] * 3
+
+def test_gain_is_encoded_into_the_frames(tmp_path, ffmpeg):
+    ffmpeg_path, calls = ffmpeg
+    source = tmp_path / 'track.opus'
+    source.write_bytes(ogg_opus([TOC + b'original'] * 3))
+
+    encode_opus_frames(str(source), str(tmp_path / 'track.frames'), '128k', ffmpeg_path, gain=-6.5)
+
+    # An Opus source is encoded again rather than passed through unchanged
+    assert len(calls()) == 1 and '"volume=-6.50dB"' in calls()[0]
+    assert read_packets(str(tmp_path / 'track.frames')) == [TOC + b'volume=-6.50dB'] * 5
+
+def test_measured_gain_reaches_the_voice_chat(tmp_path, ffmpeg, monkeypatch):
+    ffmpeg_path, calls = ffmpeg
+    monkeypatch.setattr(Config, 'DOWNLOAD_DIR', str(tmp_path / 'downloads'))
+    monkeypatch.setattr(Config, 'FFMPEG_PATH', ffmpeg_path)
+    monkeypatch.setattr(Config, 'OPUS_FRAMES', True)
+    monkeypatch.setattr(Config, 'LOUDNESS_ANALYSIS', True)
+    monkeypatch.setattr(Config, 'MEDIA_WORKERS', 1)
+    os.makedirs(Config.DOWNLOAD_DIR)
+
+    async def scenario():
+        downloader = YouTubeDownloader()
+        player = TelegramVoiceChatPlayer(downloader.cache)
+        try:
+            file_path = downloader.cache.path_for('loud', 'mp3')
+            with open(file_path, 'wb') as f:
+                f.write(b'not opus')
+            file_path = downloader.cache.put('loud', file_path, duration=1.0, codec='mp3')
+
+            downloader.post_process('loud')
+            assert await downloader._post_tasks[('frames', 'loud')]
+
+            entry = downloader.cache.get_entry('loud')
+            assert entry['loudness']['gain'] == -6.5
+            assert entry['sidecars']['frames']['gain'] == -6.5
+
+            assert await player.play_audio(1, file_path, 1.0)
+            return player.read_frames(1, lead=1.0)
+        finally:
+            await player.cleanup()
+            downloader.close()
+
+    packets = asyncio.run(scenario())
+
+    assert packets and all(packet == TOC + b'volume=-6.50dB' for packet in packets)
+
+def test_loudness_is_not_measured_without_frames(tmp_path, ffmpeg, monkeypatch):
+    ffmpeg_path, calls = ffmpeg
+    monkeypatch.setattr(Config, 'DOWNLOAD_DIR', str(tmp_path / 'downloads'))
+    monkeypatch.setattr(Config, 'FFMPEG_PATH', ffmpeg_path)
+    monkeypatch.setattr(Config, 'OPUS_FRAMES', False)
+    monkeypatch.setattr(Config, 'LOUDNESS_ANALYSIS', True)
+    os.makedirs(Config.DOWNLOAD_DIR)
+
+    async def scenario():
+        downloader = YouTubeDownloader()
+        try:
+            file_path = downloader.cache.path_for('loud', 'mp3')
+            with open(file_path, 'wb') as f:
+                f.write(b'not opus')
+            downloader.cache.put('loud', file_path, duration=1.0, codec='mp3')
+
+            downloader.post_process('loud')
+            assert not downloader._post_tasks
+        finally:
+            downloader.close()
+
+    asyncio.run(scenario())
+    assert calls() == []
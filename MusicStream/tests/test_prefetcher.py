@@ -0,0 +1,69 @@
+"""
+Prefetch downloads survive their song becoming the head of the queue
+"""
+
+import asyncio
+
+from prefetcher import Prefetcher
+from queue_manager import QueueManager
+from song_queue import Song
+
+class GatedDownloader:
+    """Downloads that finish when the test releases them"""
+
+    def __init__(self):
+        self.release = asyncio.Event()
+        self.calls = []
+
+    async def download_audio(self, video_info, chat_id=0, priority=0):
+        self.calls.append((video_info['id'], priority))
+        await self.release.wait()
+        return f"/cache/{video_info['id']}.opus"
+
+class Player:
+    async def probe_duration(self, file_path, video_id=None):
+        return 1.0
+
+def song(video_id):
+    return Song(title=video_id, url='', video_id=video_id, duration=1.0)
+
+def test_prefetch_of_new_head_keeps_running():
+    async def scenario():
+        downloader = GatedDownloader()
+        queues = QueueManager()
+        prefetcher = Prefetcher(downloader, queues, Player(), depth=1, concurrency=2)
+
+        queues.add_to_queue(1, song('first'))
+        queues.add_to_queue(1, song('second'))
+        await asyncio.sleep(0)
+        prefetch = prefetcher.tasks[1]['second']
+
+        # The first song ends while the second is still downloading
+        queues.remove_entry(1, queues.get_current_song(1).entry_id)
+        await asyncio.sleep(0)
+        assert not prefetch.cancelled()
+
+        ready = asyncio.ensure_future(prefetcher.ensure_ready(1, queues.get_current_song(1)))
+        downloader.release.set()
+        assert await ready == '/cache/second.opus'
+        assert await prefetch == '/cache/second.opus'
+        assert queues.get_current_song(1).file_path == '/cache/second.opus'
+
+    asyncio.run(scenario())
+
+def test_prefetch_leaving_the_window_is_cancelled():
+    async def scenario():
+        downloader = GatedDownloader()
+        queues = QueueManager()
+        prefetcher = Prefetcher(downloader, queues, Player(), depth=1, concurrency=2)
+
+        queues.add_to_queue(1, song('first'))
+        queues.add_to_queue(1, song('second'))
+        await asyncio.sleep(0)
+        prefetch = prefetcher.tasks[1]['second']
+
+        queues.remove_entry(1, queues.get_queue(1)[1].entry_id)
+        await asyncio.sleep(0)
+        assert prefetch.cancelled()
+
+    asyncio.run(scenario())
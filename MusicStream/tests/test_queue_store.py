@@ -0,0 +1,67 @@
+"""
+Queues survive restarts through the snapshot and journal
+"""
+
+from queue_manager import QueueManager
+from queue_store import QueueJournal
+from song_queue import Song
+
+def song(title):
+    return Song(title=title, url='', video_id=title)
+
+def titles(queue_manager, chat_id):
+    return [song.title for song in queue_manager.get_queue(chat_id)]
+
+def restart(state_dir):
+    return QueueManager(QueueJournal(str(state_dir)))
+
+def test_mutations_are_recovered(tmp_path):
+    queues = restart(tmp_path)
+    for title in ('a', 'b', 'c', 'd'):
+        queues.add_to_queue(1, song(title))
+    queues.add_many(2, [song('x'), song('y')])
+    queues.remove_entry(1, queues.get_queue(1)[1].entry_id)
+    queues.move_song(1, 3, 1)
+    queues.clear_queue(2)
+    queues.close()
+
+    recovered = restart(tmp_path)
+    assert titles(recovered, 1) == ['d', 'a', 'c']
+    assert recovered.get_active_chats() == [1]
+
+    # Entry IDs keep counting from the recovered ones
+    recovered.add_to_queue(1, song('e'))
+    entry_ids = [song.entry_id for song in recovered.get_queue(1)]
+    assert len(set(entry_ids)) == 4
+    recovered.close()
+
+def test_snapshot_and_later_records_are_recovered(tmp_path):
+    queues = restart(tmp_path)
+    queues.add_many(1, [song(str(index)) for index in range(10)])
+    queues.journal.compact(queues.queues)
+    queues.remove_entry(1, queues.get_current_song(1).entry_id)
+    queues.close()
+
+    recovered = restart(tmp_path)
+    assert titles(recovered, 1) == [str(index) for index in range(1, 10)]
+    recovered.close()
+
+def test_records_after_a_torn_tail_are_recovered(tmp_path):
+    queues = restart(tmp_path)
+    queues.add_to_queue(1, song('a'))
+    queues.add_to_queue(1, song('b'))
+    queues.close()
+
+    # Crash in the middle of writing a record
+    with open(tmp_path / QueueJournal.JOURNAL_FILE, 'a') as f:
+        f.write('{"op":"add","chat":1,"so')
+
+    recovered = restart(tmp_path)
+    assert titles(recovered, 1) == ['a', 'b']
+    recovered.add_to_queue(1, song('c'))
+    recovered.remove_entry(1, recovered.get_current_song(1).entry_id)
+    recovered.close()
+
+    again = restart(tmp_path)
+    assert titles(again, 1) == ['b', 'c']
+    again.close()
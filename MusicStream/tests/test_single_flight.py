@@ -0,0 +1,91 @@
+"""
+Concurrent identical calls share one task
+"""
+
+import asyncio
+
+import pytest
+
+from single_flight import SingleFlight
+
+def test_concurrent_callers_share_one_call():
+    async def scenario():
+        flight = SingleFlight()
+        calls = []
+
+        async def work():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return 'result'
+
+        results = await asyncio.gather(*(flight.do('key', work) for _ in range(5)))
+        assert results == ['result'] * 5
+        assert calls == [1]
+        assert len(flight) == 0
+
+    asyncio.run(scenario())
+
+def test_exception_reaches_every_waiter():
+    async def scenario():
+        flight = SingleFlight()
+
+        async def work():
+            await asyncio.sleep(0)
+            raise ValueError('broken')
+
+        results = await asyncio.gather(*(flight.do('key', work) for _ in range(3)), return_exceptions=True)
+        assert all(isinstance(result, ValueError) for result in results)
+
+    asyncio.run(scenario())
+
+def test_cancelled_waiter_leaves_the_call_to_the_others():
+    async def scenario():
+        flight = SingleFlight()
+        release = asyncio.Event()
+
+        async def work():
+            await release.wait()
+            return 'result'
+
+        first = asyncio.ensure_future(flight.do('key', work))
+        second = asyncio.ensure_future(flight.do('key', work))
+        await asyncio.sleep(0)
+        first.cancel()
+        await asyncio.sleep(0)
+        release.set()
+
+        assert await second == 'result'
+        with pytest.raises(asyncio.CancelledError):
+            await first
+
+    asyncio.run(scenario())
+
+def test_caller_after_last_waiter_cancelled_gets_a_fresh_call():
+    async def scenario():
+        flight = SingleFlight()
+        started = []
+
+        async def work():
+            started.append(1)
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                # Winding down takes a moment
+                await asyncio.sleep(0.01)
+                raise
+            return 'stale'
+
+        async def fresh():
+            return 'fresh'
+
+        waiter = asyncio.ensure_future(flight.do('key', work))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.sleep(0)
+
+        # The cancelled task is still running its cleanup
+        assert await flight.do('key', fresh) == 'fresh'
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+
+    asyncio.run(scenario())
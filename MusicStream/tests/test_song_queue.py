@@ -0,0 +1,109 @@
+"""
+The treap-backed song queue keeps the order of a plain list
+"""
+
+import random
+
+import pytest
+
+from song_queue import Song, SongQueue
+
+def _song(entry_id: int, video_id: str = None) -> Song:
+    return Song(title=f"Song {entry_id}", url='', video_id=video_id or f"video{entry_id % 7}", entry_id=entry_id)
+
+def _check(queue: SongQueue, model: list):
+    assert [song.entry_id for song in queue] == [song.entry_id for song in model]
+    assert len(queue) == len(model)
+    assert bool(queue) == bool(model)
+    assert queue.head() is (model[0] if model else None)
+    for position, song in enumerate(model):
+        assert queue.at(position) is song
+        assert queue.position_of(song.entry_id) == position
+        assert queue.get(song.entry_id) is song
+    assert queue.video_ids() == {song.video_id for song in model}
+
+def test_random_operations_match_a_list():
+    rng = random.Random(7)
+    queue = SongQueue()
+    model = []
+    next_id = 1
+
+    for _ in range(2000):
+        op = rng.choice(['append', 'extend', 'insert', 'remove', 'popleft', 'move', 'move_entry', 'update'])
+        if op == 'append':
+            song = _song(next_id)
+            next_id += 1
+            queue.append(song)
+            model.append(song)
+        elif op == 'extend':
+            songs = [_song(next_id + i) for i in range(rng.randrange(5))]
+            next_id += len(songs)
+            queue.extend(songs)
+            model.extend(songs)
+        elif op == 'insert':
+            song = _song(next_id)
+            next_id += 1
+            position = rng.randrange(len(model) + 1)
+            queue.insert(position, song)
+            model.insert(position, song)
+        elif not model:
+            continue
+        elif op == 'remove':
+            song = rng.choice(model)
+            assert queue.remove(song.entry_id) is song
+            model.remove(song)
+        elif op == 'popleft':
+            assert queue.popleft() is model.pop(0)
+        elif op == 'move':
+            from_position, to_position = rng.randrange(len(model)), rng.randrange(len(model))
+            assert queue.move(from_position, to_position) is model[from_position]
+            model.insert(to_position, model.pop(from_position))
+        elif op == 'move_entry':
+            song, to_position = rng.choice(model), rng.randrange(len(model))
+            assert queue.move_entry(song.entry_id, to_position) is song
+            model.remove(song)
+            model.insert(to_position, song)
+        else:
+            song = rng.choice(model)
+            queue.update(song.entry_id, video_id=f"video{rng.randrange(7)}")
+
+        _check(queue, model)
+
+def test_unknown_entries_and_positions():
+    queue = SongQueue([_song(1), _song(2)])
+
+    assert queue.remove(3) is None
+    assert queue.get(3) is None
+    assert queue.position_of(3) == -1
+    assert queue.move_entry(3, 0) is None
+    assert 3 not in queue and 1 in queue
+    with pytest.raises(IndexError):
+        queue.at(2)
+
+    assert queue.popleft().entry_id == 1
+    assert queue.popleft().entry_id == 2
+    assert queue.popleft() is None
+    _check(queue, [])
+
+def test_video_index_follows_entries():
+    first, second, other = _song(1, 'a'), _song(2, 'a'), _song(3, 'b')
+    queue = SongQueue([first, second, other])
+
+    assert {song.entry_id for song in queue.entries_for_video('a')} == {1, 2}
+    queue.remove(1)
+    assert queue.entries_for_video('a') == [second]
+    queue.update(2, video_id='b')
+    assert queue.entries_for_video('a') == []
+    assert {song.entry_id for song in queue.entries_for_video('b')} == {2, 3}
+    assert queue.video_ids() == {'b'}
+
+def test_reorder_and_clear():
+    songs = [_song(entry_id) for entry_id in range(1, 6)]
+    queue = SongQueue(songs)
+
+    queue.reorder([5, 3, 1, 2, 4])
+    _check(queue, [songs[4], songs[2], songs[0], songs[1], songs[3]])
+
+    queue.clear()
+    _check(queue, [])
+    assert 1 not in queue
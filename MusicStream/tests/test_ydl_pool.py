@@ -0,0 +1,62 @@
+"""
+Pooled YoutubeDL instances are accounted for when building them fails
+"""
+
+import pytest
+
+from ydl_pool import YoutubeDLPool
+
+class _FakeYDL:
+    def __init__(self, options):
+        self.options = options
+        self.closed = False
+
+    def __exit__(self, *exc_info):
+        self.closed = True
+
+def _flaky_factory(failures: int):
+    """A factory that raises on its first calls"""
+    calls = []
+
+    def factory(options):
+        calls.append(options)
+        if len(calls) <= failures:
+            raise OSError("cannot build instance")
+        return _FakeYDL(options)
+
+    return factory
+
+def test_failed_prewarm_releases_its_slot():
+    pool = YoutubeDLPool('test', {}, size=2, factory=_flaky_factory(1))
+
+    with pytest.raises(OSError):
+        pool.prewarm()
+    assert pool.stats()['instances'] == 0
+
+    # The slot can still be filled
+    pool.prewarm()
+    assert pool.stats()['instances'] == 2
+    assert pool.stats()['idle'] == 2
+
+def test_failed_checkout_releases_its_slot():
+    pool = YoutubeDLPool('test', {}, size=1, factory=_flaky_factory(1))
+
+    with pytest.raises(OSError):
+        pool.run(lambda ydl: ydl)
+    assert pool.stats()['instances'] == 0
+    assert isinstance(pool.run(lambda ydl: ydl), _FakeYDL)
+
+def test_instance_built_after_close_is_closed():
+    pool = None
+    built = []
+
+    def factory(options):
+        pool.close()
+        built.append(_FakeYDL(options))
+        return built[-1]
+
+    pool = YoutubeDLPool('test', {}, size=2, factory=factory)
+    pool.prewarm()
+    assert pool.stats()['instances'] == 0
+    assert pool.stats()['idle'] == 0
+    assert [ydl.closed for ydl in built] == [True]
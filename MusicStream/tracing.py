@@ -0,0 +1,351 @@
+"""
+Sampled span tracing of requests through the bot's pipeline
+"""
+
+import collections
+import contextvars
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+import urllib.request
+from contextlib import contextmanager
+from typing import Any, Deque, Dict, List, Optional
+
+from config import Config
+
+# Innermost open span of the running task or thread
+_current: contextvars.ContextVar[Optional["Span"]] = contextvars.ContextVar('trace_span', default=None)
+
+class Span:
+    """A timed stage of a trace"""
+
+    __slots__ = ('trace', 'span_id', 'parent_id', 'name', 'attributes', 'started', 'ended', 'error')
+
+    def __init__(self, trace: "Trace", name: str, parent_id: Optional[str], attributes: Dict[str, Any],
+                 started: Optional[float] = None):
+        self.trace = trace
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.attributes = attributes
+        self.started = time.perf_counter() if started is None else started
+        self.ended: Optional[float] = None
+        self.error: Optional[str] = None
+
+    @property
+    def duration(self) -> float:
+        """Seconds the span took, so far if it is still open"""
+        return (self.ended or time.perf_counter()) - self.started
+
+    def set(self, **attributes):
+        """Add attributes to the span"""
+        self.attributes.update(attributes)
+
+    def end(self):
+        """Close the span"""
+        if self.ended is None:
+            self.ended = time.perf_counter()
+
+    def to_dict(self) -> Dict:
+        """Serialize relative to the start of the trace"""
+        return {
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'start_ms': round((self.started - self.trace.root.started) * 1000, 3),
+            'duration_ms': round(self.duration * 1000, 3),
+            'attributes': self.attributes,
+            'error': self.error,
+        }
+
+class Trace:
+    """One request, made of a root span and the spans of its stages"""
+
+    def __init__(self, tracer: "Tracer", name: str, attributes: Dict[str, Any]):
+        # Correlation ID shown in logs and /slowest
+        self.trace_id = os.urandom(16).hex()
+        self.tracer = tracer
+        self.started_at = time.time()
+        self.root = Span(self, name, None, attributes)
+        self.spans: List[Span] = [self.root]
+
+    @property
+    def name(self) -> str:
+        return self.root.name
+
+    @property
+    def short_id(self) -> str:
+        return self.trace_id[:8]
+
+    @property
+    def duration(self) -> float:
+        return self.root.duration
+
+    def finish(self, error: Optional[str] = None):
+        """End the trace and hand it to the tracer, later calls do nothing"""
+        if self.root.ended is not None:
+            return
+        self.root.error = error
+        self.root.end()
+        self.tracer._finished(self)
+
+    def stages(self) -> Dict[str, float]:
+        """Total seconds per span name, without the root"""
+        totals: Dict[str, float] = collections.defaultdict(float)
+        for span in self.spans[1:]:
+            totals[span.name] += span.duration
+        return dict(totals)
+
+    def summary(self) -> str:
+        """One line with the duration of the trace and its stages"""
+        stages = ', '.join(f"{name} {seconds * 1000:.0f}ms" for name, seconds in self.stages().items())
+        return f"{self.name} {self.short_id} {self.duration * 1000:.0f}ms ({stages or 'no stages'})"
+
+    def to_dict(self) -> Dict:
+        """Serialize for the JSON lines export"""
+        return {
+            'trace_id': self.trace_id,
+            'name': self.name,
+            'started_at': self.started_at,
+            'duration_ms': round(self.duration * 1000, 3),
+            'attributes': self.root.attributes,
+            'error': self.root.error,
+            'spans': [span.to_dict() for span in self.spans[1:]],
+        }
+
+    def to_otlp(self) -> List[Dict]:
+        """Serialize the spans in the OTLP/HTTP JSON encoding"""
+        def nanos(perf_time: float) -> str:
+            return str(int((self.started_at + perf_time - self.root.started) * 1e9))
+
+        spans = []
+        for span in self.spans:
+            otlp_span = {
+                'traceId': self.trace_id,
+                'spanId': span.span_id,
+                'name': span.name,
+                'kind': 1,
+                'startTimeUnixNano': nanos(span.started),
+                'endTimeUnixNano': nanos(span.ended or time.perf_counter()),
+                'attributes': [{'key': key, 'value': _otlp_value(value)} for key, value in span.attributes.items()],
+                'status': {'code': 2, 'message': span.error} if span.error else {'code': 1},
+            }
+            if span.parent_id:
+                otlp_span['parentSpanId'] = span.parent_id
+            spans.append(otlp_span)
+        return spans
+
+class Tracer:
+    """Samples traces, keeps the recent ones and exports them off the event loop"""
+
+    def __init__(self, sample_rate: Optional[float] = None, recent: Optional[int] = None,
+                 file_path: Optional[str] = None, otlp_endpoint: Optional[str] = None,
+                 slow_seconds: Optional[float] = None):
+        """
+        Initialize tracer
+
+        Args:
+            sample_rate: Fraction of requests traced (defaults to TRACE_SAMPLE_RATE)
+            recent: Finished traces kept for slowest() (defaults to TRACE_RECENT)
+            file_path: JSON lines file traces are appended to (defaults to TRACE_FILE)
+            otlp_endpoint: OTLP/HTTP traces URL (defaults to TRACE_OTLP_ENDPOINT)
+            slow_seconds: Traces at least this long are logged (defaults to TRACE_SLOW_SECONDS)
+        """
+        self.sample_rate = Config.TRACE_SAMPLE_RATE if sample_rate is None else sample_rate
+        self.file_path = Config.TRACE_FILE if file_path is None else file_path
+        self.otlp_endpoint = Config.TRACE_OTLP_ENDPOINT if otlp_endpoint is None else otlp_endpoint
+        self.slow_seconds = Config.TRACE_SLOW_SECONDS if slow_seconds is None else slow_seconds
+        self.recent: Deque[Trace] = collections.deque(maxlen=Config.TRACE_RECENT if recent is None else recent)
+
+        self._exports: "queue.SimpleQueue[Optional[Trace]]" = queue.SimpleQueue()
+        self._exporter: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def start_trace(self, name: str, **attributes) -> Optional[Trace]:
+        """
+        Start a sampled trace, activate it with use()
+
+        Returns None when the request was not sampled, spans are then no-ops.
+
+        Args:
+            name: Request name, e.g. 'play'
+            **attributes: Request attributes, e.g. the chat ID
+
+        Returns:
+            The trace or None
+        """
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            return None
+
+        return Trace(self, name, attributes)
+
+    def slowest(self, count: int = 10) -> List[Trace]:
+        """Get the slowest of the recent traces, slowest first"""
+        with self._lock:
+            traces = list(self.recent)
+        return sorted(traces, key=lambda trace: trace.duration, reverse=True)[:count]
+
+    def close(self):
+        """Export the remaining traces and stop the exporter thread"""
+        with self._lock:
+            exporter = self._exporter
+        if exporter is not None:
+            self._exports.put(None)
+            exporter.join(timeout=5)
+
+    def _finished(self, trace: Trace):
+        """Keep a finished trace and queue it for export"""
+        with self._lock:
+            self.recent.append(trace)
+            if (self.file_path or self.otlp_endpoint) and self._exporter is None:
+                self._exporter = threading.Thread(target=self._export_loop, name="trace-export", daemon=True)
+                self._exporter.start()
+
+        if trace.duration >= self.slow_seconds:
+            logging.warning(f"Slow request: {trace.summary()}")
+
+        if self.file_path or self.otlp_endpoint:
+            self._exports.put(trace)
+
+    def _export_loop(self):
+        """Write queued traces in batches"""
+        while True:
+            batch = [self._exports.get()]
+            while len(batch) < 100:
+                try:
+                    batch.append(self._exports.get_nowait())
+                except queue.Empty:
+                    break
+
+            traces = [trace for trace in batch if trace is not None]
+            if traces:
+                try:
+                    self._export(traces)
+                except Exception as e:
+                    logging.error(f"Error exporting {len(traces)} traces: {e}")
+
+            if None in batch:
+                return
+
+    def _export(self, traces: List[Trace]):
+        """Append traces to the JSON lines file and post them to the OTLP endpoint"""
+        if self.file_path:
+            with open(self.file_path, 'a') as f:
+                for trace in traces:
+                    f.write(json.dumps(trace.to_dict()) + '\n')
+
+        if self.otlp_endpoint:
+            body = json.dumps({'resourceSpans': [{
+                'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': 'musicstream'}}]},
+                'scopeSpans': [{
+                    'scope': {'name': 'musicstream'},
+                    'spans': [span for trace in traces for span in trace.to_otlp()],
+                }],
+            }]}).encode()
+            request = urllib.request.Request(self.otlp_endpoint, data=body, headers={'Content-Type': 'application/json'})
+            with urllib.request.urlopen(request, timeout=10) as response:
+                response.read()
+
+def current_trace() -> Optional[Trace]:
+    """Get the trace of the running task or thread, if it is sampled"""
+    span = _current.get()
+    return span.trace if span is not None else None
+
+@contextmanager
+def use(trace: Optional[Trace]):
+    """
+    Make a trace current inside the with block
+
+    Tasks created in the block keep the trace after it exits, so work
+    spawned for a request stays part of it. An exception escaping the
+    block finishes the trace.
+
+    Args:
+        trace: Trace from start_trace, None does nothing
+    """
+    if trace is None:
+        yield
+        return
+
+    token = _current.set(trace.root)
+    try:
+        yield
+    except BaseException as e:
+        trace.finish(error=f"{type(e).__name__}: {e}")
+        raise
+    finally:
+        _current.reset(token)
+
+@contextmanager
+def span(name: str, **attributes):
+    """
+    Time a stage of the current trace
+
+    Yields the span, or None outside a sampled trace.
+
+    Args:
+        name: Stage name, e.g. 'search'
+        **attributes: Stage attributes
+    """
+    parent = _current.get()
+    if parent is None or parent.trace.root.ended is not None:
+        yield None
+        return
+
+    child = Span(parent.trace, name, parent.span_id, attributes)
+    parent.trace.spans.append(child)
+    token = _current.set(child)
+    try:
+        yield child
+    except BaseException as e:
+        child.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        child.end()
+        _current.reset(token)
+
+def record(name: str, seconds: float, **attributes):
+    """
+    Add an already finished stage to the current trace
+
+    Args:
+        name: Stage name
+        seconds: How long the stage took, ending now
+        **attributes: Stage attributes
+    """
+    parent = _current.get()
+    if parent is None or parent.trace.root.ended is not None:
+        return
+
+    now = time.perf_counter()
+    child = Span(parent.trace, name, parent.span_id, attributes, started=now - seconds)
+    child.ended = now
+    parent.trace.spans.append(child)
+
+def finish(error: Optional[str] = None):
+    """Finish the current trace, if there is one"""
+    trace = current_trace()
+    if trace is not None:
+        trace.finish(error)
+
+def annotate(**attributes):
+    """Add attributes to the current span"""
+    current = _current.get()
+    if current is not None:
+        current.set(**attributes)
+
+def _otlp_value(value: Any) -> Dict:
+    """Encode an attribute value as an OTLP AnyValue"""
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+tracer = Tracer()
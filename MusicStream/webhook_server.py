@@ -0,0 +1,381 @@
+"""
+Webhook ingestion through an embedded asyncio HTTP server
+"""
+
+import argparse
+import asyncio
+import hmac
+import itertools
+import json
+import logging
+import signal
+import time
+from typing import Callable, Dict, List, Optional, Set, Tuple
+from urllib.parse import urlsplit
+
+from telegram import Update
+from telegram.ext import Application
+
+import metrics
+from config import Config
+
+SECRET_HEADER = 'x-telegram-bot-api-secret-token'
+
+REASONS = {
+    200: 'OK',
+    400: 'Bad Request',
+    401: 'Unauthorized',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    411: 'Length Required',
+    413: 'Payload Too Large',
+    503: 'Service Unavailable',
+}
+
+class _HttpError(Exception):
+    """Request that cannot be served, answered with the given status"""
+
+    def __init__(self, status: int):
+        super().__init__(status)
+        self.status = status
+
+class WebhookServer:
+    """Minimal HTTP/1.1 server accepting Telegram webhook calls"""
+
+    HEADER_TIMEOUT = 30.0
+
+    def __init__(self, application: Application, host: Optional[str] = None, port: Optional[int] = None,
+                 path: Optional[str] = None, secret_token: Optional[str] = None,
+                 ready_check: Optional[Callable[[], bool]] = None, accept_updates: bool = True,
+                 metrics_token: Optional[str] = None):
+        """
+        Initialize webhook server
+
+        Args:
+            application: Application whose update queue receives the updates
+            host: Interface to listen on (defaults to WEBHOOK_HOST)
+            port: Port to listen on (defaults to PORT)
+            path: Path Telegram posts updates to (defaults to WEBHOOK_PATH)
+            secret_token: Expected secret token header (defaults to WEBHOOK_SECRET)
+            ready_check: Function telling whether the bot can take traffic
+            accept_updates: False to only serve health checks and metrics
+            metrics_token: Bearer token required for /metrics (defaults to METRICS_TOKEN)
+        """
+        self.application = application
+        self.host = Config.WEBHOOK_HOST if host is None else host
+        self.port = Config.PORT if port is None else port
+        self.path = Config.WEBHOOK_PATH if path is None else path
+        self.secret_token = Config.WEBHOOK_SECRET if secret_token is None else secret_token
+        self.ready_check = ready_check or (lambda: self.application.running)
+        self.max_body = Config.WEBHOOK_MAX_BODY
+        self.accept_updates = accept_updates
+        self.metrics_token = Config.METRICS_TOKEN if metrics_token is None else metrics_token
+
+        self.ready = False
+        self.updates_received = 0
+        self.requests_rejected = 0
+
+        self._server: Optional[asyncio.AbstractServer] = None
+        # Open keep-alive connections, closed on shutdown
+        self._connections: Set[asyncio.Task] = set()
+
+    async def start(self):
+        """Start listening"""
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        ports = ', '.join(str(sock.getsockname()[1]) for sock in self._server.sockets)
+        logging.info(f"Webhook server listening on {self.host}:{ports}{self.path if self.accept_updates else ''}")
+
+    @property
+    def bound_port(self) -> int:
+        """Port the server actually listens on, useful when started with port 0"""
+        return self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        """Stop accepting connections"""
+        self.ready = False
+        if self._server is not None:
+            self._server.close()
+            for task in list(self._connections):
+                task.cancel()
+            await asyncio.gather(*self._connections, return_exceptions=True)
+            await self._server.wait_closed()
+            self._server = None
+        logging.info("Webhook server stopped")
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Serve requests on one keep-alive connection"""
+        task = asyncio.current_task()
+        self._connections.add(task)
+        try:
+            while True:
+                request = await self._read_request(reader)
+                if request is None:
+                    break
+
+                method, target, headers, body = request
+                status, text = await self._dispatch(method, urlsplit(target).path, headers, body)
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                self._write_response(writer, status, text, keep_alive)
+                await writer.drain()
+
+                if not keep_alive:
+                    break
+
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError,
+                asyncio.CancelledError, ConnectionError):
+            pass
+        except _HttpError as e:
+            self.requests_rejected += 1
+            self._write_response(writer, e.status, REASONS.get(e.status, ''), False)
+        except Exception as e:
+            logging.error(f"Error serving webhook connection: {e}")
+        finally:
+            self._connections.discard(task)
+            try:
+                writer.close()
+                await writer.wait_closed()
+            except Exception:
+                pass
+
+    async def _read_request(self, reader: asyncio.StreamReader) -> Optional[Tuple[str, str, Dict[str, str], bytes]]:
+        """Read one request, None when the client closed the connection"""
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), self.HEADER_TIMEOUT)
+        except asyncio.IncompleteReadError as e:
+            if not e.partial:
+                return None
+            raise
+
+        lines = head.decode('latin-1').split('\r\n')
+        try:
+            method, target, _ = lines[0].split(' ', 2)
+        except ValueError:
+            raise _HttpError(400)
+
+        headers = {}
+        for line in lines[1:]:
+            if ':' in line:
+                name, value = line.split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+
+        body = b''
+        if method == 'POST':
+            if 'content-length' not in headers:
+                raise _HttpError(411)
+            try:
+                length = int(headers['content-length'])
+            except ValueError:
+                raise _HttpError(400)
+            if length > self.max_body:
+                raise _HttpError(413)
+            body = await reader.readexactly(length)
+
+        return method, target, headers, body
+
+    async def _dispatch(self, method: str, path: str, headers: Dict[str, str], body: bytes) -> Tuple[int, str]:
+        """Route a request, returning status code and response text"""
+        if path == '/healthz':
+            return 200, 'ok'
+
+        if path == '/readyz':
+            if self.ready and self.ready_check():
+                return 200, 'ready'
+            return 503, 'not ready'
+
+        if path == '/metrics' and Config.METRICS_ENABLED:
+            if not self._metrics_allowed(headers):
+                return 404, REASONS[404]
+            return 200, metrics.render()
+
+        if not self.accept_updates or path != self.path:
+            return 404, REASONS[404]
+
+        if method != 'POST':
+            return 405, REASONS[405]
+
+        if not hmac.compare_digest(headers.get(SECRET_HEADER, '').encode(), self.secret_token.encode()):
+            self.requests_rejected += 1
+            logging.warning("Rejected webhook call with a wrong secret token")
+            return 401, REASONS[401]
+
+        try:
+            payload = json.loads(body)
+            # Telegram sends one update per call, local senders may batch them
+            batch = payload if isinstance(payload, list) else [payload]
+            updates = [Update.de_json(data, self.application.bot) for data in batch]
+        except Exception as e:
+            self.requests_rejected += 1
+            logging.warning(f"Rejected malformed webhook payload: {e}")
+            return 400, REASONS[400]
+
+        for update in updates:
+            await self.application.update_queue.put(update)
+        self.updates_received += len(updates)
+        return 200, 'ok'
+
+    def _metrics_allowed(self, headers: Dict[str, str]) -> bool:
+        """
+        Check if a request may read /metrics
+
+        With METRICS_TOKEN set, the request must carry it as a bearer token.
+        Without one, only a metrics-only server on METRICS_PORT serves
+        them, never the public webhook port.
+        """
+        if not self.metrics_token:
+            return not self.accept_updates
+        expected = f"Bearer {self.metrics_token}"
+        return hmac.compare_digest(headers.get('authorization', '').encode(), expected.encode())
+
+    @staticmethod
+    def _write_response(writer: asyncio.StreamWriter, status: int, text: str, keep_alive: bool):
+        """Write a plain text response"""
+        body = text.encode()
+        writer.write(
+            f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\n"
+            f"Content-Type: text/plain; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n"
+            f"\r\n".encode() + body
+        )
+
+def run_webhook(application: Application):
+    """
+    Run an application on the webhook server until SIGINT or SIGTERM
+
+    Registers WEBHOOK_URL with Telegram when it is set, otherwise only
+    the local server runs, e.g. for use with LocalUpdateSender.
+
+    Args:
+        application: Application to feed, with post_init/post_shutdown hooks
+    """
+    asyncio.run(_serve_webhook(application))
+
+async def _serve_webhook(application: Application):
+    """Start the application and the server, then wait for a stop signal"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+
+    server = WebhookServer(application)
+
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    # Listen first, so the application only counts as running once
+    # updates can reach it
+    await server.start()
+    await application.start()
+
+    try:
+        if Config.WEBHOOK_URL:
+            await application.bot.set_webhook(
+                url=Config.WEBHOOK_URL.rstrip('/') + server.path,
+                secret_token=server.secret_token,
+                allowed_updates=Update.ALL_TYPES,
+            )
+            logging.info(f"Registered webhook {Config.WEBHOOK_URL.rstrip('/')}{server.path}")
+
+        server.ready = True
+        await stop.wait()
+
+    finally:
+        await server.stop()
+        await application.stop()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+        await application.shutdown()
+
+class LocalUpdateSender:
+    """Posts synthetic updates to a webhook server, standing in for Telegram"""
+
+    def __init__(self, host: str = '127.0.0.1', port: Optional[int] = None,
+                 path: Optional[str] = None, secret_token: Optional[str] = None):
+        """
+        Initialize local sender
+
+        Args:
+            host: Webhook server host
+            port: Webhook server port (defaults to PORT)
+            path: Webhook path (defaults to WEBHOOK_PATH)
+            secret_token: Secret token to send (defaults to WEBHOOK_SECRET)
+        """
+        self.host = host
+        self.port = Config.PORT if port is None else port
+        self.path = Config.WEBHOOK_PATH if path is None else path
+        self.secret_token = Config.WEBHOOK_SECRET if secret_token is None else secret_token
+
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+
+    def command_update(self, chat_id: int, text: str, user_id: Optional[int] = None) -> Dict:
+        """
+        Build a minimal message update carrying a bot command
+
+        Args:
+            chat_id: Group chat ID
+            text: Message text, e.g. '/play song name'
+            user_id: Sender ID (defaults to the chat ID)
+
+        Returns:
+            Update dict as Telegram would send it
+        """
+        command_length = len(text.split(' ', 1)[0]) if text.startswith('/') else 0
+        message = {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'group', 'title': f"Chat {chat_id}"},
+            'from': {'id': user_id or abs(chat_id), 'is_bot': False, 'first_name': 'Local'},
+            'text': text,
+        }
+        if command_length:
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': command_length}]
+        return {'update_id': next(self._update_ids), 'message': message}
+
+    async def send(self, updates: List[Dict]) -> int:
+        """
+        Post a batch of updates in one request
+
+        Args:
+            updates: Update dicts
+
+        Returns:
+            HTTP status code of the response
+        """
+        body = json.dumps(updates).encode()
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            writer.write(
+                f"POST {self.path} HTTP/1.1\r\n"
+                f"Host: {self.host}\r\n"
+                f"Content-Type: application/json\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"{SECRET_HEADER}: {self.secret_token}\r\n"
+                f"Connection: close\r\n"
+                f"\r\n".encode() + body
+            )
+            await writer.drain()
+            status_line = await reader.readline()
+            return int(status_line.split()[1])
+        finally:
+            writer.close()
+            await writer.wait_closed()
+
+def main():
+    """Send commands to a locally running webhook server"""
+    parser = argparse.ArgumentParser(description="Send synthetic updates to the webhook server")
+    parser.add_argument('--chat', type=int, default=-1001, help="Chat ID the commands come from")
+    parser.add_argument('--port', type=int, default=None, help="Webhook server port")
+    parser.add_argument('commands', nargs='+', help="Command texts, e.g. '/play song name'")
+    args = parser.parse_args()
+
+    sender = LocalUpdateSender(port=args.port)
+    updates = [sender.command_update(args.chat, text) for text in args.commands]
+    status = asyncio.run(sender.send(updates))
+    print(f"Sent {len(updates)} updates: HTTP {status}")
+
+if __name__ == "__main__":
+    main()
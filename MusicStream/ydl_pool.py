@@ -0,0 +1,234 @@
+"""
+Pools of long-lived, pre-configured YoutubeDL instances
+"""
+
+import collections
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Deque, Dict, Optional
+
+from config import Config
+
+_yt_dlp = None
+
+def load_yt_dlp():
+    """Import yt-dlp on first use, loading it and its extractors dominates startup"""
+    global _yt_dlp
+    if _yt_dlp is None:
+        import yt_dlp
+        _yt_dlp = yt_dlp
+    return _yt_dlp
+
+class _Member:
+    """A pooled YoutubeDL instance and its usage record"""
+
+    __slots__ = ('ydl', 'uses', 'created', 'last_used', 'broken')
+
+    def __init__(self, ydl):
+        self.ydl = ydl
+        self.uses = 0
+        self.created = time.monotonic()
+        self.last_used = self.created
+        self.broken = False
+
+class YoutubeDLPool:
+    """
+    Bounded pool of YoutubeDL instances sharing one options profile
+
+    Building a YoutubeDL loads its extractors and postprocessors, so
+    instances are reused across calls. Each checkout gets an instance to
+    itself, checkouts block while every instance is busy. Instances are
+    recycled after max_uses calls, after max_idle seconds unused and
+    after an unexpected error.
+    """
+
+    def __init__(self, name: str, options: Dict, size: int,
+                 max_uses: Optional[int] = None, max_idle: Optional[float] = None,
+                 factory: Optional[Callable[[Dict], Any]] = None):
+        """
+        Initialize pool
+
+        Args:
+            name: Profile name used in logs
+            options: YoutubeDL options of every instance
+            size: Maximum number of instances
+            max_uses: Calls before an instance is recycled (defaults to YDL_MAX_USES)
+            max_idle: Idle seconds before an instance is recycled (defaults to YDL_MAX_IDLE)
+            factory: Function building an instance from options (defaults to yt_dlp.YoutubeDL, imported on first use)
+        """
+        self.name = name
+        self.options = options
+        self.size = max(1, size)
+        self.max_uses = Config.YDL_MAX_USES if max_uses is None else max_uses
+        self.max_idle = Config.YDL_MAX_IDLE if max_idle is None else max_idle
+        self.factory = factory
+
+        self._idle: Deque[_Member] = collections.deque()
+        self._total = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+        self.created = 0
+        self.recycled = 0
+        self.checkouts = 0
+
+    def run(self, func: Callable[[Any], Any]) -> Any:
+        """
+        Call a function with a checked out instance, blocking
+
+        Args:
+            func: Function taking the YoutubeDL instance
+
+        Returns:
+            The function's result
+        """
+        with self.checkout() as ydl:
+            return func(ydl)
+
+    @contextmanager
+    def checkout(self):
+        """Borrow an instance for the duration of the with block"""
+        member = self._acquire()
+        try:
+            yield member.ydl
+        except BaseException as e:
+            # Failures of single videos leave the instance usable
+            if _yt_dlp is None or not isinstance(e, _yt_dlp.utils.DownloadError):
+                member.broken = True
+            raise
+        finally:
+            self._release(member)
+
+    def prewarm(self, count: Optional[int] = None):
+        """
+        Build idle instances ahead of the first calls, blocking
+
+        Args:
+            count: Instances to have ready (defaults to the pool size)
+        """
+        target = min(self.size, self.size if count is None else count)
+        while True:
+            with self._cond:
+                if self._closed or self._total >= target:
+                    return
+                self._total += 1
+
+            try:
+                member = self._create()
+            except BaseException:
+                with self._cond:
+                    self._total -= 1
+                    self._cond.notify()
+                raise
+
+            with self._cond:
+                closed = self._closed
+                if closed:
+                    self._total -= 1
+                else:
+                    self._idle.append(member)
+                self._cond.notify()
+
+            if closed:
+                # Closed while building, close() only saw the idle instances
+                self._destroy(member)
+                return
+
+    def close(self):
+        """Close every idle instance, busy ones are closed on return"""
+        with self._cond:
+            self._closed = True
+            members = list(self._idle)
+            self._idle.clear()
+            self._total -= len(members)
+            self._cond.notify_all()
+
+        for member in members:
+            self._destroy(member)
+
+    def stats(self) -> Dict[str, int]:
+        """Get the pool's size and usage counters"""
+        with self._cond:
+            return {
+                'size': self.size,
+                'instances': self._total,
+                'idle': len(self._idle),
+                'created': self.created,
+                'recycled': self.recycled,
+                'checkouts': self.checkouts,
+            }
+
+    def _acquire(self) -> _Member:
+        """Take a healthy idle instance, create one, or wait for one to return"""
+        while True:
+            stale = None
+            with self._cond:
+                if self._closed:
+                    raise RuntimeError(f"YoutubeDL pool {self.name} is closed")
+
+                if self._idle:
+                    member = self._idle.pop()
+                    if self._healthy(member):
+                        self.checkouts += 1
+                        return member
+                    stale = member
+                    self._total -= 1
+                    self.recycled += 1
+                elif self._total < self.size:
+                    self._total += 1
+                    self.checkouts += 1
+                else:
+                    self._cond.wait()
+                    continue
+
+            if stale is not None:
+                self._destroy(stale)
+                continue
+
+            try:
+                return self._create()
+            except BaseException:
+                with self._cond:
+                    self._total -= 1
+                    self._cond.notify()
+                raise
+
+    def _release(self, member: _Member):
+        """Return an instance, recycling it when it is used up or broken"""
+        member.uses += 1
+        member.last_used = time.monotonic()
+
+        with self._cond:
+            keep = not self._closed and not member.broken and member.uses < self.max_uses
+            if keep:
+                self._idle.append(member)
+            else:
+                self._total -= 1
+                self.recycled += 1
+            self._cond.notify()
+
+        if not keep:
+            self._destroy(member)
+
+    def _healthy(self, member: _Member) -> bool:
+        """Check an idle instance before handing it out"""
+        return (not member.broken
+                and member.uses < self.max_uses
+                and time.monotonic() - member.last_used < self.max_idle)
+
+    def _create(self) -> _Member:
+        """Build a new instance"""
+        factory = self.factory or load_yt_dlp().YoutubeDL
+        member = _Member(factory(dict(self.options)))
+        with self._cond:
+            self.created += 1
+        return member
+
+    def _destroy(self, member: _Member):
+        """Close an instance, saving cookies and releasing its connections"""
+        try:
+            member.ydl.__exit__(None, None, None)
+        except Exception as e:
+            logging.error(f"Error closing YoutubeDL instance of pool {self.name}: {e}")
@@ -3,25 +3,105 @@ YouTube downloader using yt-dlp
 """
 
 import asyncio
+import contextvars
+import importlib.util
 import logging
 import os
 import tempfile
-from typing import Dict, Optional
-try:
-    import yt_dlp
-except ImportError:
-    yt_dlp = None
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+# yt-dlp itself is imported by the YoutubeDL pools on first use
+YT_DLP_AVAILABLE = importlib.util.find_spec("yt_dlp") is not None
+if not YT_DLP_AVAILABLE:
     logging.warning("yt-dlp not available - YouTube functionality will be limited")
 
 from pathlib import Path
+import loudness
+import metrics
+import tracing
+from audio_cache import AudioCache
+from audio_processing import (
+    CODEC_EXTENSIONS, ENCODERS, MediaProcessPool, codec_family, convert_audio, encode_opus_frames
+)
+from audio_stream import ProgressiveStream, STREAM_FORMATS
 from config import Config
+from download_scheduler import DownloadScheduler, PRIORITY_PLAY
+from search_cache import SearchCache, normalize_query
+from single_flight import SingleFlight
+from ydl_pool import YoutubeDLPool
+
+SEARCH_SECONDS = metrics.histogram('musicstream_search_seconds', 'YouTube search latency')
+SEARCHES_IN_FLIGHT = metrics.gauge('musicstream_searches_in_flight', 'YouTube searches running or waiting for a search thread')
+DOWNLOAD_SECONDS = metrics.histogram('musicstream_download_seconds', 'Download time on a worker thread, including transcoding', ['result'])
+DOWNLOAD_BYTES = metrics.counter('musicstream_download_bytes_total', 'Audio bytes written to the cache', ['source'])
+TRANSCODE_SECONDS = metrics.histogram('musicstream_transcode_seconds', 'Time spent in yt-dlp postprocessors', ['postprocessor'])
+DOWNLOAD_WORKERS = metrics.gauge('musicstream_download_scheduler', 'Download scheduler saturation', ['state'])
+STREAMS = metrics.gauge('musicstream_streams_downloading', 'Progressive streams still being written')
+
+# yt-dlp format filter selecting each codec family
+_CODEC_FILTERS = {
+    'opus': '[acodec^=opus]',
+    'aac': '[acodec^=mp4a]',
+    'mp3': '[acodec^=mp3]',
+    'vorbis': '[acodec^=vorbis]',
+}
+
+def playable_codecs() -> List[str]:
+    """Codec families from PLAYABLE_CODECS that are kept without transcoding"""
+    return [codec.strip() for codec in Config.PLAYABLE_CODECS.split(',') if codec.strip() in _CODEC_FILTERS]
+
+def audio_format_selector() -> str:
+    """yt-dlp format selector preferring audio-only streams in a playable codec"""
+    preferred = [f"bestaudio{_CODEC_FILTERS[codec]}" for codec in playable_codecs()]
+    return '/'.join(preferred + ['bestaudio', 'best'])
+
+# Start time of the running postprocessor, per download thread
+_postprocessor_started = threading.local()
+
+def _time_postprocessor(status: Dict):
+    """yt-dlp postprocessor hook timing FFmpegExtractAudio and friends"""
+    if status.get('status') == 'started':
+        _postprocessor_started.value = time.perf_counter()
+    elif status.get('status') == 'finished':
+        started = getattr(_postprocessor_started, 'value', None)
+        if started is not None:
+            elapsed = time.perf_counter() - started
+            postprocessor = status.get('postprocessor') or 'unknown'
+            TRANSCODE_SECONDS.observe(elapsed, postprocessor=postprocessor)
+            tracing.record('transcode', elapsed, postprocessor=postprocessor)
+            _postprocessor_started.value = None
 
 class YouTubeDownloader:
     """Handles YouTube search and download functionality"""
     
     def __init__(self):
         """Initialize YouTube downloader"""
-        self.ydl_available = yt_dlp is not None
+        self.ydl_available = YT_DLP_AVAILABLE
+        self.cache = AudioCache()
+        self.search_cache = SearchCache()
+        
+        # Concurrent identical searches and downloads share one task
+        self._search_flight = SingleFlight("search")
+        self._download_flight = SingleFlight("download")
+        
+        # Blocking yt-dlp calls stay off the loop's default executor
+        self.scheduler = DownloadScheduler()
+        self.search_executor = ThreadPoolExecutor(max_workers=Config.SEARCH_WORKERS, thread_name_prefix="search")
+        # Remuxing and transcoding run in worker processes
+        self.media_pool = MediaProcessPool()
+        
+        # Post-download stages running in the background, by (stage, video ID),
+        # and the ones that failed, not retried until a restart
+        self._post_tasks: Dict[Tuple[str, str], asyncio.Task] = {}
+        self._post_failed: Set[Tuple[str, str]] = set()
+        
+        # Progressive streams still being written, by video ID
+        self.streams: Dict[str, ProgressiveStream] = {}
+        # Downloads replacing streams that broke off, kept until they finish
+        self._fallback_tasks: Set[asyncio.Task] = set()
         
         if self.ydl_available:
             self.ydl_opts = {
@@ -29,7 +109,7 @@ class YouTubeDownloader:
                 'extractaudio': True,
                 'audioformat': Config.AUDIO_FORMAT,
                 'audioquality': Config.AUDIO_BITRATE,
-                'outtmpl': os.path.join(Config.DOWNLOAD_DIR, '%(title)s.%(ext)s'),
+                'outtmpl': os.path.join(Config.DOWNLOAD_DIR, '%(id)s.%(ext)s'),
                 'noplaylist': True,
                 'no_warnings': True,
                 'quiet': True,
@@ -48,8 +128,38 @@ class YouTubeDownloader:
                 }],
                 'ffmpeg_location': Config.FFMPEG_PATH,
             }
+            
+            # Long-lived YoutubeDL instances, one pool per options profile
+            stream_opts = {key: value for key, value in self.ydl_opts.items() if key != 'postprocessors'}
+            self.search_pool = YoutubeDLPool('search', {
+                **stream_opts,
+                'extract_flat': True,
+                'default_search': 'ytsearch',
+            }, Config.SEARCH_WORKERS)
+            download_opts = {
+                **self.ydl_opts,
+                'outtmpl': os.path.join(self.cache.cache_dir, '%(id)s.%(ext)s'),
+                'postprocessor_hooks': [_time_postprocessor],
+            }
+            if Config.TRANSCODE_FREE:
+                # Download the stream as served, _finish_audio remuxes it or
+                # transcodes it only if its codec is not playable
+                download_opts.update({'format': audio_format_selector(), 'postprocessors': []})
+            self.download_pool = YoutubeDLPool('download', download_opts, Config.DOWNLOAD_WORKERS)
+            self.stream_pool = YoutubeDLPool('stream', stream_opts, Config.DOWNLOAD_WORKERS)
+            # Lists playlist entries without resolving each video
+            self.playlist_pool = YoutubeDLPool('playlist', {
+                **stream_opts,
+                'noplaylist': False,
+                'extract_flat': 'in_playlist',
+                'playlistend': Config.PLAYLIST_MAX_SONGS,
+            }, Config.SEARCH_WORKERS)
         else:
             self.ydl_opts = {}
+            self.search_pool = self.download_pool = self.stream_pool = self.playlist_pool = None
+        
+        DOWNLOAD_WORKERS.set_function(self._scheduler_state)
+        STREAMS.set_function(lambda: len(self.streams))
         
         logging.info("YouTube downloader initialized")
     
@@ -68,39 +178,112 @@ class YouTubeDownloader:
             logging.error("yt-dlp not available for YouTube search")
             return self._create_demo_result(query)
         
-        try:
-            # Create search options
-            search_opts = self.ydl_opts.copy()
-            search_opts.update({
-                'quiet': True,
-                'no_warnings': True,
-                'extract_flat': True,
-                'default_search': 'ytsearch' + str(max_results),
-            })
+        # Serve repeated searches from the cache
+        cache_key = f"{max_results}:{normalize_query(query)}"
+        cached_result = self.search_cache.get(cache_key)
+        tracing.annotate(cached=bool(cached_result))
+        if cached_result:
+            return cached_result
+        
+        return await self._search_flight.do(
+            cache_key,
+            lambda: self._search_youtube(query, max_results, cache_key)
+        )
+    
+    async def _search_youtube(self, query: str, max_results: int, cache_key: str) -> Optional[Dict]:
+        """
+        Run a YouTube search through yt-dlp and cache the result
+        
+        Args:
+            query: Search query
+            max_results: Maximum number of results
+            cache_key: Search cache key for the query
             
-            with yt_dlp.YoutubeDL(search_opts) as ydl:
-                # Search for the query
-                search_results = await asyncio.get_event_loop().run_in_executor(
-                    None, 
-                    lambda: ydl.extract_info(f"ytsearch{max_results}:{query}", download=False)
+        Returns:
+            Dict with video info or None if not found
+        """
+        def search():
+            with SEARCH_SECONDS.time(), tracing.span('ydl.search'):
+                return self.search_pool.run(
+                    lambda ydl: ydl.extract_info(f"ytsearch{max_results}:{query}", download=False)
                 )
-                
-                if search_results and 'entries' in search_results and search_results['entries']:
-                    # Return first result
-                    result = search_results['entries'][0]
-                    return {
-                        'id': result.get('id'),
-                        'title': result.get('title', 'Unknown Title'),
-                        'url': result.get('url') or f"https://www.youtube.com/watch?v={result.get('id')}",
-                        'duration': result.get('duration', 0),
-                        'uploader': result.get('uploader', 'Unknown'),
-                    }
-                
-                return None
-                
+        
+        SEARCHES_IN_FLIGHT.inc()
+        try:
+            # Search for the query
+            search_results = await asyncio.get_event_loop().run_in_executor(
+                self.search_executor, contextvars.copy_context().run, search
+            )
+            
+            if search_results and 'entries' in search_results and search_results['entries']:
+                # Return first result
+                result = search_results['entries'][0]
+                video_info = {
+                    'id': result.get('id'),
+                    'title': result.get('title', 'Unknown Title'),
+                    'url': result.get('url') or f"https://www.youtube.com/watch?v={result.get('id')}",
+                    'duration': result.get('duration', 0),
+                    'uploader': result.get('uploader', 'Unknown'),
+                }
+                self.search_cache.put(cache_key, video_info)
+                return video_info
+            
+            return None
+            
         except Exception as e:
             logging.error(f"Error searching YouTube: {e}")
             return None
+        finally:
+            SEARCHES_IN_FLIGHT.dec()
+    
+    async def extract_playlist(self, url: str) -> Optional[Dict]:
+        """
+        List the videos of a playlist in one flat extraction
+        
+        The entries are not resolved, their audio is fetched when they
+        come up in the queue.
+        
+        Args:
+            url: Playlist URL, a single video URL yields one entry
+            
+        Returns:
+            Dict with the playlist 'title' and its 'entries' as video info
+            dicts, or None if it could not be read
+        """
+        if not self.ydl_available:
+            logging.error("yt-dlp not available for playlists")
+            return None
+        
+        def extract():
+            with tracing.span('ydl.playlist'):
+                return self.playlist_pool.run(lambda ydl: ydl.extract_info(url, download=False))
+        
+        try:
+            info = await asyncio.get_running_loop().run_in_executor(
+                self.search_executor, contextvars.copy_context().run, extract
+            )
+        except Exception as e:
+            logging.error(f"Error reading playlist {url}: {e}")
+            return None
+        
+        if not info:
+            return None
+        
+        entries = []
+        for entry in info.get('entries') or ([info] if info.get('id') else []):
+            # Unavailable videos come back as None or without an ID
+            if not entry or not entry.get('id'):
+                continue
+            entry_url = entry.get('url') or ''
+            entries.append({
+                'id': entry['id'],
+                'title': entry.get('title') or 'Unknown Title',
+                'url': entry_url if entry_url.startswith('http') else f"https://www.youtube.com/watch?v={entry['id']}",
+                'duration': entry.get('duration') or 0,
+                'uploader': entry.get('uploader') or entry.get('channel') or 'Unknown',
+            })
+        
+        return {'title': info.get('title') or url, 'entries': entries[:Config.PLAYLIST_MAX_SONGS]}
     
     def _create_demo_result(self, query: str) -> Dict:
         """Create a demo result when yt-dlp is not available"""
@@ -112,12 +295,15 @@ class YouTubeDownloader:
             'uploader': 'Demo Channel',
         }
     
-    async def download_audio(self, video_info: Dict) -> Optional[str]:
+    async def download_audio(self, video_info: Dict, chat_id: int = 0,
+                             priority: int = PRIORITY_PLAY) -> Optional[str]:
         """
         Download audio from YouTube video
         
         Args:
             video_info: Video information dict
+            chat_id: Chat the download is for, used for fair scheduling
+            priority: PRIORITY_PLAY for songs about to play, PRIORITY_PREFETCH otherwise
             
         Returns:
             Path to downloaded file or None if failed
@@ -126,49 +312,413 @@ class YouTubeDownloader:
             logging.warning("yt-dlp not available - creating demo audio file")
             return self._create_demo_audio_file(video_info)
         
+        video_id = video_info.get('id') or self._sanitize_filename(video_info['title'])
+        
+        # Check if the video is already cached
+        cached_path = self.cache.get(video_id)
+        tracing.annotate(cached=bool(cached_path))
+        if cached_path:
+            logging.info(f"Cache hit for {video_id}: {cached_path}")
+            # Tracks cached before a post-download stage was enabled
+            self.post_process(video_id)
+            return cached_path
+        
+        # A progressive stream is already writing this file
+        stream = self.streams.get(video_id)
+        if stream is not None:
+            file_path = await stream.wait_complete()
+            if file_path:
+                return file_path
+        
+        if priority == PRIORITY_PLAY:
+            # A prefetch of this song may still be waiting for a worker
+            self.prioritize(video_id)
+        
+        return await self._download_flight.do(
+            video_id,
+            lambda: self._download_audio(video_info, video_id, chat_id, priority)
+        )
+    
+    async def stream_audio(self, video_info: Dict, chat_id: int = 0) -> Optional[ProgressiveStream]:
+        """
+        Start streaming a video's audio into the cache while it plays
+        
+        The caller can start playback as soon as this returns. None is
+        returned whenever streaming is not possible, and the caller should
+        then fall back to download_audio.
+        
+        Args:
+            video_info: Video information dict
+            chat_id: Chat the stream is for, used for fair scheduling
+            
+        Returns:
+            Buffered ProgressiveStream or None
+        """
+        if not (self.ydl_available and Config.STREAMING_ENABLED and Config.AUDIO_FORMAT in STREAM_FORMATS):
+            return None
+        
+        video_id = video_info.get('id')
+        if not video_id or self.cache.get_entry(video_id) or self._download_flight.in_flight(video_id):
+            # Cached or already downloading, the regular path is faster
+            return None
+        
+        stream = self.streams.get(video_id)
+        if stream is None:
+            stream = await self._start_stream(video_info, video_id, chat_id)
+            if stream is None:
+                return None
+        
+        if not await stream.wait_ready():
+            if self.streams.get(video_id) is stream:
+                del self.streams[video_id]
+            await stream.cancel()
+            logging.warning(f"Streaming failed for {video_id}, falling back to download")
+            return None
+        
+        return stream
+    
+    async def _start_stream(self, video_info: Dict, video_id: str, chat_id: int) -> Optional[ProgressiveStream]:
+        """Resolve the direct audio URL of a video and start piping it through ffmpeg"""
         try:
-            # Sanitize filename
-            safe_title = self._sanitize_filename(video_info['title'])
-            output_path = os.path.join(Config.DOWNLOAD_DIR, f"{safe_title}.{Config.AUDIO_FORMAT}")
+            info = await self.scheduler.run(
+                lambda: self.stream_pool.run(lambda ydl: ydl.extract_info(video_info['url'], download=False)),
+                chat_id=chat_id,
+                priority=PRIORITY_PLAY,
+                key=f"stream:{video_id}"
+            )
+        except Exception as e:
+            logging.error(f"Error resolving stream URL: {e}")
+            return None
+        
+        if not info or not info.get('url') or video_id in self.streams:
+            return self.streams.get(video_id)
+        
+        stream = ProgressiveStream(
+            video_id,
+            info['url'],
+            self.cache.path_for(video_id, Config.AUDIO_FORMAT),
+            duration=info.get('duration') or video_info.get('duration', 0),
+            http_headers=info.get('http_headers'),
+        )
+        if not await stream.start():
+            return None
+        
+        self.streams[video_id] = stream
+        stream.task.add_done_callback(lambda task: self._stream_finished(stream, video_info, task))
+        return stream
+    
+    def _stream_finished(self, stream: ProgressiveStream, video_info: Dict, task: asyncio.Task):
+        """Register a completed stream in the cache or fall back to a download"""
+        if self.streams.get(stream.video_id) is stream:
+            del self.streams[stream.video_id]
+        
+        # A cancelled pump may finish before cancel() marks the stream failed
+        if not task.cancelled() and stream.complete.is_set() and not stream.failed:
+            DOWNLOAD_BYTES.inc(stream.bytes_written, source='stream')
+            self.cache.put(stream.video_id, stream.final_path, duration=stream.duration, codec=stream.codec)
+            self.post_process(stream.video_id)
+            return
+        
+        if stream.listened:
+            # Playback already started from the partial file, make sure the
+            # full track still ends up in the cache
+            logging.warning(f"Stream for {stream.video_id} broke off, downloading instead")
+            fallback = asyncio.ensure_future(self.download_audio(video_info))
+            self._fallback_tasks.add(fallback)
+            fallback.add_done_callback(self._fallback_finished)
+    
+    def _fallback_finished(self, task: asyncio.Task):
+        """Forget a fallback download and log its failure"""
+        self._fallback_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logging.error(f"Fallback download failed: {task.exception()}")
+    
+    async def prewarm(self):
+        """Build the pooled YoutubeDL instances before the first requests need them"""
+        if not self.ydl_available:
+            return
+        
+        loop = asyncio.get_running_loop()
+        pools = [self.search_pool, self.download_pool, self.stream_pool]
+        await asyncio.gather(*(loop.run_in_executor(None, pool.prewarm) for pool in pools))
+        logging.info(f"Prewarmed YoutubeDL pools: {', '.join(f'{pool.name}={pool.size}' for pool in pools)}")
+    
+    def close(self):
+        """Release worker threads and pooled instances and save the cache index"""
+        for pool in (self.search_pool, self.download_pool, self.stream_pool, self.playlist_pool):
+            if pool is not None:
+                pool.close()
+        
+        for task in list(self._post_tasks.values()) + list(self._fallback_tasks):
+            task.cancel()
+        
+        self.scheduler.shutdown()
+        self.search_executor.shutdown(wait=False)
+        self.media_pool.shutdown()
+        self.cache.flush()
+    
+    def _scheduler_state(self) -> Dict:
+        """Download scheduler gauges, computed on each scrape"""
+        stats = self.scheduler.stats()
+        return {
+            ('workers',): stats['workers'],
+            ('in_flight',): stats['in_flight'],
+            ('pending',): stats['pending'],
+        }
+    
+    def prioritize(self, video_id: str) -> bool:
+        """
+        Move a pending download of a video ahead of prefetch work
+        
+        Args:
+            video_id: YouTube video ID
             
-            # Check if file already exists
-            if os.path.exists(output_path):
-                logging.info(f"File already exists: {output_path}")
-                return output_path
+        Returns:
+            True if a pending download was promoted, False otherwise
+        """
+        return self.scheduler.promote(f"download:{video_id}")
+    
+    async def _download_audio(self, video_info: Dict, video_id: str, chat_id: int, priority: int) -> Optional[str]:
+        """
+        Download audio through yt-dlp into the cache
+        
+        Args:
+            video_info: Video information dict
+            video_id: Cache key for the video
+            chat_id: Chat the download is for
+            priority: Scheduling priority
+            
+        Returns:
+            Path to downloaded file or None if failed
+        """
+        def download():
+            started = time.perf_counter()
+            result = 'error'
+            try:
+                with tracing.span('ydl.download', video_id=video_id):
+                    info = self.download_pool.run(lambda ydl: ydl.extract_info(video_info['url'], download=True))
+                result = 'ok' if info else 'error'
+                return info
+            finally:
+                DOWNLOAD_SECONDS.observe(time.perf_counter() - started, result=result)
+        
+        try:
+            # Download the video, keeping the info yt-dlp extracted on the way
+            info = await self.scheduler.run(
+                download,
+                chat_id=chat_id,
+                priority=priority,
+                key=f"download:{video_id}"
+            )
             
-            # Download options
-            download_opts = self.ydl_opts.copy()
-            download_opts['outtmpl'] = os.path.join(Config.DOWNLOAD_DIR, f"{safe_title}.%(ext)s")
+            info = info or {}
+            duration = info.get('duration') or video_info.get('duration', 0)
             
-            with yt_dlp.YoutubeDL(download_opts) as ydl:
-                # Download the video
-                await asyncio.get_event_loop().run_in_executor(
-                    None,
-                    lambda: ydl.download([video_info['url']])
-                )
-                
-                # Check if file was created
-                if os.path.exists(output_path):
-                    logging.info(f"Successfully downloaded: {output_path}")
-                    return output_path
-                else:
-                    # Try to find the downloaded file with different extension
-                    base_path = os.path.join(Config.DOWNLOAD_DIR, safe_title)
-                    for ext in ['mp3', 'm4a', 'webm', 'ogg']:
-                        test_path = f"{base_path}.{ext}"
-                        if os.path.exists(test_path):
-                            # Rename to expected format if needed
-                            if ext != Config.AUDIO_FORMAT:
-                                os.rename(test_path, output_path)
-                            return output_path
-                    
-                    logging.error("Downloaded file not found")
-                    return None
+            # The pooled profile names files after the ID yt-dlp reports
+            file_stem = info.get('id') or video_id
+            
+            file_path = self._downloaded_file(info, file_stem)
+            if file_path is None:
+                logging.error("Downloaded file not found")
+                return None
+            
+            if Config.TRANSCODE_FREE:
+                file_path = await self._finish_audio(file_path, file_stem, info.get('acodec'))
+            
+            logging.info(f"Successfully downloaded: {file_path}")
+            DOWNLOAD_BYTES.inc(os.path.getsize(file_path), source='download')
+            ext = os.path.splitext(file_path)[1].lstrip('.')
+            file_path = self.cache.put(video_id, file_path, duration=duration, codec=ext)
+            self.post_process(video_id)
+            return file_path
                     
         except Exception as e:
             logging.error(f"Error downloading audio: {e}")
             return None
     
+    def _downloaded_file(self, info: Dict, file_stem: str) -> Optional[str]:
+        """
+        Find the file yt-dlp wrote for a download
+        
+        Args:
+            info: Info dict returned by extract_info
+            file_stem: Cache file name stem of the video
+            
+        Returns:
+            Path of the file or None if it is missing
+        """
+        for download in info.get('requested_downloads') or []:
+            file_path = download.get('filepath')
+            if file_path and os.path.exists(file_path):
+                return file_path
+        
+        # Older yt-dlp versions, preferring the configured format
+        for ext in [Config.AUDIO_FORMAT, 'mp3', 'm4a', 'opus', 'webm', 'ogg']:
+            file_path = self.cache.path_for(file_stem, ext)
+            if os.path.exists(file_path):
+                return file_path
+        return None
+    
+    async def _finish_audio(self, file_path: str, file_stem: str, acodec: Optional[str]) -> str:
+        """
+        Move a downloaded stream into an audio-only file
+        
+        Playable codecs are copied into their own container, anything else
+        is transcoded to AUDIO_FORMAT. Both run in the media process pool.
+        
+        Args:
+            file_path: File as downloaded
+            file_stem: Cache file name stem of the video
+            acodec: Audio codec yt-dlp reported for the file
+            
+        Returns:
+            Path of the finished file, the downloaded one if it could not be converted
+        """
+        family = codec_family(acodec)
+        if family in playable_codecs():
+            kind, encoder = 'remux', None
+            target = self.cache.path_for(file_stem, CODEC_EXTENSIONS[family])
+        else:
+            kind, encoder = 'transcode', ENCODERS.get(Config.AUDIO_FORMAT)
+            target = self.cache.path_for(file_stem, Config.AUDIO_FORMAT)
+        
+        if os.path.abspath(target) == os.path.abspath(file_path):
+            # Already in its audio-only container
+            return file_path
+        
+        try:
+            with tracing.span(kind, codec=acodec or 'unknown'):
+                seconds = await self.media_pool.run(
+                    convert_audio, file_path, target, encoder, Config.AUDIO_BITRATE, Config.FFMPEG_PATH
+                )
+            TRANSCODE_SECONDS.observe(seconds, postprocessor=kind)
+        except Exception as e:
+            logging.warning(f"Could not {kind} {file_path}, keeping it as downloaded: {e}")
+            return file_path
+        
+        try:
+            os.remove(file_path)
+        except OSError as e:
+            logging.warning(f"Could not remove {file_path}: {e}")
+        return target
+    
+    def post_process(self, video_id: str):
+        """
+        Start the post-download stages a cached track still needs
+        
+        Args:
+            video_id: YouTube video ID of a cache entry
+        """
+        self.measure_loudness(video_id)
+        self.prepare_frames(video_id)
+    
+    def measure_loudness(self, video_id: str) -> Optional[asyncio.Task]:
+        """
+        Analyze the loudness of a cached track in the background, once
+        
+        Args:
+            video_id: YouTube video ID of a cache entry
+            
+        Returns:
+            The analysis task, None if there is nothing to do
+        """
+        # The gain is only applied through the Opus frames
+        if not (Config.LOUDNESS_ANALYSIS and Config.OPUS_FRAMES):
+            return None
+        entry = self.cache.get_entry(video_id)
+        if entry is None or entry.get('loudness'):
+            return None
+        return self._run_post_stage(
+            'loudness', video_id, lambda: loudness.analyze_entry(self.cache, self.media_pool, video_id)
+        )
+    
+    def prepare_frames(self, video_id: str) -> Optional[asyncio.Task]:
+        """
+        Encode a cached track into Opus frames in the background, once
+        
+        Args:
+            video_id: YouTube video ID of a cache entry
+            
+        Returns:
+            The encoding task, None if there is nothing to do
+        """
+        if not Config.OPUS_FRAMES:
+            return None
+        # A running analysis may change the gain the frames need
+        if ('loudness', video_id) not in self._post_tasks and self._frames_current(video_id):
+            return None
+        return self._run_post_stage('frames', video_id, lambda: self._encode_frames(video_id))
+    
+    @staticmethod
+    def _frames_gain(entry: Dict) -> float:
+        """Get the normalization gain the frames of a cache entry are encoded with"""
+        if not Config.LOUDNESS_ANALYSIS:
+            return 0.0
+        return (entry.get('loudness') or {}).get('gain', 0.0)
+    
+    def _frames_current(self, video_id: str) -> bool:
+        """Check if a cache entry has frames encoded with its current gain"""
+        entry = self.cache.get_entry(video_id)
+        sidecar = entry.get('sidecars', {}).get('frames') if entry else None
+        if sidecar is None or sidecar.get('gain', 0.0) != self._frames_gain(entry):
+            return False
+        return self.cache.sidecar_path(video_id, 'frames') is not None
+    
+    def _run_post_stage(self, stage: str, video_id: str,
+                        func: Callable[[], Awaitable]) -> Optional[asyncio.Task]:
+        """Start a post-download stage unless it is running or failed before"""
+        key = (stage, video_id)
+        if key in self._post_tasks:
+            return self._post_tasks[key]
+        if key in self._post_failed:
+            return None
+        
+        def finished(task: asyncio.Task):
+            self._post_tasks.pop(key, None)
+            failed = not task.cancelled() and (task.exception() is not None or not task.result())
+            # Evicted tracks are handled again if they are downloaded again
+            if failed and self.cache.get_entry(video_id) is not None:
+                self._post_failed.add(key)
+        
+        # Run outside the trace of the request that triggered it
+        task = contextvars.Context().run(asyncio.ensure_future, func())
+        self._post_tasks[key] = task
+        task.add_done_callback(finished)
+        return task
+    
+    async def _encode_frames(self, video_id: str) -> bool:
+        """Write the Opus frame file of a cache entry with its normalization gain and attach it"""
+        # The gain is encoded into the frames, so it has to be known first
+        analysis = self._post_tasks.get(('loudness', video_id))
+        if analysis is not None:
+            await asyncio.wait([analysis])
+        if self._frames_current(video_id):
+            return True
+        
+        entry = self.cache.get_entry(video_id)
+        if entry is None:
+            return False
+        
+        source = os.path.join(self.cache.cache_dir, entry['file_name'])
+        target = self.cache.path_for(video_id, 'frames')
+        gain = self._frames_gain(entry)
+        try:
+            seconds = await self.media_pool.run(
+                encode_opus_frames, source, target, Config.OPUS_BITRATE, Config.FFMPEG_PATH, gain
+            )
+            TRANSCODE_SECONDS.observe(seconds, postprocessor='opus_frames')
+        except Exception as e:
+            logging.warning(f"Could not encode Opus frames for {video_id}: {e}")
+            return False
+        
+        if not self.cache.attach(video_id, 'frames', target, gain=gain):
+            # Evicted while encoding
+            os.remove(target)
+            return False
+        
+        logging.info(f"Encoded Opus frames for {video_id} in {seconds:.2f}s (gain {gain:+.2f} dB)")
+        return True
+    
     def _create_demo_audio_file(self, video_info: Dict) -> str:
         """Create a demo audio file when yt-dlp is not available"""
         try:
@@ -232,6 +782,7 @@ class YouTubeDownloader:
                 return None
             
             return {
+                'id': video_info.get('id'),
                 'title': video_info['title'],
                 'url': video_info['url'],
                 'file_path': file_path,
@@ -266,31 +817,3 @@ class YouTubeDownloader:
         filename = filename.strip(' .')
         
         return filename or "unknown_song"
-    
-    def cleanup_old_files(self, max_age_hours: int = 24):
-        """
-        Clean up old downloaded files
-        
-        Args:
-            max_age_hours: Maximum age of files to keep in hours
-        """
-        try:
-            import time
-            current_time = time.time()
-            max_age_seconds = max_age_hours * 3600
-            
-            for filename in os.listdir(Config.DOWNLOAD_DIR):
-                file_path = os.path.join(Config.DOWNLOAD_DIR, filename)
-                
-                if os.path.isfile(file_path):
-                    file_age = current_time - os.path.getmtime(file_path)
-                    
-                    if file_age > max_age_seconds:
-                        try:
-                            os.remove(file_path)
-                            logging.info(f"Cleaned up old file: {filename}")
-                        except Exception as e:
-                            logging.error(f"Error removing file {filename}: {e}")
-                            
-        except Exception as e:
-            logging.error(f"Error during cleanup: {e}")
\ No newline at end of file